@@ -1,8 +1,19 @@
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 import librosa
 import numpy as np
 import soundfile as sf
 
+from .atomic_write import atomic_path
+from .manifest import load_manifest, save_manifest, source_state, is_up_to_date
+from .dataset_index import load_index, dataset_dictionary, resampled_dictionary, resampled_registry
+
+# the functions librosa compiles with numba on first use (~30s) are cached in .numba_cache at the root of the
+# repository, the same cache as the API's (see api/audio.py), so they are only compiled once per machine or
+# image instead of once per container. NUMBA_CACHE_DIR overrides it
+os.environ.setdefault('NUMBA_CACHE_DIR', os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.numba_cache')))
+
 #---------------------------------------------------------------------------------------------------------
 # List of the Global Labels for each emotion:
 #   0 = neutral
@@ -45,6 +56,10 @@ global_labels = {'neutral': 0, 'happy': 1, 'sad': 2, 'angry': 3, 'fearful': 4, '
 # global target sampling rate
 target_sampling_rate = 24000
 
+# librosa.load's default sampling rate. All the processed data has been loaded at this rate before being
+# resampled to the target rate, so nothing above 11.025kHz has ever been part of the training data
+load_sampling_rate = 22050
+
 # specific label dictionaries for each dataset
 TESS_labels = {
     'angry': 'angry',
@@ -138,43 +153,198 @@ def convert_label(label):
 # The following are some functions to resize, normalize, and process audio files from each dataset
 # into new files and creates a new directory of processed data
 
+# function to resample audio to target_sr, in one step unless the audio was recorded above 22.05kHz:
+# that audio still goes through 22.05kHz first, so it keeps the same bandwidth as the rest of the
+# processed data (api/audio.py resamples the uploads the same way)
+def resample_audio(audio, sr, target_sr):
+    if sr > load_sampling_rate:
+        audio = librosa.resample(audio, orig_sr=sr, target_sr=load_sampling_rate)
+        sr = load_sampling_rate
+    return librosa.resample(audio, orig_sr=sr, target_sr=target_sr)
+
 # function to normalize and resamples every file into a specific sample rate (sr)
+# (the file is loaded at its own sampling rate, so it is only resampled once)
 def resample_data(file_path, target_sr):
-    audio, sr = librosa.load(file_path)
-    audio_resampled = librosa.resample(audio, orig_sr=sr, target_sr=target_sr)
-    audio_normalized = (audio_resampled - np.mean(audio_resampled)) / np.std(audio_resampled)
+    audio, sr = librosa.load(file_path, sr=None)
+    audio_resampled = resample_audio(audio, sr, target_sr)
+    audio_normalized = normalize_data(audio_resampled)
     return audio_normalized
 
 def normalize_data(audio_file):
     audio_normalized = (audio_file - np.mean(audio_file)) / np.std(audio_file)
     return audio_normalized
 
+# function to pad (with 0s) or truncate audio to desired_length_in_sec seconds
+def pad_audio(audio, sr, desired_length_in_sec):
+    desired_length = int(sr * desired_length_in_sec)
+
+    # Truncate if too long
+    if len(audio) > desired_length:
+        audio = audio[:desired_length]
+
+    # Else, pad with 0s
+    else:
+        padding = int(desired_length - len(audio))
+        audio = np.pad(audio, (0, padding), 'constant')
+    return audio
+
+# extract MFCCs and their first and second derivatives from an audio file (or an audio array at sampling rate sr)
+# sr=None keeps the file's own sampling rate
+def extract_mfccs(file_path=None, audio=None, n_mfcc=13, desired_length_in_sec=4.0, sr=None):
+
+    # Checks if the input has been a file path or a file
+    if (file_path!=None): audio, sr = librosa.load(file_path, sr=sr)
+    elif (sr==None): sr = target_sampling_rate
+
+    audio = pad_audio(audio, sr, desired_length_in_sec)
+
+    # COLUMNS of the mfcc correspond to the frames of the audio, ROWS represent features
+    mfcc = librosa.feature.mfcc(y=audio, sr=sr, n_mfcc=n_mfcc)
+    delta_mfcc  = librosa.feature.delta(mfcc)
+    delta2_mfcc = librosa.feature.delta(mfcc, order=2)
+
+    # Stacking mfcc and deltas together and normalizing every frame
+    combined_matrix = np.vstack([mfcc, delta_mfcc, delta2_mfcc])
+    combined_matrix = (combined_matrix - np.mean(combined_matrix, axis=0)) / np.std(combined_matrix, axis=0)
+
+    # We transpose so that the ROWS correspond to the frames of the audio, while COLUMNS represent features
+    return np.transpose(combined_matrix, [1, 0])
+
+
+# path of the processed version of the index-th audio file of a dataset
+def resampled_path(dataset, index, label):
+    return f"Data\\resampled\\{dataset}\\{dataset}_resampled_{str(index).zfill(6)}_emotion_{label}.wav"
+
+# parameters the processed files depend on, kept in the manifest so changing them reprocesses everything
+preprocessing_params = {'target sampling rate': target_sampling_rate, 'load sampling rate': load_sampling_rate,
+                        'normalization': 'mean 0, std 1', 'version': 1}
+
+# function to resample, normalize and save a single audio file (this is what runs in the worker processes)
+def process_audio_file(audio_path, path_name):
+    audio_modified = resample_data(audio_path, target_sampling_rate)
+    with atomic_path(path_name) as temporary_path:
+        sf.write(temporary_path, audio_modified, target_sampling_rate, format='WAV')
+    return path_name
+
+# function to go through the processed files as they finish, printing how far the processing is and how fast it goes
+# on_done is called with the position of every finished file
+def track_progress(dataset, results, total, report_every, on_done):
+    start_time = time.perf_counter()
+    for done, _ in enumerate(results, 1):
+        on_done(done - 1)
+        if done % report_every == 0 or done == total:
+            elapsed = time.perf_counter() - start_time
+            print(f'{dataset}: {done}/{total} files processed in {elapsed:.1f}s ({done / max(elapsed, 1e-9):.1f} files/s)')
+
+# function to decide which files need to be processed, using the dataset's manifest (see Lib/manifest.py)
+# returns the output path of every file of the dataset and the positions of the files to process
+def plan_preprocessing(dataset, dataset_dictionary, manifest, use_hash=False):
+    audio_paths = dataset_dictionary['audio path']
+    labels = dataset_dictionary['label']
+    same_params = manifest['params'] == preprocessing_params
+    files = manifest['files']
+
+    # sources that are gone from the dataset: their outputs are removed too
+    current_paths = set(audio_paths)
+    for audio_path in [audio_path for audio_path in files if audio_path not in current_paths]:
+        if os.path.isfile(files[audio_path]['output']): os.remove(files[audio_path]['output'])
+        del files[audio_path]
+
+    # a file keeps its output name as long as its label does not change. New files are named after their
+    # position in the dataset like before, unless another file already uses that index
+    used_indices = {entry['index'] for entry in files.values()}
+    next_index = max(used_indices, default=-1) + 1
+    path_names, to_process = [], []
+
+    for position, (audio_path, label) in enumerate(zip(audio_paths, labels)):
+        entry = files.get(audio_path)
+        if entry is not None and entry['label'] == label:
+            if not (same_params and is_up_to_date(entry, audio_path, use_hash) and os.path.isfile(entry['output'])):
+                to_process.append(position)
+            path_names.append(entry['output'])
+            continue
+
+        if entry is not None and os.path.isfile(entry['output']): os.remove(entry['output'])
+        if entry is not None: index = entry['index']
+        elif position not in used_indices: index = position
+        else: index, next_index = next_index, next_index + 1
+        used_indices.add(index)
+
+        files[audio_path] = {'label': label, 'index': index, 'output': resampled_path(dataset, index, label)}
+        path_names.append(files[audio_path]['output'])
+        to_process.append(position)
+
+    return path_names, to_process
+
+# processes the new, changed or missing audio files of the dataset, split across `workers` processes (all the
+# cores by default, workers=1 processes everything in this process) and sent to them in chunks of `chunksize`
+# files. Everything that is already up to date according to the dataset's manifest is skipped, so a rerun
+# after adding files or after an interrupted run only does the remaining work. With use_hash, changes are
+# detected from the files' contents instead of only their size and modification time.
+def preprocess_dataset(dataset, dataset_dictionary, workers=None, chunksize=16, report_every=500, use_hash=False, save_every=200):
+    dataset_dir = f"Data\\resampled\\{dataset}"
+
+    manifest = load_manifest(dataset)
+    if manifest is None:
+        manifest = {'dataset': dataset, 'params': preprocessing_params, 'files': {}}
+        if (os.path.isdir(dataset_dir)): adopt_processed_files(dataset, dataset_dictionary, manifest)
+
+    path_names, to_process = plan_preprocessing(dataset, dataset_dictionary, manifest, use_hash)
+    manifest['params'] = preprocessing_params
 
-def preprocess_dataset(dataset, dataset_dictionary):
-    # prevents re-running if the data has already been processed
-    if (os.path.isdir(f"Data\\resampled\\{dataset}")):
+    if not to_process:
+        save_manifest(manifest)
         print('Dataset has already been normalized and resampled. Skipping...')
-        return
-    
-    print('No processed data found. Processing the dataset...')
+        return path_names
 
-    for index, audio_path in enumerate(dataset_dictionary['audio path']):
-        audio_modified = resample_data(audio_path, target_sampling_rate)
-        audio_modified = normalize_data(audio_modified)
+    print(f'Processing {len(to_process)} new, changed or missing files out of {len(path_names)}...')
+
+    # Making directory to store audio files, and removing what an interrupted run could have left behind
+    os.makedirs(dataset_dir, exist_ok=True)
+    for file in os.listdir(dataset_dir):
+        if file.endswith('.tmp'): os.remove(os.path.join(dataset_dir, file))
+
+    audio_paths = [dataset_dictionary['audio path'][position] for position in to_process]
+    outputs = [path_names[position] for position in to_process]
+
+    # records every finished file in the manifest, which is saved regularly, so an interrupted run keeps its progress
+    def on_done(done):
+        manifest['files'][audio_paths[done]].update(source_state(audio_paths[done], use_hash))
+        if (done + 1) % save_every == 0: save_manifest(manifest)
 
-        # Making directory to store audio files
-        os.makedirs(f"Data\\resampled\\{dataset}", exist_ok=True)
-        path_name = f"Data\\resampled\\{dataset}\\{dataset}_resampled_{str(index).zfill(6)}_emotion_{dataset_dictionary['label'][index]}.wav"
+    if workers is None: workers = os.cpu_count()
+
+    try:
+        if workers == 1:
+            track_progress(dataset, map(process_audio_file, audio_paths, outputs), len(audio_paths), report_every, on_done)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(process_audio_file, audio_paths, outputs, chunksize=chunksize)
+                track_progress(dataset, results, len(audio_paths), report_every, on_done)
+    finally:
+        save_manifest(manifest)
 
-        # Save audio output as wav file
-        sf.write(path_name, audio_modified, target_sampling_rate)
-        librosa.get_samplerate(path_name)
     print('Dataset normalized and resampled successfully')
+    return path_names
+
+# function to build a manifest for a dataset processed before manifests existed: every output that is
+# there and readable is taken as up to date, the missing or broken ones will be processed again
+def adopt_processed_files(dataset, dataset_dictionary, manifest):
+    for index, (audio_path, label) in enumerate(zip(dataset_dictionary['audio path'], dataset_dictionary['label'])):
+        entry = {'label': label, 'index': index, 'output': resampled_path(dataset, index, label)}
+        try:
+            sf.info(entry['output'])
+            entry.update(source_state(audio_path))
+        except Exception:
+            pass    # no size/mtime recorded, so the file counts as changed
+        manifest['files'][audio_path] = entry
 
 # function to add modified audio file's path to dataset dictionaries
 def add_modified_path(dataset, dataset_dictionary):
+    files = (load_manifest(dataset) or {'files': {}})['files']
     for index, audio_path in enumerate(dataset_dictionary['audio path']):
-        path_name = f"Data\\resampled\\{dataset}\\{dataset}_resampled_{str(index).zfill(6)}_emotion_{dataset_dictionary['label'][index]}.wav"
+        if audio_path in files: path_name = files[audio_path]['output']
+        else: path_name = resampled_path(dataset, index, dataset_dictionary['label'][index])
         dataset_dictionary['resampled audio path'].append(path_name)
     return (dataset_dictionary)
 
@@ -187,32 +357,14 @@ def merge_dataset_dictionaries(*dataset_dictionaries):
     return merged_dictionary
 
 
-# Now, different functions specifically for each filename format in different datasets:
+# Now, the functions for each dataset. The files and labels of every dataset come from the dataset index
+# (Lib/dataset_index.py), where each dataset's filename format is described by a pattern, so all the
+# datasets are crawled once, in parallel, and only again when their directories change
 
 # TESS labels: ['angry' 'disgust' 'fear' 'happy' 'neutral' 'ps' 'sad']
 def TESS():
 
-    dataset_path = "Data\\TESS"                     # keeps the main path of the dataset
-    dataset_folders = os.listdir(dataset_path)      # lists all the folders inside the dataset
-
-    TESS_dictionary = {'audio path': [], 'dataset label': [], 'label': [], 'resampled audio path': []}
-
-    # going through each file in the dataset and extract the information about all the audio files inside
-    for file in dataset_folders:
-        if file == "TESS Toronto emotional speech set data":
-            continue
-
-        file_path = os.path.join(dataset_path, file)
-        audio_files = os.listdir(file_path)
-        
-        for audio in audio_files:
-            audio_path = os.path.join(file_path, audio)
-            audio_label = audio.split("_")[2][:-4]
-            audio_label_global = assign_global_labels('TESS', audio_label)
-
-            TESS_dictionary['audio path'].append(audio_path)
-            TESS_dictionary['dataset label'].append(audio_label)
-            TESS_dictionary['label'].append(audio_label_global)
+    TESS_dictionary = dataset_dictionary('TESS')
 
     # preprocess all the audio files and keep the new paths
     preprocess_dataset('TESS', TESS_dictionary)
@@ -224,20 +376,7 @@ def TESS():
 # CREMA labels: ['ANG' 'DIS' 'FEA' 'HAP' 'NEU' 'SAD']
 def CREMA():
     
-    dataset_path = "Data\\CREMA"                     # keeps the main path of the dataset
-    audio_files = os.listdir(dataset_path)           # lists all the folders inside the dataset
-
-    CREMA_dictionary = {'audio path': [], 'dataset label': [], 'label': [], 'resampled audio path': []}
-
-    # going through each file in the dataset and extract the information about all the audio files inside
-    for audio in audio_files:
-        audio_path = os.path.join(dataset_path, audio)
-        audio_label = audio.split("_")[2]
-        audio_label_global = assign_global_labels('CREMA', audio_label)
-
-        CREMA_dictionary['audio path'].append(audio_path)
-        CREMA_dictionary['dataset label'].append(audio_label)
-        CREMA_dictionary['label'].append(audio_label_global)
+    CREMA_dictionary = dataset_dictionary('CREMA')
 
     # preprocess all the audio files and keep the new paths
     preprocess_dataset('CREMA', CREMA_dictionary)
@@ -249,20 +388,7 @@ def CREMA():
 # SAVEE labels: ['a' 'd' 'f' 'h' 'n' 'sa' 'su']
 def SAVEE():
     
-    dataset_path = "Data\\SAVEE"                     # keeps the main path of the dataset
-    audio_files = os.listdir(dataset_path)           # lists all the folders inside the dataset
-
-    SAVEE_dictionary = {'audio path': [], 'dataset label': [], 'label': [], 'resampled audio path': []}
-
-    # going through each file in the dataset and extract the information about all the audio files inside
-    for audio in audio_files:
-        audio_path = os.path.join(dataset_path, audio)
-        audio_label = audio.split("_")[1][:-6]
-        audio_label_global = assign_global_labels('SAVEE', audio_label)
-
-        SAVEE_dictionary['audio path'].append(audio_path)
-        SAVEE_dictionary['dataset label'].append(audio_label)
-        SAVEE_dictionary['label'].append(audio_label_global)
+    SAVEE_dictionary = dataset_dictionary('SAVEE')
 
     # preprocess all the audio files and keep the new paths
     preprocess_dataset('SAVEE', SAVEE_dictionary)
@@ -285,31 +411,7 @@ def SAVEE():
 # RAVDESS labels: ['01' '02' '03' '04' '05' '06' '07' '08']
 def RAVDESS():
 
-    dataset_path = "Data\\RAVDESS"                  # keeps the main path of the dataset
-    dataset_folders = os.listdir(dataset_path)      # lists all the folders inside the dataset
-
-    RAVDESS_dictionary = {'audio path': [], 'dataset label': [], 'label': [], 'resampled audio path': []}
-
-    # going through each file in the dataset and extract the information about all the audio files inside
-    for file in dataset_folders:
-        if file == "audio_speech_actors_01-24":
-            continue
-
-        file_path = os.path.join(dataset_path, file)
-        audio_files = os.listdir(file_path)
-        
-        for audio in audio_files:
-            audio_path = os.path.join(file_path, audio)
-            audio_label = (audio.split("-"))[2]
-
-            # Skip calm
-            if audio_label == '02':
-                continue
-            audio_label_global = assign_global_labels('RAVDESS', audio_label)
-
-            RAVDESS_dictionary['audio path'].append(audio_path)
-            RAVDESS_dictionary['dataset label'].append(audio_label)
-            RAVDESS_dictionary['label'].append(audio_label_global)
+    RAVDESS_dictionary = dataset_dictionary('RAVDESS')      # calm is not in RAVDESS_labels, so it is skipped
 
     # preprocess all the audio files and keep the new paths
     preprocess_dataset('RAVDESS', RAVDESS_dictionary)
@@ -327,21 +429,8 @@ def RAVDESS():
 #       since we want to augment our dataset
 #
 def EMOdb():
-    dataset_path = "Data\\EMOdb"                  # keeps the main path of the dataset
-    audio_files = os.listdir(dataset_path)      # lists all the folders inside the dataset
-
-    EMOdb_dictionary = {'audio path': [], 'dataset label': [], 'label': [], 'resampled audio path': []}
-
-    # going through each file in the dataset and extract the information about all the audio files inside
-    for audio in audio_files:
-        audio_path = os.path.join(dataset_path, audio)
-        audio_label = audio[5]
-        if audio_label in ['A', 'F', 'T', 'N']:
-            audio_label_global = assign_global_labels('EMOdb', audio_label)
 
-            EMOdb_dictionary['audio path'].append(audio_path)
-            EMOdb_dictionary['dataset label'].append(audio_label)
-            EMOdb_dictionary['label'].append(audio_label_global)
+    EMOdb_dictionary = dataset_dictionary('EMOdb')          # only the labels in EMOdb_labels are kept
 
     # preprocess all the audio files and keep the new paths
     preprocess_dataset('EMOdb', EMOdb_dictionary)
@@ -350,38 +439,9 @@ def EMOdb():
     return EMOdb_dictionary
 
 # In case one wants to just use the resampled data, we ignore all the original datasets and use all the
-# resampled data
+# resampled data (from the index of Data\resampled, which is only crawled again when it changes)
 
 def load_resampled():
     
-    global global_labels
-    
-    dataset_path = 'Data\\resampled'
-    available_datasets = os.listdir(dataset_path)
-    
-    CREMA_dictionary = {'resampled audio path': [], 'label': []}
-    RAVDESS_dictionary = {'resampled audio path': [], 'label': []}
-    SAVEE_dictionary = {'resampled audio path': [], 'label': []}
-    TESS_dictionary = {'resampled audio path': [], 'label': []}
-    EMOdb_dictionary = {'resampled audio path': [], 'label': []}
-    
-    for dataset in available_datasets:
-
-        file_path = os.path.join(dataset_path, dataset)
-        audio_files = os.listdir(file_path)
-        
-        audio_files.sort()
-        
-        if dataset == 'CREMA': print('-----------CREMA:',len(audio_files))
-        
-        dataset_dictionary = locals()[dataset+'_dictionary']
-        
-        for audio in audio_files:
-            
-            audio_path = os.path.join(file_path, audio)
-            audio_label = int((audio.split("_"))[-1][:-4])   # takes only the last section (x.wav) and removes the '.wav'
-            
-            dataset_dictionary['resampled audio path'].append(audio_path)
-            dataset_dictionary['label'].append(audio_label)
-    
-    return CREMA_dictionary, RAVDESS_dictionary, SAVEE_dictionary, TESS_dictionary, EMOdb_dictionary
\ No newline at end of file
+    index = load_index(resampled_registry)
+    return tuple(resampled_dictionary(dataset, index) for dataset in ['CREMA', 'RAVDESS', 'SAVEE', 'TESS', 'EMOdb'])
@@ -0,0 +1,29 @@
+import os
+import threading
+from contextlib import contextmanager
+
+#---------------------------------------------------------------------------------------------------------
+# Every file Lib writes for later runs (cached features, packs, manifests, indexes, checkpoints, resampled
+# wavs) goes through atomic_path: it is written under a temporary name next to its destination and renamed
+# over it once complete. os.replace is atomic, so a reader only ever sees the previous file or the new one,
+# and an interrupted run leaves a .tmp file behind instead of a half written file that looks complete.
+#---------------------------------------------------------------------------------------------------------
+
+
+# yields the temporary path to write to, and renames it to path once the block finishes, e.g.
+#   with atomic_path(path) as temporary_path:
+#       torch.save(checkpoint, temporary_path)
+# the temporary name is unique to the process and thread, so concurrent writers of the same path never
+# write into each other's file. If the block raises, the temporary file is removed and path is untouched.
+# (np.save/np.savez add an extension to paths that don't have it, give them an open file instead)
+@contextmanager
+def atomic_path(path):
+    directory = os.path.dirname(path)
+    if directory: os.makedirs(directory, exist_ok=True)
+    temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        yield temporary_path
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path): os.remove(temporary_path)
+        raise
@@ -0,0 +1,88 @@
+import numpy as np
+import librosa
+import scipy.fft
+import scipy.signal
+
+#---------------------------------------------------------------------------------------------------------
+# Batched version of Lib.extract_mfccs for clips that are all padded to the same length: an (N, samples)
+# array in, the (N, frames, 3 * n_mfcc) MFCC + delta + delta² matrices of all N clips out, computed with a
+# few large array operations per chunk of clips instead of a dozen librosa calls per clip:
+#
+#   frames (strided view) -> window -> rfft -> power -> mel filterbank -> dB -> DCT -> deltas -> normalization
+#
+# with the same parameters as librosa.feature.mfcc / librosa.feature.delta (2048 point FFT, hop of 512,
+# centered zero-padded frames, 128 slaney mel bands, top_db=80 per clip, orthonormal DCT-II, 9 frame
+# Savitzky-Golay deltas). The window, mel filterbank and DCT matrix are computed once, the output is
+# preallocated (or given), and the chunks keep the intermediate arrays to a few hundred MB.
+#
+#   extractor = BatchMFCC(sr=24000, n_mfcc=13)
+#   features = extractor(extractor.pad([audio_1, audio_2, ...], desired_length_in_sec=4.0))
+#
+# The results match extract_mfccs to float32 precision (see benchmarks/batch_features.py).
+#---------------------------------------------------------------------------------------------------------
+
+
+class BatchMFCC:
+
+    def __init__(self, sr=24000, n_mfcc=13, n_fft=2048, hop_length=512, n_mels=128, top_db=80.0, delta_width=9,
+                 chunk_size=32):
+        self.sr = sr
+        self.n_mfcc = n_mfcc
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.top_db = top_db
+        self.delta_width = delta_width
+        self.chunk_size = chunk_size
+
+        self.window = scipy.signal.get_window('hann', n_fft, fftbins=True).astype(np.float32)
+        # (n_fft // 2 + 1, n_mels), so that power @ mel_basis gives (..., frames, n_mels)
+        self.mel_basis = librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels).T.astype(np.float32)
+        # (n_mels, n_mfcc) orthonormal DCT-II, the first n_mfcc coefficients
+        self.dct_matrix = scipy.fft.dct(np.eye(n_mels), type=2, norm='ortho', axis=0)[:n_mfcc].T.astype(np.float32)
+
+    def num_frames(self, num_samples):
+        return 1 + num_samples // self.hop_length
+
+    # pads (or cuts) every clip to desired_length_in_sec into one (N, samples) array, like Lib.pad_audio
+    def pad(self, clips, desired_length_in_sec):
+        desired_length = int(self.sr * desired_length_in_sec)
+        batch = np.zeros((len(clips), desired_length), dtype=np.float32)
+        for row, clip in zip(batch, clips):
+            clip = clip[:desired_length]
+            row[:len(clip)] = clip
+        return batch
+
+    # (N, samples) -> (N, frames, 3 * n_mfcc) float32, written into out if it is given
+    def __call__(self, audio_batch, out=None):
+        audio_batch = np.asarray(audio_batch, dtype=np.float32)
+        if audio_batch.ndim == 1: audio_batch = audio_batch[np.newaxis]
+        shape = (len(audio_batch), self.num_frames(audio_batch.shape[1]), 3 * self.n_mfcc)
+        if out is None: out = np.empty(shape, dtype=np.float32)
+        elif out.shape != shape: raise ValueError(f'out has shape {out.shape}, expected {shape}')
+
+        for start in range(0, len(audio_batch), self.chunk_size):
+            self._extract(audio_batch[start:start + self.chunk_size], out[start:start + self.chunk_size])
+        return out
+
+    def _extract(self, audio, out):
+        n = self.n_mfcc
+
+        # centered frames: n_fft // 2 zeros on both sides, then a strided (N, frames, n_fft) view
+        padded = np.pad(audio, ((0, 0), (self.n_fft // 2, self.n_fft // 2)))
+        frames = np.lib.stride_tricks.sliding_window_view(padded, self.n_fft, axis=1)[:, ::self.hop_length]
+        spectrum = scipy.fft.rfft(frames * self.window, axis=-1)
+        power = np.square(spectrum.real) + np.square(spectrum.imag)
+
+        # mel spectrogram in dB, clipped top_db below the loudest value of every clip
+        mel = np.maximum(power @ self.mel_basis, 1e-10)
+        mel_db = 10.0 * np.log10(mel)
+        np.maximum(mel_db, mel_db.max(axis=(1, 2), keepdims=True) - self.top_db, out=mel_db)
+
+        mfcc = out[..., :n]
+        np.matmul(mel_db, self.dct_matrix, out=mfcc)
+        out[..., n:2 * n] = scipy.signal.savgol_filter(mfcc, self.delta_width, polyorder=1, deriv=1, axis=1, mode='interp')
+        out[..., 2 * n:] = scipy.signal.savgol_filter(mfcc, self.delta_width, polyorder=2, deriv=2, axis=1, mode='interp')
+
+        # every frame normalized over its 3 * n_mfcc features
+        out -= out.mean(axis=2, keepdims=True)
+        out /= out.std(axis=2, keepdims=True)
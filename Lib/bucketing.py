@@ -0,0 +1,103 @@
+import argparse
+import numpy as np
+from torch.utils.data import Sampler
+
+from Lib.packed_features import PackedFeatureDataset, default_packed_dir
+
+#---------------------------------------------------------------------------------------------------------
+# Batches of clips of similar length, for the variable length mode of PackedFeatureDataset: every batch is
+# only padded to its longest clip instead of to the length every clip is padded to (4s, 188 frames), so
+# the model doesn't spend most of its time on padding frames.
+#
+# Every epoch the clips are shuffled, cut into pools of bucket_batches batches, every pool is sorted by
+# length and cut into batches, and the order of all the batches is shuffled again. So the batches are made
+# of clips of similar length but still change from one epoch to the next (as long as there is more than
+# one pool: larger pools pad less but mix less), and the long and short batches are spread over the epoch.
+#
+#   sampler = BucketBatchSampler(dataset.frames, batch_size=512, indices=train_indices)
+#   DataLoader(PackedFeatureDataset(variable_length=True), batch_sampler=sampler)
+#
+#   python -m Lib.bucketing --batch-size 512         padding of fixed, random and bucketed batches of the pack
+#---------------------------------------------------------------------------------------------------------
+
+
+class BucketBatchSampler(Sampler):
+
+    # lengths[i] is the length (valid frames) of the i-th sample of the dataset, indices the samples to use
+    # (all of them by default). The batches of an epoch only depend on seed and the epoch number
+    def __init__(self, lengths, batch_size, indices=None, bucket_batches=8, shuffle=True, drop_last=False, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.indices = np.arange(len(self.lengths)) if indices is None else np.asarray(indices)
+        self.bucket_batches = bucket_batches
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    # e.g. set_epoch(first_epoch) when resuming a training
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def epoch_batches(self, epoch):
+        rng = np.random.default_rng((self.seed, epoch))
+        indices = rng.permutation(self.indices) if self.shuffle else self.indices
+
+        batches = []
+        pool_size = self.batch_size * self.bucket_batches
+        for start in range(0, len(indices), pool_size):
+            pool = indices[start:start + pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+            batches += [pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size)]
+
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return [batch.tolist() for batch in batches]
+
+    def __iter__(self):
+        batches = self.epoch_batches(self.epoch)
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        if self.drop_last: return len(self.indices) // self.batch_size
+        return -(-len(self.indices) // self.batch_size)
+
+
+# frames the model goes through in an epoch of `batches`: padded to a fixed length (full_length frames per
+# clip), padded per batch (each batch to its longest clip), and without any padding at all
+def padding_stats(batches, lengths, full_length):
+    lengths = np.asarray(lengths)
+    clips = sum(len(batch) for batch in batches)
+    batch_frames = sum(len(batch) * int(lengths[batch].max()) for batch in batches)
+    content_frames = sum(int(lengths[batch].sum()) for batch in batches)
+    fixed_frames = clips * full_length
+    return {'clips': clips, 'fixed frames': fixed_frames, 'batch frames': batch_frames, 'content frames': content_frames,
+            'saved': 1 - batch_frames / fixed_frames if fixed_frames else 0.0}
+
+
+def padding_summary(stats):
+    return (f"{stats['batch frames'] / stats['clips']:.1f} frames per clip instead of {stats['fixed frames'] / stats['clips']:.0f}, "
+            f"{stats['saved'] * 100:.1f}% of the padded compute saved "
+            f"({(1 - stats['content frames'] / stats['batch frames']) * 100:.1f}% of the frames still padding)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Padding per epoch of fixed length, random and bucketed batches')
+    parser.add_argument('--packed-dir', default=default_packed_dir)
+    parser.add_argument('--batch-size', type=int, nargs='+', default=[64, 256, 512])
+    parser.add_argument('--bucket-batches', type=int, default=8)
+    args = parser.parse_args()
+
+    dataset = PackedFeatureDataset(args.packed_dir, variable_length=True)
+    full_length = dataset.features.shape[1]
+    print(f'{len(dataset)} clips of at most {full_length} frames, {np.mean(dataset.frames):.1f} valid frames on average')
+
+    for batch_size in args.batch_size:
+        random_batches = BucketBatchSampler(dataset.frames, batch_size, bucket_batches=1).epoch_batches(0)
+        bucketed_batches = BucketBatchSampler(dataset.frames, batch_size, bucket_batches=args.bucket_batches).epoch_batches(0)
+        print(f'batch size {batch_size}:')
+        print(f'  random batches:   {padding_summary(padding_stats(random_batches, dataset.frames, full_length))}')
+        print(f'  bucketed batches: {padding_summary(padding_stats(bucketed_batches, dataset.frames, full_length))}')
@@ -0,0 +1,129 @@
+import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import soundfile as sf
+
+from Lib.dataset_index import default_index_dir, read_index, write_index, load_index, resampled_registry
+
+#---------------------------------------------------------------------------------------------------------
+# Metadata of the processed clips (Data\resampled): duration, sampling rate and loudness, kept in
+#
+#   Data\index\metadata.npz         path, size, mtime, duration, sample rate, rms, rms max, rms std
+#
+# rms is the RMS of the whole clip, rms max and rms std are the largest and the spread of the RMS of its
+# 2048 sample frames (hop of 512, the MFCC frames), so quiet or mostly silent clips can be found without
+# opening them. Every clip is decoded once, by the metadata pass or by whatever already decoded it (like
+# Lib.packed_features.pack_features, which hands its stats over in `known` and keeps its own metadata.npz
+# next to the pack unless it is given this one), and only decoded again if its size or modification time
+# changes.
+#
+#   metadata = load_metadata(paths)                 columns in the order of paths
+#   python -m Lib.clip_metadata                     metadata pass over every processed clip, and a summary
+#---------------------------------------------------------------------------------------------------------
+
+default_metadata_path = os.path.join(default_index_dir, 'metadata.npz')
+
+columns = {'path': str, 'size': np.int64, 'mtime': np.int64, 'duration': np.float32, 'sample rate': np.int32,
+           'rms': np.float32, 'rms max': np.float32, 'rms std': np.float32}
+stat_columns = ['duration', 'sample rate', 'rms', 'rms max', 'rms std']
+
+
+# duration, sampling rate and RMS stats of decoded audio
+def clip_stats(audio, sr, frame_length=2048, hop_length=512):
+    audio = np.asarray(audio, dtype=np.float32)
+    if audio.ndim > 1: audio = audio.mean(axis=1)
+    if len(audio) == 0:
+        return {'duration': 0.0, 'sample rate': sr, 'rms': 0.0, 'rms max': 0.0, 'rms std': 0.0}
+
+    frames = np.lib.stride_tricks.sliding_window_view(audio, frame_length)[::hop_length] if len(audio) >= frame_length else audio[np.newaxis]
+    frame_rms = np.sqrt(np.mean(np.square(frames), axis=1))
+    return {'duration': len(audio) / sr, 'sample rate': sr, 'rms': float(np.sqrt(np.mean(np.square(audio)))),
+            'rms max': float(frame_rms.max()), 'rms std': float(frame_rms.std())}
+
+
+def read_stats(path):
+    try:
+        audio, sr = sf.read(path, dtype='float32')
+        return clip_stats(audio, sr)
+    except Exception:
+        return {'duration': np.nan, 'sample rate': 0, 'rms': np.nan, 'rms max': np.nan, 'rms std': np.nan}
+
+
+def file_state(path):
+    try:
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+    except OSError:
+        return -1, -1
+
+
+# the metadata of every path, in the same order, decoding only the clips that aren't in the metadata file
+# yet (or changed since). known maps paths to clip_stats of clips that were just decoded anyway
+def load_metadata(paths, metadata_path=default_metadata_path, known=None, workers=8):
+    known = known or {}
+    previous = read_index(metadata_path)
+    cached = {}
+    if previous is not None:
+        cached = {key: row for row, key in enumerate(zip(previous['path'].tolist(), previous['size'].tolist(), previous['mtime'].tolist()))}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        states = list(executor.map(file_state, paths))
+        keys = [(path, size, mtime) for path, (size, mtime) in zip(paths, states)]
+        to_read = [path for path, size, mtime in keys if (path, size, mtime) not in cached and path not in known]
+        if to_read: print(f'Reading the metadata of {len(to_read)} clips...')
+        read = dict(zip(to_read, executor.map(read_stats, to_read)))
+
+    table = {column: [] for column in columns}
+    for key in keys:
+        path, size, mtime = key
+        if key in cached:
+            stats = {column: previous[column][cached[key]] for column in stat_columns}
+        else:
+            stats = known[path] if path in known else read[path]
+        table['path'].append(path)
+        table['size'].append(size)
+        table['mtime'].append(mtime)
+        for column in stat_columns:
+            table[column].append(stats[column])
+    metadata = {column: np.array(table[column], dtype=dtype) for column, dtype in columns.items()}
+
+    # new or changed clips are saved, along with the clips of the metadata file that weren't asked for
+    if any(key not in cached for key in keys):
+        if previous is not None:
+            kept = ~np.isin(previous['path'], metadata['path'])
+            metadata_file = {column: np.concatenate([previous[column][kept], metadata[column]]) for column in columns}
+        else:
+            metadata_file = metadata
+        write_index(metadata_file, metadata_path)
+    return metadata
+
+
+# valid MFCC frames of every clip once padded or cut to desired_length_in_sec (what extract_mfccs gives
+# 1 + samples // hop_length frames for); the rest of the frames of its matrix are padding
+def clip_frames(metadata, desired_length_in_sec, hop_length=512):
+    sample_rate = metadata['sample rate'].astype(np.int64)
+    samples = np.round(np.nan_to_num(metadata['duration']) * sample_rate).astype(np.int64)
+    samples = np.minimum(samples, (sample_rate * desired_length_in_sec).astype(np.int64))
+    return 1 + samples // hop_length
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Metadata pass over the processed clips (Data\\resampled)')
+    parser.add_argument('--length', type=float, default=4.0, help='clip length the features are padded or cut to')
+    parser.add_argument('--workers', type=int, default=8, help='threads reading the clips')
+    args = parser.parse_args()
+
+    index = load_index(resampled_registry)
+    metadata = load_metadata(index['path'].tolist(), workers=args.workers)
+    durations = metadata['duration']
+    truncated = durations > args.length
+
+    print(f'{len(durations)} clips, {np.nansum(durations) / 3600:.2f} hours')
+    for dataset in index['datasets']:
+        rows = index['dataset'] == dataset
+        print(f'{dataset:>8}: {rows.sum():>6} clips, duration {np.nanmin(durations[rows]):.2f}s to {np.nanmax(durations[rows]):.2f}s '
+              f'(median {np.nanmedian(durations[rows]):.2f}s), {truncated[rows].sum()} longer than {args.length}s')
+    padding = 1 - np.nansum(np.minimum(durations, args.length)) / (len(durations) * args.length)
+    print(f'Padded to {args.length}s: {padding * 100:.1f}% of the samples are padding, {truncated.sum()} clips are cut '
+          f'({np.nansum(durations[truncated] - args.length):.1f}s of audio dropped)')
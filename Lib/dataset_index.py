@@ -0,0 +1,233 @@
+import os
+import re
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import soundfile as sf
+
+import Lib
+from Lib.atomic_write import atomic_path
+
+#---------------------------------------------------------------------------------------------------------
+# Index of the audio files of every dataset, built by one crawl of all the datasets and kept on disk:
+#
+#   Data\index\sources.npz          the original datasets (dataset_registry)
+#   Data\index\resampled.npz        the processed files in Data\resampled (resampled_registry)
+#
+# Every dataset is described in a registry: where it is, how deep its audio files are, which folders to skip,
+# and a regular expression taking the dataset's label out of a file name. The datasets are crawled with
+# os.scandir, in parallel threads, and the index is one array per column (np.savez), one row per file:
+#
+#   path, dataset, dataset label, label (global), duration (s), sample rate, size, mtime
+#
+# plus the modification time of every directory that was crawled. Loading the index only stats those
+# directories: a dataset where no file was added, removed or renamed comes straight from the file, the
+# others are crawled again (duration and sample rate, read from the file headers, are kept for the files
+# whose size and modification time didn't change). rebuild=True crawls everything again.
+#
+# Files whose name doesn't match the dataset's pattern, or whose label isn't used (RAVDESS calm, most of
+# EMOdb), are left out. The files of a dataset keep the order os.scandir gives them (os.listdir's order),
+# so the positions, and so the processed file names, are the same as before the index existed.
+#
+#   index = load_index()
+#   CREMA_dictionary = dataset_dictionary('CREMA', index)
+#---------------------------------------------------------------------------------------------------------
+
+# bump this when the index's columns change, to rebuild every index
+index_version = 1
+
+default_index_dir = "Data\\index"
+
+dataset_registry = {
+    # OAF_back_angry.wav, one folder per speaker and emotion
+    'TESS': {'path': "Data\\TESS", 'depth': 1, 'skip': ['TESS Toronto emotional speech set data'],
+             'pattern': r'^[^_]*_[^_]*_(?P<label>[^_]*)\.\w{3}$'},
+    # 1001_DFA_ANG_XX.wav
+    'CREMA': {'path': "Data\\CREMA", 'depth': 0, 'pattern': r'^[^_]*_[^_]*_(?P<label>[^_.]*)'},
+    # DC_sa01.wav
+    'SAVEE': {'path': "Data\\SAVEE", 'depth': 0, 'pattern': r'^[^_]*_(?P<label>[^_]*)\d\d\.\w{3}$'},
+    # 03-01-05-01-02-01-12.wav, one folder per actor
+    'RAVDESS': {'path': "Data\\RAVDESS", 'depth': 1, 'skip': ['audio_speech_actors_01-24'],
+                'pattern': r'^[^-]*-[^-]*-(?P<label>[^-]*)-'},
+    # 03a01Fa.wav
+    'EMOdb': {'path': "Data\\EMOdb", 'depth': 0, 'pattern': r'^.{5}(?P<label>.)'},
+}
+
+# the processed files are named after their global label (see Lib.resampled_path), and sorted by name
+resampled_registry = {
+    dataset: {'path': f"Data\\resampled\\{dataset}", 'depth': 0, 'pattern': r'_emotion_(?P<label>\d+)\.wav$',
+              'global labels': True, 'sorted': True}
+    for dataset in ['CREMA', 'RAVDESS', 'SAVEE', 'TESS', 'EMOdb']
+}
+
+columns = {'path': str, 'dataset': str, 'dataset label': str, 'label': np.int16, 'duration': np.float32,
+           'sample rate': np.int32, 'size': np.int64, 'mtime': np.int64}
+
+
+def registry_hash(registry):
+    return hashlib.sha1(json.dumps([index_version, registry], sort_keys=True).encode()).hexdigest()
+
+
+# every file of a dataset as (path, file name, size, modification time), and the modification time of every
+# directory crawled, or None if the dataset isn't there
+def crawl(spec):
+    if not os.path.isdir(spec['path']):
+        return None
+    files, directories = [], {}
+    skip = set(spec.get('skip', []))
+
+    def scan(directory, depth):
+        directories[directory] = os.stat(directory).st_mtime_ns
+        with os.scandir(directory) as entries:
+            entries = list(entries)
+        if spec.get('sorted'): entries.sort(key=lambda entry: entry.name)
+
+        for entry in entries:
+            if depth > 0:
+                if entry.is_dir() and entry.name not in skip: scan(entry.path, depth - 1)
+            elif entry.is_file():
+                stat = entry.stat()
+                files.append((entry.path, entry.name, stat.st_size, stat.st_mtime_ns))
+
+    scan(spec['path'], spec['depth'])
+    return files, directories
+
+
+# the dataset label and global label of a file name, or None if the file isn't part of the dataset
+def parse_label(dataset, spec, file_name):
+    match = re.search(spec['pattern'], file_name)
+    if match is None:
+        return None
+    dataset_label = match.group('label')
+    if spec.get('global labels'):
+        return dataset_label, int(dataset_label)
+    try:
+        return dataset_label, Lib.assign_global_labels(dataset, dataset_label)
+    except KeyError:
+        return None
+
+
+# duration in seconds and sampling rate, from the file's header
+def audio_info(path):
+    try:
+        info = sf.info(path)
+        return info.frames / info.samplerate, info.samplerate
+    except Exception:
+        return np.nan, 0
+
+
+def read_index(index_path):
+    if not os.path.isfile(index_path):
+        return None
+    with np.load(index_path, allow_pickle=False) as data:
+        return {key: data[key] for key in data.files}
+
+
+def write_index(index, index_path):
+    with atomic_path(index_path) as temporary_path, open(temporary_path, 'wb') as f:
+        np.savez(f, **index)
+
+
+# True if none of the directories crawled for the dataset changed (and a dataset that wasn't there still isn't)
+def is_current(index, dataset, spec):
+    if dataset not in index['datasets']:
+        return not os.path.isdir(spec['path'])
+    rows = index['directory dataset'] == dataset
+    for directory, mtime in zip(index['directory'][rows], index['directory mtime'][rows]):
+        try:
+            if os.stat(directory).st_mtime_ns != mtime: return False
+        except OSError:
+            return False
+    return True
+
+
+# the rows of a crawled dataset. Duration and sample rate come from the previous index when the file's
+# size and modification time are the same, the headers of the other files are read in `executor`
+def dataset_rows(dataset, spec, files, previous, executor):
+    known = {}
+    if previous is not None:
+        rows = previous['dataset'] == dataset
+        for path, size, mtime, duration, sample_rate in zip(previous['path'][rows], previous['size'][rows], previous['mtime'][rows],
+                                                            previous['duration'][rows], previous['sample rate'][rows]):
+            known[(path, size, mtime)] = (duration, sample_rate)
+
+    table = {column: [] for column in columns}
+    for path, file_name, size, mtime in files:
+        labels = parse_label(dataset, spec, file_name)
+        if labels is None: continue
+        table['path'].append(path)
+        table['dataset'].append(dataset)
+        table['dataset label'].append(labels[0])
+        table['label'].append(labels[1])
+        table['size'].append(size)
+        table['mtime'].append(mtime)
+
+    keys = list(zip(table['path'], table['size'], table['mtime']))
+    unknown = [path for path, size, mtime in keys if (path, size, mtime) not in known]
+    read = dict(zip(unknown, executor.map(audio_info, unknown)))
+    for key in keys:
+        duration, sample_rate = known[key] if key in known else read[key[0]]
+        table['duration'].append(duration)
+        table['sample rate'].append(sample_rate)
+
+    return {column: np.array(table[column], dtype=dtype) for column, dtype in columns.items()}
+
+
+# the index of every dataset of the registry, crawling again only the datasets that changed since it was saved
+def load_index(registry=dataset_registry, index_path=None, rebuild=False, workers=8):
+    if index_path is None:
+        index_path = os.path.join(default_index_dir, 'resampled.npz' if registry is resampled_registry else 'sources.npz')
+
+    index = None if rebuild else read_index(index_path)
+    if index is not None and str(index['registry']) != registry_hash(registry):
+        index = None
+    stale = [dataset for dataset in registry if index is None or not is_current(index, dataset, registry[dataset])]
+    if not stale:
+        return index
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        crawls = dict(zip(stale, executor.map(crawl, [registry[dataset] for dataset in stale])))
+
+        tables, directories, datasets = [], [], []
+        for dataset, spec in registry.items():
+            if dataset in stale:
+                if crawls[dataset] is None: continue
+                files, crawled = crawls[dataset]
+                tables.append(dataset_rows(dataset, spec, files, index, executor))
+                directories += [(directory, dataset, mtime) for directory, mtime in crawled.items()]
+            else:
+                if dataset not in index['datasets']: continue
+                rows = index['dataset'] == dataset
+                tables.append({column: index[column][rows] for column in columns})
+                rows = index['directory dataset'] == dataset
+                directories += zip(index['directory'][rows], index['directory dataset'][rows], index['directory mtime'][rows])
+            datasets.append(dataset)
+
+    index = {column: np.concatenate([table[column] for table in tables]) if tables else np.array([], dtype=dtype)
+             for column, dtype in columns.items()}
+    index['directory'] = np.array([directory for directory, _, _ in directories], dtype=str)
+    index['directory dataset'] = np.array([dataset for _, dataset, _ in directories], dtype=str)
+    index['directory mtime'] = np.array([mtime for _, _, mtime in directories], dtype=np.int64)
+    index['datasets'] = np.array(datasets, dtype=str)
+    index['registry'] = np.array(registry_hash(registry))
+    write_index(index, index_path)
+    return index
+
+
+# a dataset of the index as the dictionary the dataset functions (Lib.TESS(), Lib.CREMA(), ...) return
+def dataset_dictionary(dataset, index=None):
+    if index is None: index = load_index()
+    if dataset not in index['datasets']:
+        raise FileNotFoundError(f"{dataset_registry[dataset]['path']} does not exist")
+    rows = index['dataset'] == dataset
+    return {'audio path': index['path'][rows].tolist(), 'dataset label': index['dataset label'][rows].tolist(),
+            'label': index['label'][rows].tolist(), 'resampled audio path': []}
+
+
+# a processed dataset of the index as the dictionary Lib.load_resampled returns (empty if it isn't there)
+def resampled_dictionary(dataset, index=None):
+    if index is None: index = load_index(resampled_registry)
+    rows = index['dataset'] == dataset
+    return {'resampled audio path': index['path'][rows].tolist(), 'label': index['label'][rows].tolist()}
+
@@ -0,0 +1,106 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+import Lib
+from Lib.atomic_write import atomic_path
+
+#---------------------------------------------------------------------------------------------------------
+# Content-addressed cache for the MFCC (+ delta + delta²) features used in training.
+#
+# Every entry is keyed by the SHA-1 of the audio file's contents, and every set of feature parameters
+# (n_mfcc, padded length, sampling rate) gets its own directory named after a hash of those parameters:
+#
+#   Data\features\<parameters hash>\params.json
+#   Data\features\<parameters hash>\<first 2 characters of the file hash>\<file hash>.npy
+#
+# So the features of a file are computed once, renaming or moving a file keeps its entry, editing a file
+# only recomputes that file, and changing a parameter only misses the entries of the new parameter set
+# (the other sets stay on disk, ready to be used again).
+#
+# Entries are .npy files (float32 by default, float16 halves their size). With keep_in_memory=True (the
+# default) they are loaded fully and kept in memory after the first access, so from the second epoch on
+# nothing is read from disk at all. Only entries that are not kept are read with mmap (mmap=True): a kept
+# memmap would hold an open file descriptor per entry and run into the process's limit (ulimit -n).
+#---------------------------------------------------------------------------------------------------------
+
+# bump this when extract_mfccs changes in a way that changes its output, to invalidate every entry
+feature_version = 1
+
+default_cache_dir = "Data\\features"
+
+
+class FeatureCache:
+
+    def __init__(self, cache_dir=default_cache_dir, n_mfcc=13, desired_length_in_sec=4.0, sr=None,
+                 dtype=np.float32, mmap=True, keep_in_memory=True):
+        self.n_mfcc = n_mfcc
+        self.desired_length_in_sec = desired_length_in_sec
+        self.sr = sr
+        self.dtype = np.dtype(dtype)
+        self.mmap = mmap
+        self.keep_in_memory = keep_in_memory
+
+        self.params = {'n_mfcc': n_mfcc, 'desired length in sec': desired_length_in_sec, 'sr': sr,
+                       'dtype': self.dtype.name, 'version': feature_version}
+        self.params_hash = hashlib.sha1(json.dumps(self.params, sort_keys=True).encode()).hexdigest()[:16]
+        self.directory = os.path.join(cache_dir, self.params_hash)
+
+        os.makedirs(self.directory, exist_ok=True)
+        params_path = os.path.join(self.directory, 'params.json')
+        if not os.path.isfile(params_path):
+            with open(params_path, 'w') as f:
+                json.dump(self.params, f, indent=2)
+
+        self._features = {}          # file hash -> features
+        self._file_hashes = {}       # (path, size, modification time) -> file hash, so files are hashed once per run
+        self.hits = 0
+        self.misses = 0
+
+    # SHA-1 of the file's contents
+    def file_hash(self, file_path):
+        stat = os.stat(file_path)
+        file_key = (file_path, stat.st_size, stat.st_mtime_ns)
+
+        if file_key not in self._file_hashes:
+            sha1 = hashlib.sha1()
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha1.update(block)
+            self._file_hashes[file_key] = sha1.hexdigest()
+        return self._file_hashes[file_key]
+
+    def entry_path(self, file_hash):
+        return os.path.join(self.directory, file_hash[:2], f'{file_hash}.npy')
+
+    # returns the features of the file, computing and storing them only if they are not cached yet
+    def get(self, file_path):
+        file_hash = self.file_hash(file_path)
+        if file_hash in self._features:
+            self.hits += 1
+            return self._features[file_hash]
+
+        path = self.entry_path(file_hash)
+        if os.path.isfile(path):
+            self.hits += 1
+            # copy-on-write mmap, so torch can wrap the array without complaining that it is read-only
+            features = np.load(path, mmap_mode='c' if self.mmap and not self.keep_in_memory else None)
+        else:
+            self.misses += 1
+            features = Lib.extract_mfccs(file_path, n_mfcc=self.n_mfcc,
+                                         desired_length_in_sec=self.desired_length_in_sec, sr=self.sr).astype(self.dtype)
+            self._save(path, features)
+
+        if self.keep_in_memory:
+            self._features[file_hash] = features
+        return features
+
+    # computes and stores the features of all the files that are not cached yet (e.g. before training starts)
+    def warm_up(self, file_paths):
+        for file_path in file_paths:
+            self.get(file_path)
+
+    def _save(self, path, features):
+        with atomic_path(path) as temporary_path, open(temporary_path, 'wb') as f:
+            np.save(f, features)
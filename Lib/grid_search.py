@@ -0,0 +1,233 @@
+import os
+import argparse
+import importlib
+import pickle
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.utils.data import BatchSampler, SubsetRandomSampler
+from sklearn.model_selection import KFold
+
+from Lib.packed_features import PackedFeatureDataset, default_packed_dir
+from Lib.training import save_checkpoint, make_loader, fit
+from Lib.bucketing import BucketBatchSampler, padding_stats, padding_summary
+
+#---------------------------------------------------------------------------------------------------------
+# Learning rate grid search with k-fold cross validation, with every (lr, fold) job running in its own
+# process. This replaces the sequential grid_search of Semi_final_codes.ipynb:
+#
+#   python -m Lib.grid_search --lr 0.0005 0.001 --folds 4 --epochs 35 --batch-size 512 --workers 4 --run-number 4
+#
+# - the features come from the packed feature file (Lib.packed_features), which every worker memory-maps,
+#   so all the jobs read the same single copy of the features from the page cache
+# - every worker limits torch to threads_per_worker threads, so the workers don't fight over the cores
+# - every job holds its own model, gradients and Adam state, 16 bytes per parameter (~5.8 GB for a
+#   CNNModel, ~3 MB for a PooledCNNModel), so by default only as many jobs run at once as fit in the
+#   memory available when the search starts
+# - the splits are made once, up front, from a fixed seed: the held out test set and the folds are the same
+#   in every job and in every rerun (they are saved next to the results)
+# - every job checkpoints to its own file after each epoch, so an interrupted grid search resumes every job
+#   from its last finished epoch, and finished jobs are not run again. With --keep-checkpoints, every epoch
+#   past the halfway point is also kept in a file of its own, like the notebook did (a CNNModel checkpoint
+#   with its Adam state is ~4 GB, so they are not kept by default)
+# - the histories are merged into the same Complete_history.pkl format the plotting cells use:
+#   histories['all_loss_history'][lr][fold][epoch]
+# - with --variable-length, the batches are made of clips of similar length (Lib.bucketing) and only padded
+#   to their longest clip, with a model that takes any number of frames (Lib.models:PooledCNNModel by
+#   default). Every epoch reports how much of the fixed length padding it didn't compute
+# - --precision bf16 and --channels-last train with bfloat16 autocast and channels last tensors (see
+#   Lib.training), --loader-workers reads the batches ahead in that many processes per job. Every epoch
+#   reports its samples per second
+#---------------------------------------------------------------------------------------------------------
+
+default_checkpoint_dir = "Checkpoints\\grid_search"
+
+# the packed dataset of the worker process, opened once by init_worker
+worker_dataset = None
+
+
+def init_worker(threads_per_worker, packed_dir, variable_length=False):
+    global worker_dataset
+    torch.set_num_threads(threads_per_worker)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass    # can only be set before torch starts any parallel work
+    worker_dataset = PackedFeatureDataset(packed_dir, variable_length=variable_length)
+
+
+# builds the model from a 'module:ClassName' string, so jobs only have to pickle a string
+def make_model(model_spec, num_classes):
+    module_name, class_name = model_spec.split(':')
+    return getattr(importlib.import_module(module_name), class_name)(num_classes=num_classes)
+
+
+# rough memory of one job: weights, gradients and Adam's two moments in float32, and job_overhead_bytes
+# for the process itself and the activations of a batch. The model is built on the meta device, so
+# nothing is allocated
+job_overhead_bytes = 512 * 2**20
+
+
+def job_memory(model_spec, num_classes):
+    with torch.device('meta'):
+        parameters = sum(parameter.numel() for parameter in make_model(model_spec, num_classes).parameters())
+    return 16 * parameters + job_overhead_bytes
+
+
+# memory that can be used without swapping, in bytes, or None where it isn't known (only Linux says)
+def available_memory():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+# held out test set and k folds over the rest, like random_split + KFold in the notebook but seeded
+def make_splits(dataset_length, k_folds, test_fraction=0.2, seed=0):
+    rng = np.random.default_rng(seed)
+    permutation = rng.permutation(dataset_length)
+    test_length = int(round(dataset_length * test_fraction))
+    test_indices, train_indices = permutation[:test_length], permutation[test_length:]
+
+    kf = KFold(n_splits=k_folds, shuffle=True, random_state=seed)
+    folds = [(train_indices[train_idx], train_indices[val_idx]) for train_idx, val_idx in kf.split(train_indices)]
+    return test_indices, folds
+
+
+def checkpoint_path(checkpoint_dir, lr, fold):
+    return os.path.join(checkpoint_dir, f'grid_lr_{lr}_fold_{fold}.pth')
+
+
+# trains one (lr, fold) job, resuming from its checkpoint if there is one
+def run_job(job):
+    lr, fold = job['lr'], job['fold']
+    num_epochs = job['num_epochs']
+    filepath = checkpoint_path(job['checkpoint_dir'], lr, fold)
+
+    torch.manual_seed(job['seed'])
+    model = make_model(job['model'], job['num_classes'])
+    optimizer = optim.Adam(model.parameters(), lr=lr)
+    criterion = nn.CrossEntropyLoss()
+
+    # the same batches as DataLoader(batch_size=..., sampler=SubsetRandomSampler(...)), but every batch is read at once
+    if job['variable length']:
+        train_sampler = BucketBatchSampler(worker_dataset.frames, job['batch_size'], indices=job['train indices'], seed=job['seed'])
+        val_sampler = BucketBatchSampler(worker_dataset.frames, job['batch_size'], indices=job['val indices'], shuffle=False)
+    else:
+        train_sampler = BatchSampler(SubsetRandomSampler(job['train indices']), job['batch_size'], drop_last=False)
+        val_sampler = BatchSampler(SubsetRandomSampler(job['val indices']), job['batch_size'], drop_last=False)
+    train_loader = make_loader(worker_dataset, train_sampler, workers=job['loader workers'])
+    val_loader = make_loader(worker_dataset, val_sampler, workers=job['loader workers'])
+    halfpoint = round(num_epochs / 2)
+
+    def on_epoch_end(epoch, model, optimizer, histories):
+        if job['keep checkpoints'] and epoch > halfpoint:
+            save_checkpoint(lr, fold, epoch, model, optimizer,
+                            filepath=os.path.join(job['checkpoint_dir'], f'checkpoint_lr_{lr}_fold_{fold}_epoch_{epoch}.pth'))
+        if job['variable length']:
+            stats = padding_stats(train_sampler.epoch_batches(epoch), worker_dataset.frames, worker_dataset.features.shape[1])
+            print(f'[lr {lr}, fold {fold + 1}] Padding: {padding_summary(stats)}', flush=True)
+
+    histories = fit(model, optimizer, criterion, train_loader, val_loader, num_epochs, lr=lr, fold=fold, checkpoint_path=filepath,
+                    precision=job['precision'], channels_last=job['channels last'], log_prefix=f'[lr {lr}, fold {fold + 1}] ',
+                    on_epoch_end=on_epoch_end)
+    return lr, fold, histories
+
+
+# runs every (lr, fold) job over `workers` processes and returns the merged histories
+def grid_search(lr_values, k_folds, num_epochs, batch_size, model=None, packed_dir=default_packed_dir,
+                workers=None, threads_per_worker=None, checkpoint_dir=default_checkpoint_dir, test_fraction=0.2,
+                seed=0, keep_checkpoints=False, variable_length=False, precision='fp32', channels_last=False, loader_workers=0):
+
+    if model is None: model = 'Lib.models:PooledCNNModel' if variable_length else 'Lib.models:CNNModel'
+    dataset = PackedFeatureDataset(packed_dir, variable_length=variable_length)
+    test_indices, folds = make_splits(len(dataset), k_folds, test_fraction, seed)
+
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    with open(os.path.join(checkpoint_dir, 'splits.pkl'), 'wb') as f:
+        pickle.dump({'test indices': test_indices, 'folds': folds, 'seed': seed}, f)
+
+    jobs = [{'lr': lr, 'fold': fold, 'num_epochs': num_epochs, 'batch_size': batch_size, 'model': model,
+             'num_classes': dataset.num_classes(), 'train indices': train_idx, 'val indices': val_idx,
+             'checkpoint_dir': checkpoint_dir, 'seed': seed + fold, 'keep checkpoints': keep_checkpoints,
+             'variable length': variable_length, 'precision': precision, 'channels last': channels_last,
+             'loader workers': loader_workers}
+            for lr in lr_values for fold, (train_idx, val_idx) in enumerate(folds)]
+
+    per_job, available = job_memory(model, dataset.num_classes()), available_memory()
+    fitting = None if available is None else available // per_job
+    if workers is None: workers = min(len(jobs), os.cpu_count(), max(1, fitting if fitting is not None else len(jobs)))
+    if threads_per_worker is None: threads_per_worker = max(1, os.cpu_count() // workers)
+    memory = f'~{per_job / 1e9:.1f} GB per job' + ('' if available is None else f', {available / 1e9:.1f} GB available')
+    print(f'Running {len(jobs)} jobs on {workers} workers with {threads_per_worker} threads each ({memory})')
+    if fitting is not None and workers > fitting:
+        print(f'Warning: {workers} workers need ~{workers * per_job / 1e9:.1f} GB, more than the {available / 1e9:.1f} GB available')
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(threads_per_worker, packed_dir, variable_length)) as executor:
+        futures = [executor.submit(run_job, job) for job in jobs]
+        for future in as_completed(futures):
+            lr, fold, histories = future.result()
+            results[(lr, fold)] = histories
+            print(f'Finished lr {lr}, fold {fold + 1} ({len(results)}/{len(jobs)} jobs)', flush=True)
+
+    return merge_histories(results, lr_values, k_folds)
+
+
+# histories[category][lr][fold][epoch], like the notebook's grid_search
+def merge_histories(results, lr_values, k_folds):
+    histories = {'all_loss_history': {}, 'all_train_accuracy_history': {}, 'all_val_accuracy_history': {}}
+    for lr in lr_values:
+        folds = [results[(lr, fold)] for fold in range(k_folds)]
+        histories['all_loss_history'][lr] = [fold_histories['loss history'] for fold_histories in folds]
+        histories['all_train_accuracy_history'][lr] = [fold_histories['train accuracy history'] for fold_histories in folds]
+        histories['all_val_accuracy_history'][lr] = [fold_histories['val accuracy history'] for fold_histories in folds]
+    return histories
+
+
+def save_histories(histories, lr_values, k_folds, num_epochs, run_number):
+    os.makedirs(os.path.join('Results', str(run_number)), exist_ok=True)
+    lr_names = '_'.join(str(lr) for lr in lr_values)
+    filename = os.path.join('Results', str(run_number), f'Grid_Search_lr_{lr_names}_{k_folds}_folds_{num_epochs}_epochs_Complete_history.pkl')
+    with open(filename, 'wb') as f:
+        pickle.dump(histories, f)
+    print(f'Saved the histories to {filename}')
+    return filename
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parallel learning rate grid search with k-fold cross validation')
+    parser.add_argument('--lr', type=float, nargs='+', required=True, help='learning rates to try')
+    parser.add_argument('--folds', type=int, default=4)
+    parser.add_argument('--epochs', type=int, default=35)
+    parser.add_argument('--batch-size', type=int, default=512)
+    parser.add_argument('--model', default=None, help='model class, as module:ClassName (default: Lib.models:CNNModel, '
+                                                      'or Lib.models:PooledCNNModel with --variable-length)')
+    parser.add_argument('--variable-length', action='store_true', help='batches of clips of similar length, padded per batch')
+    parser.add_argument('--precision', choices=['fp32', 'bf16'], default='fp32', help='bf16: bfloat16 autocast')
+    parser.add_argument('--channels-last', action='store_true', help='channels last (NHWC) weights and inputs')
+    parser.add_argument('--loader-workers', type=int, default=0, help='processes reading the batches ahead, per job')
+    parser.add_argument('--packed-dir', default=default_packed_dir, help='output of Lib.packed_features.pack_features')
+    parser.add_argument('--checkpoint-dir', default=default_checkpoint_dir)
+    parser.add_argument('--keep-checkpoints', action='store_true', help='also keep a checkpoint of every epoch past the halfway point')
+    parser.add_argument('--workers', type=int, default=None, help='number of jobs running at once, each needs ~16 bytes per model parameter (~5.8 GB '
+                                                            'for CNNModel) (default: one per core, as many as fit in memory)')
+    parser.add_argument('--threads-per-worker', type=int, default=None, help='torch threads of every worker (default: cores / workers)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--run-number', required=True, help='results are saved in Results\\<run number>')
+    args = parser.parse_args()
+
+    histories = grid_search(args.lr, args.folds, args.epochs, args.batch_size, model=args.model, packed_dir=args.packed_dir,
+                            workers=args.workers, threads_per_worker=args.threads_per_worker,
+                            checkpoint_dir=args.checkpoint_dir, keep_checkpoints=args.keep_checkpoints, seed=args.seed,
+                            variable_length=args.variable_length, precision=args.precision, channels_last=args.channels_last,
+                            loader_workers=args.loader_workers)
+    save_histories(histories, args.lr, args.folds, args.epochs, args.run_number)
@@ -0,0 +1,71 @@
+import os
+import json
+import hashlib
+
+from Lib.atomic_write import atomic_path
+
+#---------------------------------------------------------------------------------------------------------
+# Preprocessing manifests: one json file per dataset recording, for every source audio file, what it was
+# when it got processed and where its processed version is:
+#
+#   Data\manifests\CREMA.json
+#   {
+#     "dataset": "CREMA",
+#     "params": {...},                          preprocessing parameters the outputs were made with
+#     "files": {
+#       "<source path>": {"size": ..., "mtime": ..., "sha1": ..., "label": 3, "index": 12, "output": "<path>"},
+#       ...
+#     }
+#   }
+#
+# A rerun only stats the files: anything new, changed (size, modification time or hash), relabelled,
+# processed with other parameters or with a missing output is processed again, everything else is skipped.
+#---------------------------------------------------------------------------------------------------------
+
+default_manifest_dir = "Data\\manifests"
+
+
+def manifest_path(dataset, manifest_dir=default_manifest_dir):
+    return os.path.join(manifest_dir, f'{dataset}.json')
+
+
+def load_manifest(dataset, manifest_dir=default_manifest_dir):
+    path = manifest_path(dataset, manifest_dir)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, manifest_dir=default_manifest_dir):
+    path = manifest_path(manifest['dataset'], manifest_dir)
+    with atomic_path(path) as temporary_path, open(temporary_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+
+def file_sha1(file_path):
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+# size and modification time of a source file (and its hash when use_hash is True)
+def source_state(file_path, use_hash=False):
+    stat = os.stat(file_path)
+    state = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    if use_hash: state['sha1'] = file_sha1(file_path)
+    return state
+
+
+# True if the entry still describes the source file. With use_hash, a file whose modification time changed
+# but whose contents did not (e.g. copied over again) is still up to date, and its entry is refreshed.
+def is_up_to_date(entry, file_path, use_hash=False):
+    state = source_state(file_path)
+    if entry.get('size') == state['size'] and entry.get('mtime') == state['mtime']:
+        return True
+    if use_hash and entry.get('size') == state['size'] and entry.get('sha1') == file_sha1(file_path):
+        entry['mtime'] = state['mtime']
+        return True
+    return False
@@ -0,0 +1,116 @@
+import torch
+import torch.nn as nn
+
+# A copy of the CNN defined and trained in Semi_final_codes.ipynb (4s clips: 188 by 39 MFCC matrices), in a
+# module so that worker processes (Lib.grid_search) can build it. api/model.py is the 2s version used by the API.
+class CNNModel(nn.Module):
+  def __init__(self, num_classes):
+    super().__init__()
+    self.model = nn.Sequential(
+
+        nn.Conv2d(1, 32, kernel_size=3, padding=1, stride=1),
+        nn.ReLU(),
+        nn.MaxPool2d(kernel_size=2, stride=2),
+        nn.Dropout(0.2),
+
+        nn.Conv2d(32, 64, kernel_size=3, padding=1, stride=1),
+        nn.ReLU(),
+        nn.MaxPool2d(kernel_size=2, stride=2),
+        nn.Dropout(0.2),
+
+        nn.Flatten(),
+
+        nn.Linear(27072, 13248),
+        nn.ReLU(),
+
+        nn.Linear(13248, 256),
+        nn.ReLU(),
+
+        nn.Linear(256, 128),
+        nn.ReLU(),
+
+        nn.Linear(128, num_classes),
+        nn.Softmax(dim=1)
+    )
+
+  def forward(self, x):
+    x = self.model(x)
+    return x
+
+
+# CNNModel's convolutions with a head that averages over the frames instead of flattening them, so it
+# takes clips of any number of frames (at least 4): the model for the variable length batches of
+# PackedFeatureDataset(variable_length=True) and Lib.bucketing.BucketBatchSampler.
+#
+# In those batches every clip is zero padded to the longest one, so forward takes the valid frames of every
+# clip too (frames, the dataset's third item). After each pooling, whatever comes from past a clip's last
+# valid frame is zeroed, and the mean is over the clip's own valid positions only: a clip gives the same
+# output alone as padded in any batch. Without frames, every frame of the input counts.
+class PooledCNNModel(nn.Module):
+  def __init__(self, num_classes, num_features=39):
+    super().__init__()
+    self.convolutions = nn.Sequential(
+
+        nn.Conv2d(1, 32, kernel_size=3, padding=1, stride=1),
+        nn.ReLU(),
+        nn.MaxPool2d(kernel_size=2, stride=2),
+        nn.Dropout(0.2),
+
+        nn.Conv2d(32, 64, kernel_size=3, padding=1, stride=1),
+        nn.ReLU(),
+        nn.MaxPool2d(kernel_size=2, stride=2),
+        nn.Dropout(0.2),
+    )
+    self.classifier = nn.Sequential(
+
+        nn.Linear(64 * (num_features // 4), 256),
+        nn.ReLU(),
+
+        nn.Linear(256, 128),
+        nn.ReLU(),
+
+        nn.Linear(128, num_classes),
+        nn.Softmax(dim=1)
+    )
+
+  # (batch, 1, frames, features) -> mean over the frames of the (batch, 64, frames / 4, features / 4) maps
+  def forward(self, x, frames=None):
+    if frames is None:
+      x = self.convolutions(x).mean(dim=2)
+    else:
+      # the convolutions see zeros past the last valid frame either way, the poolings (which round down)
+      # are what let the padding in: a pooled position is valid if both of the positions it covers are
+      lengths = frames.to(x.device) // 2
+      x = valid_positions(self.convolutions[:4](x), lengths)
+      lengths = lengths // 2
+      x = valid_positions(self.convolutions[4:](x), lengths).sum(dim=2) / lengths.clamp(min=1).view(-1, 1, 1).to(x.dtype)
+    x = self.classifier(x.flatten(1))
+    return x
+
+
+# the (batch, channels, positions, features) maps with the positions from lengths[i] on zeroed
+def valid_positions(x, lengths):
+  mask = torch.arange(x.shape[2], device=x.device) < lengths.view(-1, 1)
+  return x * mask.view(x.shape[0], 1, x.shape[2], 1).to(x.dtype)
+
+
+# checks that zero padding doesn't change PooledCNNModel's output: every clip alone, then padded to the
+# longest one in a single batch (exits with 1 if they differ by more than the tolerance)
+#   python -m Lib.models
+if __name__ == '__main__':
+  import sys
+  torch.manual_seed(0)
+  model = PooledCNNModel(num_classes=8).eval()
+  lengths = [4, 5, 7, 60, 61, 62, 63, 150, 188]
+  clips = [torch.randn(length, 39) for length in lengths]
+  padded = torch.zeros(len(clips), 1, max(lengths), 39)
+  for i, clip in enumerate(clips): padded[i, 0, :len(clip)] = clip
+
+  with torch.no_grad():
+    alone = torch.cat([model(clip.view(1, 1, *clip.shape)) for clip in clips])
+    batched = model(padded, torch.tensor(lengths))
+    unmasked = model(padded)
+  difference = (alone - batched).abs().max().item()
+  print(f'largest difference, alone vs padded in a batch: {difference:.2e} (without the valid frames: '
+        f'{(alone - unmasked).abs().max().item():.2e})')
+  sys.exit(0 if difference <= 1e-6 else 1)
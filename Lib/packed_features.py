@@ -0,0 +1,209 @@
+import os
+import json
+import numpy as np
+import librosa
+import torch
+from torch.utils.data import Dataset
+
+import Lib
+from Lib.atomic_write import atomic_path
+from Lib.batch_features import BatchMFCC
+from Lib.clip_metadata import clip_stats, load_metadata, clip_frames
+
+#---------------------------------------------------------------------------------------------------------
+# Packed feature format: the MFCC matrices of every clip of every dataset in one contiguous array on disk,
+# so training never opens the individual wav files again.
+#
+#   Data\packed\features.npy    (number of clips, frames, features) float32 or float16 array
+#   Data\packed\labels.npy      (number of clips,) global labels
+#   Data\packed\index.json      feature parameters, the [start, end) rows of every dataset, and the source
+#                               path, duration and valid frames (the frames that aren't padding) of every row
+#   Data\packed\metadata.npz    metadata of the packed clips (see Lib.clip_metadata), unless it is kept
+#                               somewhere else with metadata_path
+#
+# PackedFeatureDataset memory-maps features.npy, so a sample is a view into the page cache instead of a
+# copy. All the DataLoader workers (and every process reading the same file) share the same pages.
+#
+# With variable_length=True, a batch is only as long as its longest clip: the padding frames past it are
+# not read and the model never sees them. Use it with Lib.bucketing.BucketBatchSampler, which puts clips
+# of similar length together, and a model that takes any number of frames (Lib.models.PooledCNNModel).
+# Samples and batches are then (features, label, valid frames), so the model can leave out the padding
+# the shorter clips of a batch still get.
+#---------------------------------------------------------------------------------------------------------
+
+default_packed_dir = "Data\\packed"
+
+
+# packs the features of every clip of the given datasets, e.g.
+#   CREMA, RAVDESS, SAVEE, TESS, EMOdb = Lib.load_resampled()
+#   pack_features({'CREMA': CREMA, 'RAVDESS': RAVDESS, 'SAVEE': SAVEE, 'TESS': TESS, 'EMOdb': EMOdb})
+# a FeatureCache can be given to reuse (and fill) the cached features instead of extracting them again,
+# its n_mfcc and desired_length_in_sec must be the ones given here. Without one, the features are extracted
+# batch_size clips at a time by Lib.batch_features.BatchMFCC. The metadata of the clips is kept in
+# metadata_path (packed_dir\metadata.npz by default), e.g. Lib.clip_metadata.default_metadata_path to share
+# it with the metadata pass
+def pack_features(datasets, packed_dir=default_packed_dir, n_mfcc=13, desired_length_in_sec=4.0,
+                  dtype=np.float32, feature_cache=None, batch_size=64, metadata_path=None):
+    if feature_cache is not None and (feature_cache.n_mfcc, feature_cache.desired_length_in_sec) != (n_mfcc, desired_length_in_sec):
+        raise ValueError(f'the feature cache has n_mfcc={feature_cache.n_mfcc}, desired_length_in_sec={feature_cache.desired_length_in_sec}, '
+                         f'not n_mfcc={n_mfcc}, desired_length_in_sec={desired_length_in_sec}')
+
+    paths, labels, dataset_rows = [], [], {}
+    known_stats = {}
+    for dataset, dataset_dictionary in datasets.items():
+        dataset_rows[dataset] = [len(paths), len(paths) + len(dataset_dictionary['resampled audio path'])]
+        paths += dataset_dictionary['resampled audio path']
+        labels += dataset_dictionary['label']
+    if not paths: raise ValueError(f'no clips to pack in the datasets {list(datasets)}')
+
+    def features_of(audio_path):
+        if feature_cache is not None:
+            return feature_cache.get(audio_path)
+        return Lib.extract_mfccs(audio_path, n_mfcc=n_mfcc, desired_length_in_sec=desired_length_in_sec)
+
+    os.makedirs(packed_dir, exist_ok=True)
+    features_path = os.path.join(packed_dir, 'features.npy')
+    labels_path = os.path.join(packed_dir, 'labels.npy')
+    index_path = os.path.join(packed_dir, 'index.json')
+    if metadata_path is None: metadata_path = os.path.join(packed_dir, 'metadata.npz')
+
+    # every clip has the same shape since they are all padded to the same length
+    first_features = features_of(paths[0])
+    shape = (len(paths),) + first_features.shape
+
+    # the three files are renamed together once all of them are written, the index last
+    with atomic_path(index_path) as temporary_index_path, atomic_path(labels_path) as temporary_labels_path, \
+            atomic_path(features_path) as temporary_features_path:
+        features = np.lib.format.open_memmap(temporary_features_path, mode='w+', dtype=dtype, shape=shape)
+        features[0] = first_features
+        if feature_cache is not None:
+            for row in range(1, len(paths)):
+                features[row] = features_of(paths[row])
+                if row % 1000 == 0: print(f'Packed {row}/{len(paths)} clips')
+        else:
+            extract_in_batches(paths, features, n_mfcc, desired_length_in_sec, batch_size, known_stats)
+        features.flush()
+        del features
+
+        # durations of the clips (from the batches above, or the metadata pass), to know how much of every row is padding
+        metadata = load_metadata(paths, metadata_path, known=known_stats)
+        frames = np.minimum(clip_frames(metadata, desired_length_in_sec), shape[1])
+        truncated = int((metadata['duration'] > desired_length_in_sec).sum())
+
+        with open(temporary_labels_path, 'wb') as f:
+            np.save(f, np.asarray(labels, dtype=np.int64))
+
+        index = {'params': {'n_mfcc': n_mfcc, 'desired length in sec': desired_length_in_sec, 'dtype': np.dtype(dtype).name},
+                 'shape': list(shape),
+                 'datasets': dataset_rows,
+                 'paths': paths,
+                 'durations': metadata['duration'].tolist(),
+                 'frames': frames.tolist()}
+        with open(temporary_index_path, 'w') as f:
+            json.dump(index, f)
+
+    print(f'Packed {len(paths)} clips into {features_path}: {(1 - frames.mean() / shape[1]) * 100:.1f}% of the frames are padding, '
+          f'{truncated} clips longer than {desired_length_in_sec}s were cut')
+    return index
+
+
+# features of paths[1:] into features[1:], batch_size clips at a time. The clips are loaded at their own
+# sampling rate like extract_mfccs does; a clip whose rate differs from the rest of its batch is done alone.
+# The clip_stats of every decoded clip go into known_stats
+def extract_in_batches(paths, features, n_mfcc, desired_length_in_sec, batch_size, known_stats):
+    extractor = None
+    for start in range(1, len(paths), batch_size):
+        clips = [librosa.load(path, sr=None) for path in paths[start:start + batch_size]]
+        for path, (audio, clip_sr) in zip(paths[start:start + batch_size], clips):
+            known_stats[path] = clip_stats(audio, clip_sr)
+        sr = clips[0][1]
+        if extractor is None or extractor.sr != sr:
+            extractor = BatchMFCC(sr=sr, n_mfcc=n_mfcc, chunk_size=batch_size)
+
+        same_rate = [row for row, (_, clip_sr) in enumerate(clips) if clip_sr == sr]
+        batch = extractor(extractor.pad([clips[row][0] for row in same_rate], desired_length_in_sec))
+        features[start + np.asarray(same_rate)] = batch
+        for row, (audio, clip_sr) in enumerate(clips):
+            if clip_sr != sr:
+                features[start + row] = Lib.extract_mfccs(audio=audio, sr=clip_sr, n_mfcc=n_mfcc,
+                                                          desired_length_in_sec=desired_length_in_sec)
+
+        done = start + len(clips) - 1
+        if done // 1000 > (start - 1) // 1000: print(f'Packed {done}/{len(paths)} clips')
+
+
+class PackedFeatureDataset(Dataset):
+
+    # datasets selects which datasets of the pack to use (e.g. ['CREMA', 'TESS']), all of them by default.
+    # With variable_length, samples and batches are cut after their last valid frame (at least min_frames)
+    def __init__(self, packed_dir=default_packed_dir, datasets=None, variable_length=False, min_frames=4):
+        self.packed_dir = packed_dir
+        self.variable_length = variable_length
+
+        with open(os.path.join(packed_dir, 'index.json')) as f:
+            self.index = json.load(f)
+
+        all_labels = np.load(os.path.join(packed_dir, 'labels.npy'))
+        if datasets is None: datasets = list(self.index['datasets'])
+        self.rows = np.concatenate([np.arange(*self.index['datasets'][dataset]) for dataset in datasets])
+        self.labels = torch.from_numpy(all_labels[self.rows])
+
+        # valid frames of every sample, None for a pack made before the durations were recorded
+        self.frames = None
+        if 'frames' in self.index:
+            self.frames = np.maximum(np.asarray(self.index['frames'])[self.rows], min_frames)
+        elif variable_length:
+            raise ValueError(f'{packed_dir} has no clip durations, pack the features again to use variable_length')
+
+        self._open()
+
+    # copy-on-write mmap: views can be handed to torch without copying, and nothing is ever written back
+    def _open(self):
+        self.features = np.load(os.path.join(self.packed_dir, 'features.npy'), mmap_mode='c')
+
+    def __len__(self):
+        return len(self.rows)
+
+    def num_classes(self):
+        return len(set(self.labels.tolist()))
+
+    def path(self, index):
+        return self.index['paths'][self.rows[index]]
+
+    # frames=None reads the whole rows
+    def _read(self, rows, frames=None):
+        features = torch.from_numpy(self.features[rows, :frames])
+        return features if features.dtype == torch.float32 else features.float()
+
+    # an int gives one (features, label) sample, a list of indices gives a whole batch read at once:
+    #   DataLoader(dataset, sampler=BatchSampler(RandomSampler(dataset), batch_size, drop_last=False), batch_size=None)
+    # with variable_length, the valid frames of the sample (or of every sample of the batch) come third
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            if not self.variable_length:
+                return self._read(self.rows[index]), self.labels[index]
+            frames = int(self.frames[index])
+            return self._read(self.rows[index], frames), self.labels[index], torch.tensor(frames)
+
+        index = np.asarray(index)
+        frames = int(self.frames[index].max()) if self.variable_length else self.features.shape[1]
+        order = np.argsort(index)      # reading the rows in file order keeps the reads sequential
+        features = torch.empty((len(index), frames) + self.features.shape[2:], dtype=torch.float32)
+        features[torch.from_numpy(order)] = self._read(self.rows[index[order]], frames)
+        if not self.variable_length:
+            return features, self.labels[torch.from_numpy(index)]
+        return features, self.labels[torch.from_numpy(index)], torch.from_numpy(self.frames[index])
+
+    # used by the DataLoader's automatic batching: one read for the whole batch, split into samples
+    def __getitems__(self, indices):
+        return list(zip(*self[indices]))
+
+    # the memory map is not pickled, every worker started with 'spawn' maps the file again instead
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['features']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
@@ -0,0 +1,184 @@
+import os
+import time
+import torch
+from torch.utils.data import DataLoader
+
+from Lib.atomic_write import atomic_path
+
+#---------------------------------------------------------------------------------------------------------
+# Training helpers of Lib.grid_search, ready to be imported by any other training script: the checkpoint
+# format of Semi_final_codes.ipynb (the notebooks keep their own copies of these functions), one epoch of
+# training / evaluation on (batch, frames, features) inputs, and fit, the whole training loop with
+# checkpoints to resume from:
+#
+#   train_loader = make_loader(dataset, BatchSampler(SubsetRandomSampler(train_indices), 512, False), workers=4)
+#   val_loader = make_loader(dataset, BatchSampler(SubsetRandomSampler(val_indices), 512, False), workers=4)
+#   histories = fit(model, optimizer, criterion, train_loader, val_loader, num_epochs=35, lr=lr,
+#                   checkpoint_path='Checkpoints\\run.pth', precision='bf16', channels_last=True)
+#
+# - precision='bf16' runs the forward pass and the loss under bfloat16 autocast: the weights, the gradients
+#   and the optimizer state stay float32, and bfloat16 has float32's range, so there is no loss scaling.
+#   It is much faster on CPUs with bfloat16 instructions (AVX512-BF16, AMX), about as fast elsewhere
+# - channels_last keeps the model's weights and inputs in channels last (NHWC) order, which the CPU
+#   convolution kernels (oneDNN) run faster, with or without bfloat16
+# - make_loader reads whole float32 batches from PackedFeatureDataset at once, in persistent worker
+#   processes that read the next batches ahead while the model trains
+# - every epoch logs the training throughput in samples per second (loading included), also kept in the
+#   histories, so the options can be compared on the same data
+#---------------------------------------------------------------------------------------------------------
+
+# the dtype of the autocast of every precision (None: no autocast)
+precisions = {'fp32': None, 'bf16': torch.bfloat16}
+
+
+# This function will be used to create checkpoints along the learning (mode='checkpoint'), and also to save the
+# last state in each part of training (mode='last state'), so it can be restored and continue the training.
+# filepath overrides the default file of the mode.
+def save_checkpoint(lr, fold, epoch, model, optimizer, mode='checkpoint', extra_data=None, filepath=None):
+    checkpoint = {
+        'lr': lr,
+        'fold': fold,
+        'epoch': epoch,
+        'model_state_dict': model.state_dict(),
+        'optimizer_state_dict': optimizer.state_dict(),
+        'extras': extra_data,
+    }
+
+    if filepath is None:
+        if mode == 'checkpoint': filepath = f'./Checkpoints/checkpoint_lr_{lr}_fold_{fold}_epoch_{epoch}.pth'
+        elif mode == 'last state': filepath = './Checkpoints/last_state.pth'
+
+    with atomic_path(filepath) as temporary_path:
+        torch.save(checkpoint, temporary_path)
+
+
+def load_checkpoint(model, optimizer, filepath, device='cpu'):
+    checkpoint = torch.load(filepath, map_location=torch.device(device))
+    model.load_state_dict(checkpoint['model_state_dict'])
+    optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+    lr = checkpoint['lr']
+    fold = checkpoint['fold']
+    epoch = checkpoint['epoch']
+    extra_data = checkpoint['extras']
+
+    return model, optimizer, lr, fold, epoch, extra_data
+
+
+# a (batch, frames, features) batch as the model's (batch, 1, frames, features) float32 input on device
+def prepare_inputs(inputs, device='cpu', channels_last=False):
+    if inputs.dim() == 3: inputs = inputs.unsqueeze(1)
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    return inputs.to(device, dtype=torch.float32, non_blocking=True, memory_format=memory_format)
+
+
+# a batch of a loader as (model inputs, labels) on device: (features, labels) batches give the features
+# alone, the (features, labels, valid frames) ones of PackedFeatureDataset(variable_length=True) give
+# (features, valid frames), for a model that leaves out the padding (Lib.models.PooledCNNModel)
+def prepare_batch(batch, device='cpu', channels_last=False):
+    inputs = [prepare_inputs(batch[0], device, channels_last)] + [extra.to(device, non_blocking=True) for extra in batch[2:]]
+    return inputs, batch[1].to(device, non_blocking=True)
+
+
+def autocast(device, precision):
+    return torch.autocast(device_type=torch.device(device).type, dtype=precisions[precision],
+                          enabled=precisions[precision] is not None)
+
+
+# DataLoader of whole batches of a PackedFeatureDataset: batches is a sampler of lists of indices
+# (torch's BatchSampler, Lib.bucketing.BucketBatchSampler), every batch is read from the memory map at once
+# and comes out as a single float32 tensor, without being split into samples and stacked again by the
+# default collate. With workers, the batches are read by that many processes kept for the whole training,
+# prefetch_factor batches ahead each, and pinned when training on a GPU so the copy to it doesn't block
+def make_loader(dataset, batches, workers=0, prefetch_factor=2, device='cpu'):
+    options = {'num_workers': workers, 'pin_memory': torch.device(device).type == 'cuda'}
+    if workers > 0: options.update(persistent_workers=True, prefetch_factor=prefetch_factor)
+    return DataLoader(dataset, sampler=batches, batch_size=None, **options)
+
+
+# one pass over train_loader, returns the average loss and the training accuracy. stats, if given, gets the
+# number of samples and the seconds the epoch took
+def train_one_epoch(model, optimizer, criterion, train_loader, device='cpu', precision='fp32', channels_last=False, stats=None):
+    model.train()
+    running_loss = 0.0
+    total_correct_train = 0
+    total_samples_train = 0
+    start_time = time.perf_counter()
+
+    for batch in train_loader:
+        inputs, labels = prepare_batch(batch, device, channels_last)
+        optimizer.zero_grad()
+
+        with autocast(device, precision):
+            outputs = model(*inputs)
+            loss = criterion(outputs, labels)
+        _, predicted = torch.max(outputs, 1)
+
+        loss.backward()
+        optimizer.step()
+
+        total_correct_train += (predicted == labels).sum().item()
+        total_samples_train += labels.size(0)
+        running_loss += loss.item()
+
+    if stats is not None: stats.update(samples=total_samples_train, seconds=time.perf_counter() - start_time)
+    return running_loss / len(train_loader), total_correct_train / total_samples_train
+
+
+# accuracy on the validation dataset
+def evaluate(model, val_loader, device='cpu', precision='fp32', channels_last=False):
+    model.eval()
+    total_correct_val = 0
+    total_samples_val = 0
+
+    with torch.no_grad():
+        for batch in val_loader:
+            audios, labels = prepare_batch(batch, device, channels_last)
+
+            with autocast(device, precision):
+                outputs = model(*audios)
+            _, predicted = torch.max(outputs, 1)
+
+            total_correct_val += (predicted == labels).sum().item()
+            total_samples_val += labels.size(0)
+
+    return total_correct_val / total_samples_val
+
+
+# trains for num_epochs epochs, checkpointing (save_checkpoint) to checkpoint_path after every epoch and
+# resuming from it if it exists. Returns the histories of the loss, the accuracies and the samples per second
+# of every epoch. on_epoch_end(epoch, model, optimizer, histories) runs after every epoch's checkpoint
+def fit(model, optimizer, criterion, train_loader, val_loader, num_epochs, lr=None, fold=None, checkpoint_path=None,
+        device='cpu', precision='fp32', channels_last=False, log_prefix='', on_epoch_end=None):
+    model.to(device)
+    if channels_last: model.to(memory_format=torch.channels_last)
+
+    histories = {'loss history': [], 'train accuracy history': [], 'val accuracy history': [], 'samples per second history': []}
+    first_epoch = 0
+    if checkpoint_path is not None and os.path.isfile(checkpoint_path):
+        model, optimizer, _, _, last_epoch, histories = load_checkpoint(model, optimizer, checkpoint_path, device)
+        histories.setdefault('samples per second history', [])     # checkpoints from before it was recorded
+        first_epoch = last_epoch + 1
+
+    # samplers that change from one epoch to the next (Lib.bucketing.BucketBatchSampler) go on from there
+    if hasattr(train_loader.sampler, 'set_epoch'): train_loader.sampler.set_epoch(first_epoch)
+
+    for epoch in range(first_epoch, num_epochs):
+        start_time = time.perf_counter()
+        stats = {}
+        epoch_loss, accuracy_train = train_one_epoch(model, optimizer, criterion, train_loader, device, precision, channels_last, stats)
+        accuracy_val = evaluate(model, val_loader, device, precision, channels_last)
+        samples_per_second = stats['samples'] / stats['seconds']
+
+        histories['loss history'].append(epoch_loss)
+        histories['train accuracy history'].append(accuracy_train)
+        histories['val accuracy history'].append(accuracy_val)
+        histories['samples per second history'].append(samples_per_second)
+
+        if checkpoint_path is not None:
+            save_checkpoint(lr, fold, epoch, model, optimizer, extra_data=histories, filepath=checkpoint_path)
+        print(f'{log_prefix}Epoch [{epoch + 1}/{num_epochs}], Loss: {epoch_loss:.4f}, '
+              f'Training Accuracy: {accuracy_train * 100:.2f}%, Validation Accuracy: {accuracy_val * 100:.2f}% '
+              f'({samples_per_second:.0f} samples/s, {time.perf_counter() - start_time:.1f}s)', flush=True)
+        if on_epoch_end is not None: on_epoch_end(epoch, model, optimizer, histories)
+
+    return histories
@@ -1,17 +1,24 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context, g
+from werkzeug.exceptions import RequestEntityTooLarge
 from flask_cors import CORS
 import os
-from tempfile import NamedTemporaryFile
-from pydub import AudioSegment
-from pydub.silence import split_on_silence
-import librosa
-import soundfile as sf
-import numpy as np
+import asyncio
+import threading
+import time
+import zipfile
+from concurrent.futures import Future
 from io import BytesIO
+import numpy as np
 import torch
-import torch.optim as optim
-from torch import FloatTensor
-from model import CNNModel
+from backends import load_backend, artifact_path
+from batching import MicroBatcher
+from audio import bytes_to_mfcc, synthetic_clip
+from feature_pool import FeaturePool, Overloaded, TooLong
+from batch_scoring import score, jsonl_line, csv_line, csv_header
+from result_cache import ResultCache, model_version
+from streaming import predict_timeline, hop_samples, min_hop_s
+from metrics import Metrics, stage
+from profiler import Profiler
 
 app = Flask(__name__)
 CORS(app, resources={r"/predict": {"origins": "http://localhost:3000"}})
@@ -19,133 +26,303 @@ CORS(app, resources={r"/predict": {"origins": "http://localhost:3000"}})
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 # Set up model
-model_path = model_path = os.path.join('api', 'ModelWeights', 'trained_model.pth') # to edit
-model = CNNModel(num_classes=8).to(device)
-model.load_state_dict(torch.load(model_path, map_location=torch.device(device)))
-
+# INFERENCE_BACKEND picks how the model runs (see backends.py): 'eager' (trained_model.pth), 'torchscript'
+# (trained_model.pt), 'onnx' (trained_model.onnx, ONNX Runtime), both from export_model.py, or 'quantized'
+# (trained_model_int8.pt, from quantize_model.py)
+model_dir = os.path.join('api', 'ModelWeights') # to edit
+inference_backend = os.environ.get('INFERENCE_BACKEND', 'eager')
+# loaded when app is imported, on purpose: gunicorn imports it once in its master (preload_app, see
+# gunicorn.conf.py) and forks the workers from there, so they all share the pages of the weights instead of
+# each loading a copy (ONNX Runtime sessions don't survive a fork, init_worker loads those again). It costs
+# ~20ms (torchscript) to ~100ms (onnx) on one core, next to ~2.4s for importing torch
+model = load_backend(inference_backend, model_dir, device=device)
+
+# Concurrent requests are grouped into one forward pass (see batching.py)
+max_batch_size = 16         # most requests run together in a single forward pass
+max_batch_wait_ms = 8       # longest time the first request of a batch waits for others to join
+batcher = MicroBatcher(model, device, max_batch_size=max_batch_size, max_wait_ms=max_batch_wait_ms)
+
+# Request counts and latencies and the time spent in every stage of /predict, on GET /metrics in the
+# Prometheus format (see metrics.py). METRICS_DIR adds up the metrics of every server worker
+metrics = Metrics(directory=os.environ.get('METRICS_DIR'))
+metrics.register('emotion_batch_size', 'Requests per forward pass of the micro-batcher', batcher.batch_size_histogram)
+metrics.register('emotion_batch_queue_ms', 'Time requests wait for their batch, in ms', batcher.queue_latency_histogram)
+metrics.register('emotion_batch_forward_ms', 'Forward pass time per batch, in ms', batcher.forward_latency_histogram)
+
+# Sampling profiler, off unless PROFILE_DIR is set (see profiler.py): the stacks of a fraction of the
+# /predict requests (and of the ones sent with X-Profile: <PROFILE_TOKEN>) are written there as flame graph input
+profiler = Profiler(directory=os.environ.get('PROFILE_DIR'), sample_rate=float(os.environ.get('PROFILE_SAMPLE_RATE', 0.01)),
+                    interval_ms=float(os.environ.get('PROFILE_INTERVAL_MS', 5)), token=os.environ.get('PROFILE_TOKEN'),
+                    max_file_mb=float(os.environ.get('PROFILE_MAX_FILE_MB', 50)))
+
+# Uploads to /predict are decoded and turned into MFCCs by a pool of processes (see feature_pool.py), so
+# the request threads only wait. Limits, checked before anything is decoded (the size while the upload is
+# read, see limit_upload, and the duration by the pool's processes):
+feature_workers = int(os.environ.get('FEATURE_WORKERS', 2))   # processes decoding uploads (under gunicorn, sized in gunicorn.conf.py)
+max_pending_uploads = 32        # uploads queued or being decoded at once, more are turned away with a 429
+max_upload_mb = 25              # larger uploads are turned away with a 413
+max_upload_seconds = 120        # so are longer recordings (use /predict/stream for those)
+max_stream_upload_mb = 200      # /predict/stream takes recordings of any length, up to ~20 min of 16-bit 44.1kHz stereo wav
+request_timeout_s = 30          # decoding + prediction, after that the request fails with a 504
+feature_pool = FeaturePool(workers=feature_workers, max_pending=max_pending_uploads, max_seconds=max_upload_seconds,
+                           metrics=metrics, profiler=profiler)
+
+# /predict/batch shares the feature pool: a batch request keeps at most half of the pool's queue busy (so
+# /predict requests still get in), and its total upload is limited too
+max_batch_upload_mb = 500
+max_batch_expanded_mb = 2000    # uncompressed, the files in zips included
+batch_in_flight = max_pending_uploads // 2
+
+# Results of /predict are cached by upload contents and model version (see result_cache.py), a clip that
+# was already scored is answered without being decoded again. RESULT_CACHE_DIR adds a disk tier, shared by
+# every worker and kept across restarts
+result_cache_entries = 10000    # in memory, least recently used ones are evicted first
+result_cache_ttl_s = 24 * 3600
+result_cache_disk_entries = 100000    # on disk (a ~200 byte file each), the oldest ones are pruned first
+result_cache = ResultCache(f'{inference_backend}:{model_version(artifact_path(inference_backend, model_dir))}',
+                           max_entries=result_cache_entries, ttl_s=result_cache_ttl_s,
+                           disk_dir=os.environ.get('RESULT_CACHE_DIR'), max_disk_entries=result_cache_disk_entries)
+
+# set by warm_up, /ready answers 503 until then
+ready = False
+
+
+# runs a synthetic clip through the whole pipeline (decoding, silence removal, resampling, MFCCs) and the
+# model at every batch size up to max_batch_size, so the first real requests don't pay for lazy
+# initialization (imports, thread pools, allocator caches), and starts the feature pool. run_model=False
+# only warms up the audio part (what the server master does before forking, it never runs the model).
+# The feature pool's processes start (and warm up) in the background meanwhile, it is most of the warm up
+def warm_up(run_model=True):
+    global ready
+    if run_model:
+        pool_start = threading.Thread(target=feature_pool.start, name='feature-pool-start')
+        pool_start.start()
+    mfccs = bytes_to_mfcc(synthetic_clip())
+    if not run_model:
+        return
+
+    batch_size = 1
+    while batch_size <= max_batch_size:
+        model(torch.from_numpy(np.stack([mfccs] * batch_size)).unsqueeze(1))
+        batch_size *= 2
+    pool_start.join()
+    feature_pool.submit(synthetic_clip()).result()
+    ready = True
+
+
+# per process setup of a server worker (see gunicorn.conf.py): torch thread limits, then the warm up. The
+# weights were loaded once by the master before the fork and are shared with it, except for ONNX Runtime,
+# whose thread pool doesn't survive a fork, so its session is opened again in every worker.
+def init_worker(threads):
+    global model
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass    # can only be set before torch starts any parallel work
+    if inference_backend == 'onnx':
+        model = load_backend(inference_backend, model_dir, device=device, threads=threads)
+        batcher.model = model
+    warm_up()
+
+# decoding and MFCCs in the feature pool, then the prediction (the batcher runs this request's mfccs
+# together with any other waiting requests). Cancelling it takes the upload out of the pool's queue and the
+# mfccs out of the batcher's. The time waiting for the batcher goes into timings, and with profile the
+# stacks of the pool process and of the batcher thread are sampled
+async def classify(audio_bytes, timings, profile=False):
+    mfccs = await asyncio.wrap_future(feature_pool.submit(audio_bytes, profile))
+
+    sampler = profiler.sampler([batcher.worker_thread_id()]) if profile else None
+    try:
+        with stage(timings, 'predict', mfccs.nbytes):
+            return await asyncio.wrap_future(batcher.submit(mfccs))
+    finally:
+        if sampler is not None: profiler.write('model', sampler.stop())
+
+# every request's endpoint, status code and duration, for /metrics
+@app.before_request
+def start_timer():
+    g.started_at = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unknown'
+    metrics.record_request(endpoint, response.status_code, time.perf_counter() - g.started_at)
+    return response
+
+# every upload endpoint limits its request body to its own size before reading it. The limit applies to
+# the bytes actually read, so a chunked upload (no Content-Length) over it is cut off too, with a 413
+def limit_upload(mb):
+    request.max_content_length = int(mb * 1e6)
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(error):
+    return jsonify({'error': f'uploads are limited to {request.max_content_length / 1e6:g} MB'}), 413
+
+# async view (needs flask[async]): the request only waits on the feature pool and the batcher
 @app.route('/predict', methods=['POST'])
-def predict():
-    audio_file = request.files['file']
-
-    # Process the audio_file (convert to wav, remove silence, resample, normalize)
-    mfccs = convert_to_mfcc(audio_file)
-
-    # Prediction
-    model.eval()
-    with torch.no_grad():
-        my_input = FloatTensor(mfccs).unsqueeze(0).unsqueeze(0) # convert numpy array into tensor
-        my_input = my_input.to(device)
-        outputs = model(my_input)
-        pred_accuracy, predicted = torch.max(outputs, 1)
-        confidence_scores = outputs.softmax(dim=1).squeeze()
+async def predict():
+    limit_upload(max_upload_mb)
+    audio_bytes = request.files['file'].read()
+
+    cache_key = result_cache.key(audio_bytes)
+    output = result_cache.get(cache_key)
+    if output is None:
+        timings = []
+        profile = profiler.should_profile(request.headers.get('X-Profile'))
+        try:
+            output = (await asyncio.wait_for(classify(audio_bytes, timings, profile), request_timeout_s)).tolist()
+        except Overloaded:
+            return jsonify({'error': 'too many requests, try again later'}), 429, {'Retry-After': '1'}
+        except TooLong as error:
+            return jsonify({'error': str(error)}), 413
+        except asyncio.TimeoutError:
+            return jsonify({'error': f'the prediction took longer than {request_timeout_s} s'}), 504
+        result_cache.put(cache_key, output)
+        metrics.record_stages(timings)
+
+    outputs = torch.tensor([output])
+
+    pred_accuracy, predicted = torch.max(outputs, 1)
+    confidence_scores = outputs.softmax(dim=1).squeeze()
 
     return jsonify({'prediction': predicted.item(), 
                     'prediction accuracy':  float(round(confidence_scores[predicted.item()].item(), 2)), 
                     'confidence': outputs.softmax(dim=1).squeeze().tolist(), 
                     'emotions': ['neutral', 'calm', 'happy', 'sad', 'angry', 'fearful', 'disgust', 'surprised']})
 
-# function to remove silence from audio
-def remove_silence(input_path, output_path, min_silence_length_ms=300, silence_threshold=-50):
-    audio = AudioSegment.from_file(input_path)
-    chunks = split_on_silence(audio, min_silence_len = min_silence_length_ms, silence_thresh=silence_threshold)
-    output = AudioSegment.empty()
-
-    for chunk in chunks:    # reassemble non-silent segments
-        output += chunk
-
-    output.export(output_path, format="wav")
-    return output 
-
-
-# REMOVE THIS MAYBE!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-# function to repeat audio file until it has length of at least min_target_length
-def repeat_audio(audio, sr=24000, min_target_length=4):
-    length_s = len(audio)/float(sr)
-
-    if length_s < min_target_length:
-        n = np.ceil(min_target_length*sr/len(audio))
-        audio = np.tile(audio,int(n))
-    
-    return audio
-  
-        
-# function to normalize and resamples every file into a specific sample rate (sr)
-def resample_data(file_path, target_sr):
-    audio, sr = librosa.load(file_path)
-    audio_resampled = librosa.resample(audio, orig_sr=sr, target_sr=target_sr)
-    audio_normalized = (audio_resampled - np.mean(audio_resampled)) / np.std(audio_resampled)
-    return audio_normalized
-
-
-def normalize_data(audio_file):
-    audio_normalized = (audio_file - np.mean(audio_file)) / np.std(audio_file)
-    return audio_normalized
- 
-
-def pad_audio(audio, sr, desired_length_in_sec):
-    # audio is the raw audio signal as numpy array from librosa
-    desired_length = int(sr * desired_length_in_sec)
-
-    # Truncate if too long
-    if len(audio) > desired_length:
-        audio = audio[:desired_length]
-        # TODO: Check for silent parts before cropping the audio file
-
-    # Else, pad with 0s
-    else:
-        padding = int(desired_length - len(audio))
-        audio = np.pad(audio, (0, padding), 'constant')
-    return audio
-
-
-# extract MFCCs from the audio files
-def extract_mfccs(file_path=None, audio=None, n_mfcc=13):
-    
-    # Checks if the input has been a file path or a file
-    if (file_path!=None): audio, sr = librosa.load(file_path, sr=None)
-    else: sr = 24000
-        
-    audio = pad_audio(audio, sr, 2.0)        # 2s audio inputs
-
-    mfcc = librosa.feature.mfcc(y=audio, sr=sr, n_mfcc=n_mfcc)
-    delta_mfcc  = librosa.feature.delta(mfcc)
-    delta2_mfcc = librosa.feature.delta(mfcc, order=2)
-
-    # Stacking mfcc and deltas together
-    combined_matrix = np.vstack([mfcc, delta_mfcc, delta2_mfcc])
-
-    # Normalize mfccs
-    combined_matrix = (combined_matrix - np.mean(combined_matrix, axis=0)) / np.std(combined_matrix, axis=0)
-
-    # We transpose so that the ROWS correspond to the frames of the audio, while COLUMNS represent features
-    transposed_matrix = np.transpose(combined_matrix, [1, 0])
-    return transposed_matrix
-
-
-def convert_to_mfcc(audio_file):
-    target_sampling_rate = 24000
-
-    audio_data = BytesIO(audio_file.read())
-    audio_segment = AudioSegment.from_file_using_temporary_files(audio_data)
-
-    # Export AudioSegment to WAV format
-    with NamedTemporaryFile(suffix=".wav", delete=False) as temp_wav_file:
-        wav_filename = temp_wav_file.name
-        audio_segment.export(wav_filename, format="wav") 
-
-    no_silence_path = f'{wav_filename}_no_sil'
-    no_silence_audio = remove_silence(wav_filename, no_silence_path, min_silence_length_ms=300, silence_threshold=-50)
-    resampled_audio = resample_data(no_silence_path, target_sr=target_sampling_rate)
-    normalized_audio = normalize_data(resampled_audio)
-    
-    mfccs = extract_mfccs(audio=normalized_audio)
-
-    # Delete the temporary WAV file
-    os.remove(wav_filename)
-    os.remove(no_silence_path)
-
-    return mfccs
-
-
+# emotion timeline of a whole recording of any length: a 2s window every `hop` seconds (query parameter, 1s by
+# default, at least streaming.min_hop_s). A stream holds one of the feature pool's places while it runs, so
+# streams and /predict uploads share the same admission control
+@app.route('/predict/stream', methods=['POST'])
+def predict_stream():
+    limit_upload(max_stream_upload_mb)
+    audio_file = request.files['file']
+    try:
+        hop_s = float(request.args.get('hop', 1.0))
+        hop_samples(hop_s)
+    except ValueError:
+        return jsonify({'error': f'hop must be a number of seconds, at least {min_hop_s}'}), 400
+
+    try:
+        with feature_pool.reserved():
+            result = predict_timeline(model, device, audio_file.stream, hop_s=hop_s)
+    except Overloaded:
+        return jsonify({'error': 'too many requests, try again later'}), 429, {'Retry-After': '1'}
+    result['emotions'] = ['neutral', 'calm', 'happy', 'sad', 'angry', 'fearful', 'disgust', 'surprised']
+    return jsonify(result)
+
+def failed_future(error):
+    future = Future()
+    future.set_exception(error)
+    return future
+
+# feature pool future of one file of a batch (its bytes, or the error batch_items read it with). Files over
+# the /predict limits fail on their own instead of the whole batch (the pool fails the long ones), and a full
+# pool makes the batch wait instead of failing, for up to request_timeout_s
+def submit_batch_file(item):
+    if isinstance(item, Exception):
+        return failed_future(item)
+    deadline = time.monotonic() + request_timeout_s
+    while True:
+        try:
+            return feature_pool.submit(item)
+        except Overloaded:
+            if time.monotonic() > deadline:
+                return failed_future(Overloaded(f'the feature pool stayed full for {request_timeout_s} s'))
+            time.sleep(0.05)
+
+# the bytes of one file of a batch, read with read(n) (n bytes at most), or the error it fails with: files
+# over max_upload_mb (size is the one the zip's directory gives, checked before anything is read), and every
+# file once the batch has read max_batch_expanded_mb. At most max_upload_mb are ever read, so a zip bomb
+# never expands in memory
+def read_batch_file(read, size, expanded):
+    limit = int(max_upload_mb * 1e6)
+    if expanded >= max_batch_expanded_mb * 1e6:
+        return ValueError(f'batches are limited to {max_batch_expanded_mb} MB of recordings in total')
+    if size is not None and size > limit:
+        return ValueError(f'uploads are limited to {max_upload_mb} MB')
+    try:
+        audio_bytes = read(limit + 1)
+    except Exception as error:      # e.g. a damaged or encrypted zip member
+        return error
+    if len(audio_bytes) > limit:
+        return ValueError(f'uploads are limited to {max_upload_mb} MB')
+    return audio_bytes
+
+# the (name, bytes or error) of every uploaded file, or of every file in an uploaded zip (see read_batch_file).
+# uploads are (name, stream) pairs, every stream is closed once it has been read
+def batch_items(uploads):
+    expanded = 0
+    for name, stream in uploads:
+        with stream:
+            if zipfile.is_zipfile(stream):
+                stream.seek(0)
+                with zipfile.ZipFile(stream) as archive:
+                    for info in archive.infolist():
+                        if info.is_dir(): continue
+
+                        def read_member(n):
+                            with archive.open(info) as member:
+                                return member.read(n)
+                        item = read_batch_file(read_member, info.file_size, expanded)
+                        if isinstance(item, bytes): expanded += len(item)
+                        yield f'{name}/{info.filename}', item
+            else:
+                stream.seek(0)
+                item = read_batch_file(stream.read, None, expanded)
+                if isinstance(item, bytes): expanded += len(item)
+                yield name, item
+
+# scores many recordings in one request: several 'file' fields, or zip files of recordings. The results are
+# streamed back as the files finish, as JSON Lines (one /predict response per file, with its name as 'path')
+# or as CSV with ?format=csv
+@app.route('/predict/batch', methods=['POST'])
+def predict_batch():
+    limit_upload(max_batch_upload_mb)
+    files = request.files.getlist('file')
+    if not files:
+        return jsonify({'error': "no 'file' in the upload"}), 400
+    output_format = request.args.get('format', 'jsonl')
+
+    # the request closes its uploaded files when this returns, before the response is streamed, so their
+    # streams are taken out of it (batch_items closes them)
+    uploads = []
+    for uploaded in files:
+        uploads.append((uploaded.filename, uploaded.stream))
+        uploaded.stream = BytesIO()
+
+    results = score(batch_items(uploads), model, submit_batch_file, batch_size=batch_in_flight, max_in_flight=batch_in_flight)
+    if output_format == 'csv':
+        def lines():
+            yield csv_header()
+            for row in results:
+                yield csv_line(row)
+        return Response(stream_with_context(lines()), mimetype='text/csv')
+    return Response(stream_with_context(jsonl_line(row) for row in results), mimetype='application/x-ndjson')
+
+# readiness probe: 200 once this process has warmed up, 503 before
+@app.route('/ready', methods=['GET'])
+def readiness():
+    status = {'ready': ready, 'backend': inference_backend, 'pid': os.getpid(), 'threads': torch.get_num_threads()}
+    return jsonify(status), 200 if ready else 503
+
+# batch size and latency histograms of the micro-batcher (used to tune max_batch_size and max_batch_wait_ms),
+# the feature pool queue, the result cache hits and misses and the profiler
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({'backend': inference_backend, 'feature pool': feature_pool.stats(), 'result cache': result_cache.stats(),
+                    'profiler': profiler.stats(), **batcher.stats()})
+
+# Prometheus metrics: requests, per stage latency and bytes histograms, micro-batcher histograms
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# development server, for production use the pre-fork server: gunicorn -c api/gunicorn.conf.py
+# The debug reloader runs this file twice, in the process watching the files and in the one serving: only
+# the latter warms up, in the background, so the server answers right away (/ready says when it's warm)
 if __name__ == '__main__':
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
     app.run(debug=True)
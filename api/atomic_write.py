@@ -0,0 +1,25 @@
+import os
+import threading
+from contextlib import contextmanager
+
+# Same as Lib.atomic_write (the API doesn't import Lib): the files the API writes for other processes to
+# read (exported models, cached results, metrics snapshots) are written under a temporary name next to
+# their destination and renamed over it once complete. os.replace is atomic, so a reader (another worker,
+# /metrics, the next start of the API) only ever sees the previous file or the new one, never a half
+# written one.
+
+
+# yields the temporary path to write to, and renames it to path once the block finishes. The temporary
+# name is unique to the process and thread, so concurrent writers of the same path never write into each
+# other's file. If the block raises, the temporary file is removed and path is untouched
+@contextmanager
+def atomic_path(path):
+    directory = os.path.dirname(path)
+    if directory: os.makedirs(directory, exist_ok=True)
+    temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        yield temporary_path
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path): os.remove(temporary_path)
+        raise
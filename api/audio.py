@@ -0,0 +1,264 @@
+import os
+import subprocess
+from io import BytesIO
+from pydub import AudioSegment
+from pydub.silence import split_on_silence
+import librosa
+import numpy as np
+import soundfile as sf
+
+from metrics import stage
+
+# numba compiles librosa's jitted functions (resampling, MFCCs) the first time they run, ~30s, and caches
+# them on disk: next to librosa's sources, or in the user's home where those aren't writable. In a container
+# both are usually read-only or thrown away with it, so every new container compiled them again before its
+# first request. The cache is kept in .numba_cache at the root of the repository instead (NUMBA_CACHE_DIR
+# overrides it), which python api/check_startup.py fills, e.g. when the image is built. librosa only
+# imports numba on first use, so this still applies after `import librosa`
+os.environ.setdefault('NUMBA_CACHE_DIR', os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.numba_cache')))
+
+# global target sampling rate (same as Lib.target_sampling_rate, the model was trained on 24kHz audio)
+target_sampling_rate = 24000
+
+# librosa.load's default sampling rate. Every training clip was loaded at this rate before being resampled
+# to 24kHz (see Lib.resample_data), so the model has never seen anything above 11.025kHz
+training_load_sampling_rate = 22050
+
+# numpy sample types for pydub's sample widths (pydub stores 8-bit audio as signed and 24-bit audio as 32-bit)
+sample_types = {1: np.int8, 2: np.int16, 4: np.int32}
+
+# function to remove silence from audio
+def remove_silence(input_path, output_path, min_silence_length_ms=300, silence_threshold=-50):
+    audio = AudioSegment.from_file(input_path)
+    chunks = split_on_silence(audio, min_silence_len = min_silence_length_ms, silence_thresh=silence_threshold)
+    output = AudioSegment.empty()
+
+    for chunk in chunks:    # reassemble non-silent segments
+        output += chunk
+
+    output.export(output_path, format="wav")
+    return output
+
+
+# REMOVE THIS MAYBE!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+# function to repeat audio file until it has length of at least min_target_length
+def repeat_audio(audio, sr=24000, min_target_length=4):
+    length_s = len(audio)/float(sr)
+
+    if length_s < min_target_length:
+        n = np.ceil(min_target_length*sr/len(audio))
+        audio = np.tile(audio,int(n))
+
+    return audio
+
+
+# function to normalize and resamples every file into a specific sample rate (sr)
+def resample_data(file_path, target_sr):
+    audio, sr = librosa.load(file_path)
+    audio_resampled = librosa.resample(audio, orig_sr=sr, target_sr=target_sr)
+    audio_normalized = (audio_resampled - np.mean(audio_resampled)) / np.std(audio_resampled)
+    return audio_normalized
+
+
+def normalize_data(audio_file):
+    audio_normalized = (audio_file - np.mean(audio_file)) / np.std(audio_file)
+    return audio_normalized
+
+
+def pad_audio(audio, sr, desired_length_in_sec):
+    # audio is the raw audio signal as numpy array from librosa
+    desired_length = int(sr * desired_length_in_sec)
+
+    # Truncate if too long
+    if len(audio) > desired_length:
+        audio = audio[:desired_length]
+        # TODO: Check for silent parts before cropping the audio file
+
+    # Else, pad with 0s
+    else:
+        padding = int(desired_length - len(audio))
+        audio = np.pad(audio, (0, padding), 'constant')
+    return audio
+
+
+# extract MFCCs from the audio files
+def extract_mfccs(file_path=None, audio=None, n_mfcc=13):
+
+    # Checks if the input has been a file path or a file
+    if (file_path!=None): audio, sr = librosa.load(file_path, sr=None)
+    else: sr = 24000
+
+    audio = pad_audio(audio, sr, 2.0)        # 2s audio inputs
+
+    mfcc = librosa.feature.mfcc(y=audio, sr=sr, n_mfcc=n_mfcc)
+    delta_mfcc  = librosa.feature.delta(mfcc)
+    delta2_mfcc = librosa.feature.delta(mfcc, order=2)
+
+    # Stacking mfcc and deltas together
+    combined_matrix = np.vstack([mfcc, delta_mfcc, delta2_mfcc])
+
+    # Normalize mfccs
+    combined_matrix = (combined_matrix - np.mean(combined_matrix, axis=0)) / np.std(combined_matrix, axis=0)
+
+    # We transpose so that the ROWS correspond to the frames of the audio, while COLUMNS represent features
+    transposed_matrix = np.transpose(combined_matrix, [1, 0])
+    return transposed_matrix
+
+
+# The following functions keep the whole upload in memory: it is decoded once, the silence is removed
+# from the decoded samples, and the result is resampled without reading anything back from disk
+
+# decodes the uploaded bytes into an AudioSegment without writing them to disk
+# (wav files are read directly, anything else is piped through ffmpeg)
+def decode_audio(audio_bytes):
+    audio_format = 'wav' if audio_bytes[:4] == b'RIFF' and audio_bytes[8:12] == b'WAVE' else None
+    return AudioSegment.from_file(BytesIO(audio_bytes), format=audio_format)
+
+
+# returns the decoded samples of an AudioSegment as an integer array of shape (frames, channels)
+def segment_to_samples(audio_segment):
+    samples = np.frombuffer(audio_segment.raw_data, dtype=sample_types[audio_segment.sample_width])
+    return samples.reshape(-1, audio_segment.channels)
+
+
+# converts integer samples into a mono float32 array in [-1, 1] (the same values librosa.load would give)
+def samples_to_array(samples, max_possible_amplitude):
+    return samples.mean(axis=1, dtype=np.float32) / np.float32(max_possible_amplitude)
+
+
+# Vectorized version of pydub's split_on_silence followed by joining the chunks back together.
+# pydub measures the rms of a min_silence_length_ms window starting at every millisecond in a python loop
+# and then adds the chunks to the output one at a time; here the sums of squares of all the windows come
+# from a single cumulative sum and the chunks are copied into one preallocated array, so the whole thing
+# is linear in the length of the audio. Window positions, rms rounding and the keep_silence_ms of silence
+# left around every chunk all follow pydub, so the output is the same sample for sample.
+
+# returns the [start, end] milliseconds of every non-silent part, like pydub's detect_nonsilent
+def detect_nonsilent(samples, sr, max_possible_amplitude, min_silence_length_ms=300, silence_threshold=-50):
+    frame_count, channels = samples.shape
+    length_ms = round(1000 * (frame_count / sr))
+    ms_to_frames = sr / 1000.0
+
+    # you can't have a silent portion of a sound that is longer than the sound
+    if length_ms < min_silence_length_ms:
+        return np.array([[0, length_ms]])
+
+    # sums of squares of every window (exact integers for 8 and 16 bit audio)
+    squares_type = np.int64 if samples.itemsize <= 2 else np.float64
+    cumulative_squares = np.zeros(frame_count + 1, dtype=squares_type)
+    np.cumsum(np.square(samples, dtype=squares_type).sum(axis=1), out=cumulative_squares[1:])
+
+    window_starts = np.arange(length_ms - min_silence_length_ms + 1)
+    start_frames = (window_starts * ms_to_frames).astype(np.int64)
+    end_frames = ((window_starts + min_silence_length_ms) * ms_to_frames).astype(np.int64)
+
+    # pydub pads a window running past the end with silence, so the padding still counts in the mean
+    window_sums = cumulative_squares[np.minimum(end_frames, frame_count)] - cumulative_squares[start_frames]
+    window_rms = np.floor(np.sqrt(window_sums / ((end_frames - start_frames) * channels)))
+
+    silence_threshold = 10 ** (silence_threshold / 20) * max_possible_amplitude
+    silence_starts = np.flatnonzero(window_rms <= silence_threshold)
+
+    if len(silence_starts) == 0:
+        return np.array([[0, length_ms]])
+
+    # silent windows are combined into one range unless the gap between them is longer than a window
+    gaps = np.flatnonzero(np.diff(silence_starts) > min_silence_length_ms)
+    silent_starts = silence_starts[np.concatenate([[0], gaps + 1])]
+    silent_ends = silence_starts[np.concatenate([gaps, [-1]])] + min_silence_length_ms
+
+    # the whole audio is silent
+    if silent_starts[0] == 0 and silent_ends[0] == length_ms:
+        return np.zeros((0, 2), dtype=np.int64)
+
+    nonsilent_ranges = np.stack([np.concatenate([[0], silent_ends[:-1]]), silent_starts], axis=1)
+    if silent_ends[-1] != length_ms:
+        nonsilent_ranges = np.concatenate([nonsilent_ranges, [[silent_ends[-1], length_ms]]])
+    if nonsilent_ranges[0, 0] == 0 and nonsilent_ranges[0, 1] == 0:
+        nonsilent_ranges = nonsilent_ranges[1:]
+    return nonsilent_ranges
+
+
+# removes the silence from integer samples of shape (frames, channels), the same way remove_silence does
+def remove_silence_from_samples(samples, sr, max_possible_amplitude, min_silence_length_ms=300, silence_threshold=-50, keep_silence_ms=100):
+    frame_count = len(samples)
+    length_ms = round(1000 * (frame_count / sr))
+    ms_to_frames = sr / 1000.0
+
+    ranges = detect_nonsilent(samples, sr, max_possible_amplitude, min_silence_length_ms, silence_threshold)
+    starts = ranges[:, 0] - keep_silence_ms
+    ends = ranges[:, 1] + keep_silence_ms
+
+    # when two chunks would overlap, the silence between them is split evenly
+    overlapping = np.flatnonzero(starts[1:] < ends[:-1])
+    middles = (ends[overlapping] + starts[overlapping + 1]) // 2
+    ends[overlapping] = middles
+    starts[overlapping + 1] = middles
+
+    start_frames = (np.clip(starts, 0, length_ms) * ms_to_frames).astype(np.int64)
+    end_frames = (np.clip(ends, 0, length_ms) * ms_to_frames).astype(np.int64)
+
+    # single output buffer, whatever is past the end of the audio is left as silence (like pydub does)
+    output = np.zeros((int(np.sum(end_frames - start_frames)), samples.shape[1]), dtype=samples.dtype)
+    position = 0
+    for start_frame, end_frame in zip(start_frames, end_frames):
+        chunk = samples[start_frame:end_frame]
+        output[position:position + len(chunk)] = chunk
+        position += end_frame - start_frame
+    return output
+
+
+# resamples to the target sampling rate, keeping the same bandwidth as the training data:
+# audio recorded above 22.05kHz still goes through 22.05kHz first (a single resampling filter changes the
+# highest mel bands enough to move the predictions), anything else is resampled once
+def resample_audio(audio, sr, target_sr=target_sampling_rate):
+    if sr > training_load_sampling_rate:
+        audio = librosa.resample(audio, orig_sr=sr, target_sr=training_load_sampling_rate)
+        sr = training_load_sampling_rate
+    return librosa.resample(audio, orig_sr=sr, target_sr=target_sr)
+
+
+# duration in seconds read from the header of the uploaded bytes, without decoding them (soundfile reads
+# wav, flac, ogg and mp3 headers, anything else is asked to ffprobe). None if it can't be found
+def probe_duration(audio_bytes):
+    try:
+        return sf.info(BytesIO(audio_bytes)).duration
+    except Exception:
+        pass
+    try:
+        result = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', '-i', 'pipe:0'],
+                                input=audio_bytes, capture_output=True, timeout=10)
+        return float(result.stdout)
+    except (OSError, ValueError, subprocess.TimeoutExpired):
+        return None
+
+
+# a 1s noise clip as wav bytes, to warm up the pipeline
+def synthetic_clip(length_s=1, sr=44100):
+    clip = BytesIO()
+    sf.write(clip, np.random.default_rng(0).uniform(-0.5, 0.5, int(length_s * sr)).astype(np.float32), sr, format='WAV')
+    return clip.getvalue()
+
+
+def convert_to_mfcc(audio_file):
+    return bytes_to_mfcc(audio_file.read())
+
+
+# timings, if given, gets the (stage, seconds, bytes) of every step (see metrics.py)
+def bytes_to_mfcc(audio_bytes, timings=None):
+    with stage(timings, 'decode', len(audio_bytes)):
+        audio_segment = decode_audio(audio_bytes)
+        samples = segment_to_samples(audio_segment)
+
+    with stage(timings, 'remove_silence', samples.nbytes):
+        samples = remove_silence_from_samples(samples, audio_segment.frame_rate, audio_segment.max_possible_amplitude,
+                                              min_silence_length_ms=300, silence_threshold=-50)
+        audio = samples_to_array(samples, audio_segment.max_possible_amplitude)
+
+    with stage(timings, 'resample_data', audio.nbytes):
+        resampled_audio = resample_audio(audio, audio_segment.frame_rate, target_sr=target_sampling_rate)
+        normalized_audio = normalize_data(resampled_audio)
+
+    with stage(timings, 'extract_mfccs', normalized_audio.nbytes):
+        mfccs = extract_mfccs(audio=normalized_audio)
+    return mfccs
@@ -0,0 +1,118 @@
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from model import CNNModel
+
+# Inference backends for the API. Every backend is called like the model itself: a (N, 1, frames, features)
+# float tensor in, the (N, num_classes) softmax output of CNNModel out, so the micro-batcher and the
+# streaming endpoint don't need to know which one is running:
+#
+#   eager        CNNModel loaded from trained_model.pth (what the API always ran)
+#   torchscript  trained_model.pt, the frozen TorchScript export of export_model.py
+#   onnx         trained_model.onnx run by ONNX Runtime on the CPU
+#   quantized    trained_model_int8.pt, the int8 TorchScript model of quantize_model.py (CPU only)
+#
+# The exports are made from the inference version of the network (see inference_model): the Dropout
+# layers are removed and the final Softmax is kept in the graph, so eager, torchscript and onnx give the
+# same probabilities (quantized gives approximately the same ones).
+
+backend_names = ['eager', 'torchscript', 'onnx', 'quantized']
+model_dir = os.path.join('api', 'ModelWeights')
+num_classes = 8
+input_shape = (1, 94, 39)       # 2s of 24kHz audio as a MFCC matrix
+
+
+def weights_path(directory=model_dir):
+    return os.path.join(directory, 'trained_model.pth')
+
+def torchscript_path(directory=model_dir):
+    return os.path.join(directory, 'trained_model.pt')
+
+def onnx_path(directory=model_dir):
+    return os.path.join(directory, 'trained_model.onnx')
+
+def quantized_path(directory=model_dir):
+    return os.path.join(directory, 'trained_model_int8.pt')
+
+
+# the file the backend called `name` is loaded from
+def artifact_path(name, directory=model_dir):
+    paths = {'eager': weights_path, 'torchscript': torchscript_path, 'onnx': onnx_path, 'quantized': quantized_path}
+    return paths[name](directory)
+
+
+def load_eager_model(path, device='cpu'):
+    model = CNNModel(num_classes=num_classes).to(device)
+    model.load_state_dict(torch.load(path, map_location=torch.device(device)))
+    model.eval()
+    return model
+
+
+# the same layers without the Dropouts (they do nothing in eval mode), softmax included
+def inference_model(model):
+    layers = [layer for layer in model.model if not isinstance(layer, nn.Dropout)]
+    return nn.Sequential(*layers).eval()
+
+
+class EagerBackend:
+    name = 'eager'
+
+    def __init__(self, path, device='cpu'):
+        self.device = device
+        self.model = load_eager_model(path, device)
+
+    def __call__(self, inputs):
+        with torch.no_grad():
+            return self.model(inputs.to(self.device))
+
+
+class TorchScriptBackend:
+    name = 'torchscript'
+
+    def __init__(self, path, device='cpu'):
+        self.device = device
+        self.model = torch.jit.load(path, map_location=torch.device(device))
+        self.model.eval()
+
+    def __call__(self, inputs):
+        with torch.no_grad():
+            return self.model(inputs.to(self.device))
+
+
+class OnnxBackend:
+    name = 'onnx'
+
+    # threads=None lets ONNX Runtime use every core
+    def __init__(self, path, device='cpu', threads=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads is not None:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, inputs):
+        inputs = np.ascontiguousarray(inputs.detach().cpu().numpy(), dtype=np.float32)
+        outputs, = self.session.run(None, {self.input_name: inputs})
+        return torch.from_numpy(outputs)
+
+
+# builds the backend called `name` from the files in `directory`
+def load_backend(name, directory=model_dir, device='cpu', threads=None):
+    if name == 'eager':
+        return EagerBackend(weights_path(directory), device)
+    if name == 'torchscript':
+        return TorchScriptBackend(torchscript_path(directory), device)
+    if name == 'onnx':
+        return OnnxBackend(onnx_path(directory), device, threads)
+    if name == 'quantized':
+        backend = TorchScriptBackend(quantized_path(directory), 'cpu')
+        backend.name = 'quantized'
+        return backend
+    raise ValueError(f'unknown inference backend {name!r}, expected one of {backend_names}')
@@ -0,0 +1,217 @@
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+import torch
+
+from audio import bytes_to_mfcc
+from backends import backend_names, load_backend, model_dir
+from feature_pool import init_process, pool_context
+
+# Bulk offline scoring: the /predict pipeline run over many recordings at once. Used by the /predict/batch
+# endpoint and on its own from the command line, from the repository root:
+#
+#   python api/batch_scoring.py Archive/2023 --out scores.jsonl
+#   python api/batch_scoring.py recordings.txt --out scores.csv --workers 8 --batch-size 128 --backend onnx
+#
+# The input is a directory (walked recursively for audio files) or a manifest: a text file with one path per
+# line, or a .csv / .jsonl file with a 'path' column. Paths are decoded and turned into MFCCs by a pool of
+# processes, the features are run through the model batch_size at a time, and every result is written out
+# (JSON Lines or CSV, from the extension of --out) as soon as its batch has run, so results come out in
+# the order the files finish, not in the input order.
+#
+# Memory stays bounded whatever the number of files: the input is read lazily and at most max_in_flight
+# files are being decoded or waiting for their batch at any time. (When resuming, the paths already scored
+# are kept in a set, the previous output itself is only read line by line.)
+#
+# Resuming: if --out already exists, the files it has a result for are skipped and the new results are
+# appended, so an interrupted run just has to be started again with the same arguments. Results are flushed
+# to --out at least every flush_every_s, so a stopped run loses at most that much work. Files that failed
+# (an 'error' instead of a prediction) are not tried again unless --retry-errors is given (their new result
+# is appended after the failed one, the last result of a path is the one that counts).
+
+emotions = ['neutral', 'calm', 'happy', 'sad', 'angry', 'fearful', 'disgust', 'surprised']
+audio_extensions = {'.wav', '.mp3', '.flac', '.ogg', '.m4a', '.aac', '.wma', '.aiff', '.aif'}
+csv_columns = ['path', 'prediction', 'emotion', 'prediction accuracy', 'confidence', 'error']
+
+
+def file_to_mfcc(path):
+    with open(path, 'rb') as f:
+        return bytes_to_mfcc(f.read())
+
+
+# every audio file under directory, sorted within each folder so reruns go through them in the same order
+def walk_audio_files(directory):
+    for root, folders, files in os.walk(directory):
+        folders.sort()
+        for file in sorted(files):
+            if os.path.splitext(file)[1].lower() in audio_extensions:
+                yield os.path.join(root, file)
+
+
+def read_manifest(manifest_path):
+    extension = os.path.splitext(manifest_path)[1].lower()
+    with open(manifest_path, newline='') as f:
+        if extension == '.csv':
+            for row in csv.DictReader(f):
+                yield row['path']
+        elif extension == '.jsonl':
+            for line in f:
+                if line.strip(): yield json.loads(line)['path']
+        else:
+            for line in f:
+                if line.strip(): yield line.strip()
+
+
+def input_paths(source):
+    return walk_audio_files(source) if os.path.isdir(source) else read_manifest(source)
+
+
+# the same fields as a /predict response, for one row of model outputs
+def result_row(name, output):
+    confidence = output.softmax(dim=0)
+    prediction = int(output.argmax())
+    return {'path': name, 'prediction': prediction, 'emotion': emotions[prediction],
+            'prediction accuracy': float(round(confidence[prediction].item(), 2)), 'confidence': confidence.tolist()}
+
+
+# scores (name, item) pairs and yields a result per item as soon as it is ready. submit(item) starts the
+# feature extraction of an item and returns a concurrent.futures.Future of its MFCC matrix. At most
+# max_in_flight items are submitted and not yet scored at any time
+def score(items, model, submit, batch_size=64, max_in_flight=256):
+    items = iter(items)
+    in_flight = {}          # future -> name
+    ready = []              # (name, mfccs) waiting for a full batch
+    exhausted = False
+
+    def run_batch():
+        names = [name for name, _ in ready]
+        inputs = torch.from_numpy(np.stack([mfccs for _, mfccs in ready]).astype(np.float32)).unsqueeze(1)
+        with torch.no_grad():
+            outputs = model(inputs).cpu()
+        ready.clear()
+        return [result_row(name, output) for name, output in zip(names, outputs)]
+
+    while True:
+        while not exhausted and len(in_flight) + len(ready) < max_in_flight:
+            try:
+                name, item = next(items)
+            except StopIteration:
+                exhausted = True
+                break
+            in_flight[submit(item)] = name
+
+        if not in_flight:
+            if ready: yield from run_batch()
+            if exhausted: return
+            continue
+
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            name = in_flight.pop(future)
+            try:
+                ready.append((name, future.result()))
+            except Exception as error:
+                yield {'path': name, 'error': f'{type(error).__name__}: {error}'}
+
+        if len(ready) >= batch_size:
+            yield from run_batch()
+
+
+def jsonl_line(row):
+    return json.dumps(row) + '\n'
+
+# a result as a CSV line (the confidence list as a JSON string in a single column)
+def csv_line(row):
+    row = dict(row, confidence=json.dumps(row['confidence']) if 'confidence' in row else '')
+    line = io.StringIO()
+    csv.DictWriter(line, csv_columns).writerow(row)
+    return line.getvalue()
+
+def csv_header():
+    return ','.join(csv_columns) + '\r\n'
+
+
+# cuts a file back to its last complete line, reading it backwards from the end chunk_size bytes at a time
+def truncate_torn_line(path, chunk_size=64 * 1024):
+    with open(path, 'rb+') as f:
+        end = f.seek(0, os.SEEK_END)
+        position, complete = end, 0
+        while position > 0:
+            step = min(chunk_size, position)
+            position -= step
+            f.seek(position)
+            newline = f.read(step).rfind(b'\n')
+            if newline != -1:
+                complete = position + newline + 1
+                break
+        if complete < end: f.truncate(complete)
+
+
+# paths already scored in an existing output (the ones that failed too, unless retry_errors), and the
+# output cut back to its last complete line if the previous run was stopped while writing one. The output
+# is read one line at a time
+def scored_paths(out_path, retry_errors=False):
+    if not os.path.isfile(out_path):
+        return set()
+
+    truncate_torn_line(out_path)
+    with open(out_path, newline='', encoding='utf-8') as f:
+        if out_path.lower().endswith('.csv'):
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        return {row['path'] for row in rows if not (retry_errors and row.get('error'))}
+
+
+def score_files(source, out_path, backend='eager', workers=None, batch_size=64, max_in_flight=256, retry_errors=False,
+                report_every=1000, flush_every_s=1.0):
+    to_line = csv_line if out_path.lower().endswith('.csv') else jsonl_line
+    done = scored_paths(out_path, retry_errors)
+    if done: print(f'Resuming: {len(done)} files already scored in {out_path}')
+
+    model = load_backend(backend, model_dir)
+    items = ((path, path) for path in input_paths(source) if path not in done)
+    new_file = not os.path.isfile(out_path) or os.path.getsize(out_path) == 0
+
+    if workers is None: workers = os.cpu_count()
+    scored, failed, start = 0, 0, time.perf_counter()
+    flushed_at = start
+    with ProcessPoolExecutor(max_workers=workers, mp_context=pool_context(), initializer=init_process) as executor, \
+         open(out_path, 'a', newline='', encoding='utf-8') as f:
+        if new_file and to_line is csv_line:
+            f.write(csv_header())
+
+        for row in score(items, model, lambda path: executor.submit(file_to_mfcc, path), batch_size, max_in_flight):
+            f.write(to_line(row))
+            scored += 1
+            failed += 'error' in row
+            if time.perf_counter() - flushed_at >= flush_every_s:
+                f.flush()
+                flushed_at = time.perf_counter()
+            if scored % report_every == 0:
+                print(f'Scored {scored} files ({failed} failed), {scored / (time.perf_counter() - start):.1f} files/s', flush=True)
+
+    print(f'Done: scored {scored} files ({failed} failed) in {time.perf_counter() - start:.1f}s, results in {out_path}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score a directory or a manifest of recordings with the API model')
+    parser.add_argument('source', help='directory of recordings, or manifest (.txt, .csv or .jsonl with a path column)')
+    parser.add_argument('--out', required=True, help='results, .jsonl or .csv (appended to when resuming)')
+    parser.add_argument('--backend', default='eager', choices=backend_names)
+    parser.add_argument('--workers', type=int, default=None, help='decoding processes (default: one per core)')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--max-in-flight', type=int, default=256, help='files being decoded or waiting for their batch')
+    parser.add_argument('--retry-errors', action='store_true', help='score the files that failed last time again')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.source):
+        sys.exit(f'{args.source} does not exist')
+    score_files(args.source, args.out, args.backend, args.workers, args.batch_size, args.max_in_flight, args.retry_errors)
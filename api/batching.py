@@ -0,0 +1,107 @@
+import threading
+import time
+from concurrent.futures import Future
+from queue import Queue, Empty
+
+import numpy as np
+import torch
+
+from metrics import Histogram
+
+# Micro-batching for the /predict endpoint:
+# every request puts its MFCC matrix on a queue and waits on a Future. A single worker thread
+# takes the first waiting request, keeps collecting more until either max_batch_size requests
+# are in hand or max_wait_ms has passed since the first one arrived, then stacks them into one
+# (N, 1, frames, features) tensor and runs a single forward pass. Each caller gets back its own
+# row of the model output.
+
+
+class MicroBatcher:
+    def __init__(self, model, device, max_batch_size=16, max_wait_ms=8):
+        self.model = model
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+
+        self._queue = Queue()
+        self._worker = None
+        self._start_lock = threading.Lock()
+
+        # batch sizes, time spent waiting in the queue and end-to-end time per request (in ms)
+        self.batch_size_histogram = Histogram([1, 2, 4, 8, 16, 32, 64])
+        self.queue_latency_histogram = Histogram([1, 2, 4, 8, 16, 32, 64, 128, 256])
+        self.request_latency_histogram = Histogram([5, 10, 25, 50, 100, 250, 500, 1000, 2500])
+        self.forward_latency_histogram = Histogram([1, 2, 4, 8, 16, 32, 64, 128, 256])
+
+    # starts the worker thread (only once, it is a daemon so it dies with the server)
+    def start(self):
+        with self._start_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+                self._worker.start()
+
+    # id of the worker thread (for the profiler's stack samples)
+    def worker_thread_id(self):
+        self.start()
+        return self._worker.ident
+
+    # blocks until the batch containing this request has been run, and returns this request's output row
+    def predict(self, mfccs, timeout=None):
+        return self.submit(mfccs).result(timeout=timeout)
+
+    # same without blocking: returns a Future of this request's output row (cancelling it before its batch
+    # runs takes the request out of the batch)
+    def submit(self, mfccs):
+        self.start()
+        future = Future()
+        enqueued_at = time.perf_counter()
+        future.add_done_callback(lambda _: self.request_latency_histogram.observe((time.perf_counter() - enqueued_at) * 1000))
+        self._queue.put((np.asarray(mfccs, dtype=np.float32), future, enqueued_at))
+        return future
+
+    def stats(self):
+        return {'max batch size': self.max_batch_size,
+                'max wait ms': self.max_wait * 1000,
+                'queued': self._queue.qsize(),
+                'batch size': self.batch_size_histogram.snapshot(),
+                'queue latency ms': self.queue_latency_histogram.snapshot(),
+                'request latency ms': self.request_latency_histogram.snapshot(),
+                'forward latency ms': self.forward_latency_histogram.snapshot()}
+
+    # collects up to max_batch_size requests, waiting at most max_wait after the first one arrived
+    def _collect_batch(self):
+        batch = [self._queue.get()]
+        deadline = batch[0][2] + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining > 0: batch.append(self._queue.get(timeout=remaining))
+                else: batch.append(self._queue.get_nowait())   # take whatever is already waiting
+            except Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = [request for request in self._collect_batch() if request[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            started_at = time.perf_counter()
+
+            self.batch_size_histogram.observe(len(batch))
+            for _, _, enqueued_at in batch:
+                self.queue_latency_histogram.observe((started_at - enqueued_at) * 1000)
+
+            try:
+                inputs = torch.from_numpy(np.stack([mfccs for mfccs, _, _ in batch])).unsqueeze(1)
+                with torch.no_grad():
+                    outputs = self.model(inputs.to(self.device)).cpu()
+                self.forward_latency_histogram.observe((time.perf_counter() - started_at) * 1000)
+            except Exception as error:
+                for _, future, _ in batch:
+                    future.set_exception(error)
+                continue
+
+            for (_, future, _), output in zip(batch, outputs):
+                future.set_result(output)
@@ -0,0 +1,63 @@
+import argparse
+import sys
+
+import numpy as np
+import torch
+
+from audio import convert_to_mfcc
+from backends import load_backend, input_shape, model_dir
+
+# Numerical equivalence check of the inference backends (backends.py) against the eager model. Run it from
+# the repository root after exporting the model, before switching the API to another backend:
+#
+#   python api/check_backends.py
+#   python api/check_backends.py recording_1.wav recording_2.mp3 --tolerance 1e-5
+#
+# Every backend gets the same random batches (batch sizes 1 to 64) and the MFCCs of the given recordings.
+# It exits with 1 if any probability differs from the eager one by more than the tolerance, or if any
+# prediction changes. (The quantized backend is approximate by design, quantize_model.py checks its accuracy.)
+
+batch_sizes = [1, 2, 3, 8, 16, 33, 64]
+
+
+def make_inputs(file_paths, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    inputs = [torch.randn(batch_size, *input_shape, generator=generator) for batch_size in batch_sizes]
+    if file_paths:
+        mfccs = []
+        for file_path in file_paths:
+            with open(file_path, 'rb') as audio_file:
+                mfccs.append(convert_to_mfcc(audio_file))
+        inputs.append(torch.from_numpy(np.stack(mfccs).astype(np.float32)).unsqueeze(1))
+    return inputs
+
+
+def compare(backend, reference, inputs):
+    result = {'backend': backend.name, 'max abs diff': 0.0, 'same predictions': True}
+    for batch in inputs:
+        expected = reference(batch)
+        outputs = backend(batch)
+        result['max abs diff'] = max(result['max abs diff'], float((outputs - expected).abs().max()))
+        result['same predictions'] = result['same predictions'] and bool((outputs.argmax(1) == expected.argmax(1)).all())
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the torchscript and onnx backends with the eager model')
+    parser.add_argument('files', nargs='*', help='audio files to also compare on')
+    parser.add_argument('--model-dir', default=model_dir)
+    parser.add_argument('--backends', nargs='+', default=['torchscript', 'onnx'], choices=['torchscript', 'onnx'])
+    parser.add_argument('--tolerance', type=float, default=1e-5, help='largest allowed probability difference')
+    args = parser.parse_args()
+
+    reference = load_backend('eager', args.model_dir)
+    inputs = make_inputs(args.files)
+
+    failed = False
+    for name in args.backends:
+        result = compare(load_backend(name, args.model_dir), reference, inputs)
+        passed = result['max abs diff'] <= args.tolerance and result['same predictions']
+        failed = failed or not passed
+        print(('OK    ' if passed else 'DRIFT ') + ', '.join(f'{key}: {value}' for key, value in result.items()))
+
+    sys.exit(1 if failed else 0)
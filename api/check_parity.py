@@ -0,0 +1,88 @@
+import argparse
+import os
+import sys
+from io import BytesIO
+from tempfile import NamedTemporaryFile
+
+import numpy as np
+import torch
+from pydub import AudioSegment
+
+from audio import remove_silence, resample_data, normalize_data, extract_mfccs, convert_to_mfcc, target_sampling_rate
+from model import CNNModel
+
+# Parity check between the in-memory /predict pipeline (audio.convert_to_mfcc) and the previous pipeline,
+# which went through two temporary wav files and resampled twice. Run it from the api folder on a few
+# recordings before deploying a change to the audio pipeline:
+#
+#   python check_parity.py recording_1.wav recording_2.mp3 --weights ModelWeights/trained_model.pth
+#
+# It exits with 1 if the features drift more than the tolerance or if any prediction changes.
+
+
+# the previous convert_to_mfcc(), kept here only to compare against
+def convert_to_mfcc_with_temporary_files(audio_file):
+    audio_data = BytesIO(audio_file.read())
+    audio_segment = AudioSegment.from_file_using_temporary_files(audio_data)
+
+    # Export AudioSegment to WAV format
+    with NamedTemporaryFile(suffix=".wav", delete=False) as temp_wav_file:
+        wav_filename = temp_wav_file.name
+        audio_segment.export(wav_filename, format="wav")
+
+    no_silence_path = f'{wav_filename}_no_sil'
+    remove_silence(wav_filename, no_silence_path, min_silence_length_ms=300, silence_threshold=-50)
+    resampled_audio = resample_data(no_silence_path, target_sr=target_sampling_rate)
+    normalized_audio = normalize_data(resampled_audio)
+
+    mfccs = extract_mfccs(audio=normalized_audio)
+
+    # Delete the temporary WAV file
+    os.remove(wav_filename)
+    os.remove(no_silence_path)
+
+    return mfccs
+
+
+def compare(file_path, model=None):
+    with open(file_path, 'rb') as audio_file:
+        previous_mfccs = convert_to_mfcc_with_temporary_files(audio_file)
+    with open(file_path, 'rb') as audio_file:
+        mfccs = convert_to_mfcc(audio_file)
+
+    difference = np.abs(previous_mfccs - mfccs)
+    result = {'path': file_path,
+              'max abs diff': float(difference.max()),
+              'mean abs diff': float(difference.mean()),
+              'same prediction': True}
+
+    if model is not None:
+        with torch.no_grad():
+            inputs = torch.tensor(np.stack([previous_mfccs, mfccs]), dtype=torch.float32).unsqueeze(1)
+            outputs = model(inputs)
+        result['same prediction'] = bool(outputs[0].argmax() == outputs[1].argmax())
+        result['max confidence diff'] = float((outputs[0] - outputs[1]).abs().max())
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the in-memory audio pipeline with the temporary file one')
+    parser.add_argument('files', nargs='+', help='audio files to compare')
+    parser.add_argument('--weights', default=None, help='trained_model.pth, to also compare the predictions')
+    parser.add_argument('--tolerance', type=float, default=0.05, help='largest allowed mean absolute feature difference')
+    args = parser.parse_args()
+
+    model = None
+    if args.weights:
+        model = CNNModel(num_classes=8)
+        model.load_state_dict(torch.load(args.weights, map_location='cpu'))
+        model.eval()
+
+    failed = False
+    for file_path in args.files:
+        result = compare(file_path, model)
+        passed = result['mean abs diff'] <= args.tolerance and result['same prediction']
+        failed = failed or not passed
+        print(('OK    ' if passed else 'DRIFT ') + ', '.join(f'{key}: {value}' for key, value in result.items()))
+
+    sys.exit(1 if failed else 0)
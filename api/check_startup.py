@@ -0,0 +1,129 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Cold start check of the API and of Lib against a startup time budget: every run is a new Python process
+# that times, one after the other,
+#
+#   import_torch          import torch
+#   import_app            import app (Flask, the pipeline modules, loading the model weights)
+#   warm_up               app.warm_up() (the feature pool processes, the audio pipeline, the model)
+#   first_predict         the first POST /predict (Flask test client, a clip the warm up didn't see)
+#
+# and another new process
+#
+#   import_lib            import Lib
+#   first_extract_mfccs   the first Lib.extract_mfccs (the librosa imports, numba's cache)
+#
+# Run it from the repository root:
+#
+#   python api/check_startup.py
+#   python api/check_startup.py --runs 5 --budget warm_up=10 first_predict=0.2
+#
+# It prints the median of every phase over --runs cold starts against its budget and exits with 1 if any
+# is over. The first run also fills numba's cache (.numba_cache, see audio.py) if it is empty, which is the
+# thing to do when building a container image: that first run compiles for ~30s and is left out of the
+# medians (it is reported on its own).
+#
+# It is a script, to run by hand or in a build, not a test: the repository has no test suite for it to be
+# part of, and its timings depend on the machine it runs on.
+
+# seconds, for a few cores: the budget a new worker or container has before it is useful
+default_budgets = {'import_torch': 5.0, 'import_app': 2.0, 'warm_up': 10.0, 'first_predict': 0.5,
+                   'import_lib': 1.0, 'first_extract_mfccs': 5.0}
+
+repository_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def measure_app():
+    timings = {}
+    start = time.perf_counter()
+    import torch
+    timings['import_torch'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    import app
+    timings['import_app'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    app.warm_up()
+    timings['warm_up'] = time.perf_counter() - start
+
+    from io import BytesIO
+    from audio import synthetic_clip
+    client = app.app.test_client()
+    start = time.perf_counter()
+    response = client.post('/predict', data={'file': (BytesIO(synthetic_clip(length_s=3)), 'clip.wav')})
+    timings['first_predict'] = time.perf_counter() - start
+    if response.status_code != 200:
+        raise RuntimeError(f'/predict answered {response.status_code}: {response.get_data(as_text=True)}')
+    return timings
+
+
+def measure_lib():
+    timings = {}
+    sys.path.insert(0, repository_root)
+    start = time.perf_counter()
+    import Lib
+    timings['import_lib'] = time.perf_counter() - start
+
+    import numpy as np
+    audio = np.random.default_rng(0).standard_normal(Lib.target_sampling_rate * 4).astype(np.float32)
+    start = time.perf_counter()
+    Lib.extract_mfccs(audio=audio, sr=Lib.target_sampling_rate)
+    timings['first_extract_mfccs'] = time.perf_counter() - start
+    return timings
+
+
+# one cold start of `part` ('app' or 'lib') in a new process, its timings are the last line of its output
+def cold_start(part):
+    result = subprocess.run([sys.executable, '-W', 'ignore', os.path.abspath(__file__), '--measure', part],
+                            cwd=repository_root, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'the {part} cold start failed:\n{result.stderr}')
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def parse_budgets(overrides):
+    budgets = dict(default_budgets)
+    for override in overrides:
+        phase, seconds = override.split('=')
+        if phase not in budgets: raise SystemExit(f'unknown phase {phase}, phases: {", ".join(budgets)}')
+        budgets[phase] = float(seconds)
+    return budgets
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cold start times of the API and Lib against a budget')
+    parser.add_argument('--runs', type=int, default=3, help='cold starts to take the median of')
+    parser.add_argument('--budget', nargs='*', default=[], metavar='PHASE=SECONDS', help='overrides a budget')
+    parser.add_argument('--measure', choices=['app', 'lib'], help=argparse.SUPPRESS)    # a single cold start
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure_app() if args.measure == 'app' else measure_lib()))
+        sys.exit(0)
+
+    budgets = parse_budgets(args.budget)
+    print(f"numba cache: {os.environ.get('NUMBA_CACHE_DIR', os.path.abspath(os.path.join(repository_root, '.numba_cache')))}")
+    first = {**cold_start('app'), **cold_start('lib')}
+    print(f"first run (fills numba's cache if it is empty): " + ', '.join(f'{phase} {seconds:.2f}s' for phase, seconds in first.items()))
+
+    runs = [{**cold_start('app'), **cold_start('lib')} for _ in range(args.runs)]
+    over_budget = []
+    print(f"{'phase':<22} {'median (s)':>11} {'max (s)':>9} {'budget (s)':>11}")
+    for phase, budget in budgets.items():
+        timings = [run[phase] for run in runs]
+        median = statistics.median(timings)
+        flag = ''
+        if median > budget:
+            flag = '  OVER BUDGET'
+            over_budget.append(phase)
+        print(f'{phase:<22} {median:>11.3f} {max(timings):>9.3f} {budget:>11.2f}{flag}')
+
+    print(f'{len(over_budget)} phase(s) over budget')
+    sys.exit(1 if over_budget else 0)
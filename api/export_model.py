@@ -0,0 +1,84 @@
+import argparse
+import os
+import sys
+
+import torch
+
+from atomic_write import atomic_path
+from backends import load_eager_model, inference_model, weights_path, torchscript_path, onnx_path, input_shape, model_dir
+
+# Exports trained_model.pth for the torchscript and onnx backends (see backends.py). Run it from the
+# repository root after every new trained_model.pth:
+#
+#   python api/export_model.py
+#   python api/export_model.py --weights api/ModelWeights/trained_model.pth --out-dir api/ModelWeights
+#
+# Both exports are made from the inference version of the network (no Dropout, Softmax kept as the last
+# layer), with a dynamic batch dimension. The TorchScript model is frozen, so the weights are constants
+# of the graph (torch.jit.optimize_for_inference is not used: its mkldnn graphs can't be loaded back). Each export is loaded back and checked against the eager model;
+# the script exits with 1 if one of them doesn't match.
+#
+# The exports (like trained_model.pth itself) are build artifacts and are not tracked: api/ModelWeights/ is in
+# .gitignore.
+
+
+def export_torchscript(model, path):
+    example = torch.randn(2, *input_shape)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+    frozen = torch.jit.freeze(traced)
+    with atomic_path(path) as temporary_path:
+        frozen.save(temporary_path)
+
+
+def export_onnx(model, path, opset=17):
+    example = torch.randn(2, *input_shape)
+    with atomic_path(path) as temporary_path:
+        torch.onnx.export(model, example, temporary_path, input_names=['mfccs'], output_names=['probabilities'],
+                          dynamic_axes={'mfccs': {0: 'batch'}, 'probabilities': {0: 'batch'}},
+                          opset_version=opset, do_constant_folding=True, dynamo=False)
+
+
+# largest absolute difference with the eager model over a few batch sizes
+def max_difference(model, backend, batch_sizes=(1, 7, 64), seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    difference = 0.0
+    for batch_size in batch_sizes:
+        inputs = torch.randn(batch_size, *input_shape, generator=generator)
+        with torch.no_grad():
+            expected = model(inputs)
+        difference = max(difference, float((backend(inputs) - expected).abs().max()))
+    return difference
+
+
+if __name__ == '__main__':
+    from backends import TorchScriptBackend, OnnxBackend
+
+    parser = argparse.ArgumentParser(description='Export trained_model.pth to TorchScript and ONNX')
+    parser.add_argument('--weights', default=weights_path(), help='state dict of the api CNNModel')
+    parser.add_argument('--out-dir', default=model_dir)
+    parser.add_argument('--formats', nargs='+', default=['torchscript', 'onnx'], choices=['torchscript', 'onnx'])
+    parser.add_argument('--tolerance', type=float, default=1e-5, help='largest allowed difference with the eager model')
+    args = parser.parse_args()
+
+    model = load_eager_model(args.weights)
+    exported = inference_model(model)
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    failed = False
+    for export_format in args.formats:
+        if export_format == 'torchscript':
+            path = torchscript_path(args.out_dir)
+            export_torchscript(exported, path)
+            backend = TorchScriptBackend(path)
+        else:
+            path = onnx_path(args.out_dir)
+            export_onnx(exported, path)
+            backend = OnnxBackend(path)
+
+        difference = max_difference(model, backend)
+        passed = difference <= args.tolerance
+        failed = failed or not passed
+        print(f"{'OK  ' if passed else 'FAIL'} {export_format}: {path}, max abs diff with eager: {difference:.2e}")
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,172 @@
+import multiprocessing
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from threadpoolctl import threadpool_limits
+
+from audio import bytes_to_mfcc, probe_duration, synthetic_clip
+from metrics import stage
+from profiler import profile_call
+
+# Decoding and feature extraction of /predict uploads (audio.bytes_to_mfcc) in a bounded pool of processes,
+# so that a long upload only keeps one of the pool's processes busy instead of the request threads, and
+# short clips keep going through the other ones.
+#
+# Admission control: at most max_pending uploads are queued or being processed at once. Past that, submit
+# raises Overloaded right away (the API answers 429) instead of letting the queue, and every request's
+# latency, grow without bound. Work that runs outside the pool but competes for the same CPUs (a
+# /predict/stream request) holds one of those places with reserved() for as long as it runs.
+#
+# Uploads longer than max_seconds fail with TooLong. The duration is probed (possibly with an ffprobe
+# subprocess) by the pool's process too, after admission, so probing never ties up the request threads.
+#
+# The pool's processes time every stage of the pipeline and send the timings back with the MFCCs, they are
+# added to `metrics` (see metrics.py) along with the time spent queued and in transit (feature_wait). A
+# profiled upload also sends back the sampled stacks of its process, for `profiler` (see profiler.py).
+
+
+# modules the pool's processes start with already imported: the librosa modules of the pipeline import scipy
+# and load numba's cache, ~3s that every process paid on its own before its first upload
+preloaded_modules = ['audio', 'librosa.core.audio', 'librosa.feature.spectral', 'librosa.feature.utils']
+
+
+class Overloaded(Exception):
+    pass
+
+
+class TooLong(ValueError):
+    pass
+
+
+# the pool's processes are forked from a 'forkserver' process that imported preloaded_modules once, so they
+# start warm and don't inherit the threads of the process that starts them. Where there is no forkserver
+# (Windows), they are spawned and import everything themselves
+def pool_context():
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(preloaded_modules)
+    return context
+
+
+# every pool process uses a single BLAS / OpenMP thread (the pool's processes are the parallelism) and
+# runs the pipeline once, so the first real upload doesn't pay for the lazy imports
+def init_process():
+    threadpool_limits(1)
+    bytes_to_mfcc(synthetic_clip())
+
+
+# what runs in the pool's processes: the MFCCs of the upload, the timings of its stages, and its stacks
+# sampled every profile_interval_s if it is given. Raises TooLong if the recording is over max_seconds
+def extract_features(audio_bytes, profile_interval_s=None, max_seconds=None):
+    if max_seconds is not None:
+        duration = probe_duration(audio_bytes)
+        if duration is not None and duration > max_seconds:
+            raise TooLong(f'recordings are limited to {max_seconds} s, use /predict/stream for longer ones')
+    timings, stacks = [], None
+    with stage(timings, 'convert_to_mfcc', len(audio_bytes)):
+        if profile_interval_s is None:
+            mfccs = bytes_to_mfcc(audio_bytes, timings)
+        else:
+            mfccs, stacks = profile_call(profile_interval_s, bytes_to_mfcc, audio_bytes, timings)
+    return mfccs, timings, stacks
+
+
+class FeaturePool:
+    def __init__(self, workers=2, max_pending=32, max_seconds=None, metrics=None, profiler=None):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_seconds = max_seconds
+        self.metrics = metrics
+        self.profiler = profiler
+        self.pending = 0
+        self.rejected = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    # the processes are started on first use, i.e. in the server worker after the fork (see pool_context).
+    # They are all started right away: ProcessPoolExecutor only starts a new process when none looks idle,
+    # and counts every finished job as an idle process, so after a few requests one at a time it would never
+    # start the others and every upload would queue behind the others
+    def start(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=pool_context(),
+                                                     initializer=init_process)
+                for future in [self._executor.submit(int) for _ in range(self.workers)]:
+                    future.result()
+
+    # returns a concurrent.futures.Future of the MFCC matrix (or of TooLong), or raises Overloaded. profile
+    # samples the stacks of the process extracting the features (only with a profiler)
+    def submit(self, audio_bytes, profile=False):
+        self.start()
+        self._admit()
+
+        profile_interval_s = self.profiler.interval_s if profile and self.profiler is not None else None
+        submitted_at = time.perf_counter()
+        try:
+            executor = self._executor
+            try:
+                job = executor.submit(extract_features, audio_bytes, profile_interval_s, self.max_seconds)
+            except BrokenProcessPool:
+                # a process died (e.g. killed for running out of memory): shut the broken pool down, so its
+                # other processes and its management thread go away too, and start a new one (unless another
+                # request already did)
+                with self._lock:
+                    if self._executor is executor:
+                        self._executor = None
+                executor.shutdown(wait=False, cancel_futures=True)
+                self.start()
+                job = self._executor.submit(extract_features, audio_bytes, profile_interval_s, self.max_seconds)
+        except BaseException:
+            self._done(None)
+            raise
+        job.add_done_callback(self._done)
+
+        # the future of the MFCCs alone. Cancelling it cancels the job, if it hasn't started yet
+        future = Future()
+        future.add_done_callback(lambda _: job.cancel() if future.cancelled() else None)
+        job.add_done_callback(lambda _: self._finish(job, future, submitted_at))
+        return future
+
+    def _finish(self, job, future, submitted_at):
+        if job.cancelled() or not future.set_running_or_notify_cancel():
+            future.cancel()
+            return
+        if job.exception() is not None:
+            future.set_exception(job.exception())
+            return
+
+        mfccs, timings, stacks = job.result()
+        if self.metrics is not None:
+            extraction_s = sum(seconds for name, seconds, _ in timings if name == 'convert_to_mfcc')
+            self.metrics.record_stages(timings + [('feature_wait', time.perf_counter() - submitted_at - extraction_s, 0)])
+        if stacks is not None:
+            self.profiler.write('features', stacks)
+        future.set_result(mfccs)
+
+    # holds one of the max_pending places for the duration of the block, or raises Overloaded
+    @contextmanager
+    def reserved(self):
+        self._admit()
+        try:
+            yield
+        finally:
+            self._done(None)
+
+    def _admit(self):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise Overloaded(f'{self.pending} uploads already waiting')
+            self.pending += 1
+
+    def _done(self, future):
+        with self._lock:
+            self.pending -= 1
+
+    def stats(self):
+        return {'workers': self.workers, 'max pending': self.max_pending, 'pending': self.pending, 'rejected': self.rejected}
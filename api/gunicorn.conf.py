@@ -0,0 +1,54 @@
+import gc
+import os
+
+import torch
+
+# Production server: a pre-fork pool of gunicorn workers (Linux/macOS, pip install gunicorn). Run it from the
+# repository root:
+#
+#   gunicorn -c api/gunicorn.conf.py
+#   WEB_CONCURRENCY=4 FEATURE_WORKERS=1 TORCH_THREADS_PER_WORKER=2 INFERENCE_BACKEND=onnx gunicorn -c api/gunicorn.conf.py
+#
+# - the app (and the model weights) is loaded once by the master before it forks the workers, so every
+#   worker shares the same weights copy-on-write instead of loading its own copy. The master only runs
+#   torch with a single thread and never runs the model, so no thread pool is forked half-initialized
+# - the cores are shared out between the workers (WEB_CONCURRENCY, cores / 2 by default), and every
+#   worker's share between the processes of its feature pool (FEATURE_WORKERS, half of it by default, see
+#   app.py) and its torch threads (TORCH_THREADS_PER_WORKER, the rest), so all the workers' decoding
+#   processes and forward passes together don't run more threads than there are cores
+# - every worker warms up (app.init_worker) before it accepts connections; GET /ready says if it is ready
+# - every worker serves up to CONNECTIONS_PER_WORKER requests at once from threads, so its micro-batcher
+#   can still group concurrent requests into one forward pass
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_CONCURRENCY', max(1, os.cpu_count() // 2)))
+cores_per_worker = max(2, os.cpu_count() // workers)
+# app.py reads it when the master loads the app below
+feature_workers = int(os.environ.setdefault('FEATURE_WORKERS', str(cores_per_worker // 2)))
+threads_per_worker = int(os.environ.get('TORCH_THREADS_PER_WORKER', max(1, cores_per_worker - feature_workers)))
+
+worker_class = 'gthread'
+threads = int(os.environ.get('CONNECTIONS_PER_WORKER', 16))
+preload_app = True
+pythonpath = 'api'
+wsgi_app = 'app:app'
+timeout = 120
+
+torch.set_num_threads(1)
+
+
+# in the master, after the app was loaded and before the workers are forked. gc.freeze moves every object
+# loaded so far out of the garbage collector's reach, so its passes in the workers don't write to (and
+# copy) the shared pages
+def when_ready(server):
+    import app
+    app.warm_up(run_model=False)
+    gc.freeze()
+    server.log.info(f'Loaded the {app.inference_backend} model, starting {workers} workers with {feature_workers} feature '
+                    f'processes and {threads_per_worker} torch threads each')
+
+
+def post_fork(server, worker):
+    import app
+    app.init_worker(threads_per_worker)
+    server.log.info(f'Worker {worker.pid} ready')
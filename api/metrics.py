@@ -0,0 +1,206 @@
+import glob
+import json
+import os
+import threading
+import time
+
+from atomic_write import atomic_path
+
+# Metrics of the API in the Prometheus text format (GET /metrics): request counts and latencies, and the
+# time spent in (and the bytes going into) every stage of the /predict pipeline:
+#
+#   decode, remove_silence, resample_data, extract_mfccs    audio.bytes_to_mfcc, in the feature pool
+#   convert_to_mfcc                                         all of the above
+#   feature_wait                                            submit to result of the feature pool (queue + transfer)
+#   predict                                                 submit to result of the micro-batcher (queue + forward pass)
+#
+# The forward passes themselves are the micro-batcher's histograms (emotion_batch_forward_ms, once per batch).
+#
+# Stages are timed by wrapping them in stage(timings, name, bytes), which appends to a plain list, so the
+# feature pool processes can send their timings back with the MFCCs (timings=None records nothing).
+#
+# Every server worker has its own metrics. With METRICS_DIR set, every worker also writes its metrics to
+# <METRICS_DIR>/<pid>.json (a second after a request, at most once a second) and /metrics adds up the
+# files of every worker, so it gives the same totals whichever worker answers. Files of workers that stopped are kept, so the counters
+# never go down; empty the directory when the server is deployed again.
+
+stage_seconds_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+stage_bytes_buckets = [1e3, 1e4, 1e5, 1e6, 1e7, 1e8]
+request_seconds_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+
+# simple fixed-bucket histogram, buckets are upper bounds (the last bucket catches everything else)
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = len(self.buckets)
+        for i, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                index = i
+                break
+        with self._lock:
+            self.counts[index] += 1
+            self.total += value
+            self.count += 1
+
+    def snapshot(self):
+        with self._lock:
+            labels = [str(upper_bound) for upper_bound in self.buckets] + ['+Inf']
+            return {'buckets': dict(zip(labels, self.counts)),
+                    'count': self.count,
+                    'sum': self.total,
+                    'mean': self.total / self.count if self.count else 0.0}
+
+
+# appends (stage, seconds, bytes) to timings when the block is done
+class stage:
+    __slots__ = ('timings', 'name', 'num_bytes', 'start')
+
+    def __init__(self, timings, name, num_bytes=0):
+        self.timings = timings
+        self.name = name
+        self.num_bytes = num_bytes
+
+    def __enter__(self):
+        if self.timings is not None: self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        if self.timings is not None: self.timings.append((self.name, time.perf_counter() - self.start, self.num_bytes))
+
+
+class Metrics:
+    def __init__(self, directory=None, save_every_s=1.0):
+        self.directory = directory
+        self.save_every_s = save_every_s
+        self._families = {}         # name -> (type, help)
+        self._histograms = {}       # (name, labels) -> Histogram
+        self._counters = {}         # (name, labels) -> value
+        self._lock = threading.Lock()
+        self._save_timer = None
+
+        self.family('emotion_requests_total', 'counter', 'Requests by endpoint and status code')
+        self.family('emotion_request_seconds', 'histogram', 'Time to answer a request, by endpoint')
+        self.family('emotion_stage_seconds', 'histogram', 'Time spent in every stage of the /predict pipeline')
+        self.family('emotion_stage_bytes', 'histogram', 'Bytes going into every stage of the /predict pipeline')
+
+    def family(self, name, metric_type, help_text):
+        self._families[name] = (metric_type, help_text)
+
+    def histogram(self, name, buckets, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram(buckets))
+        return histogram
+
+    # an existing histogram (e.g. the micro-batcher's), exported as it is
+    def register(self, name, help_text, histogram, **labels):
+        self.family(name, 'histogram', help_text)
+        self._histograms[(name, tuple(sorted(labels.items())))] = histogram
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    # the (stage, seconds, bytes) timings of a request
+    def record_stages(self, timings):
+        for name, seconds, num_bytes in timings:
+            self.histogram('emotion_stage_seconds', stage_seconds_buckets, stage=name).observe(seconds)
+            if num_bytes: self.histogram('emotion_stage_bytes', stage_bytes_buckets, stage=name).observe(num_bytes)
+
+    def record_request(self, endpoint, status, seconds):
+        self.inc('emotion_requests_total', endpoint=endpoint, status=str(status))
+        self.histogram('emotion_request_seconds', request_seconds_buckets, endpoint=endpoint).observe(seconds)
+        if self.directory is not None: self._schedule_save()
+
+    # saves save_every_s after the first request that wasn't saved yet, so a busy worker writes its file
+    # once a second and an idle one doesn't write it at all
+    def _schedule_save(self):
+        with self._lock:
+            if self._save_timer is not None:
+                return
+            self._save_timer = threading.Timer(self.save_every_s, self.save)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def snapshot(self):
+        with self._lock:
+            histograms = list(self._histograms.items())
+            counters = list(self._counters.items())
+        return {'families': self._families,
+                'histograms': [[name, dict(labels), histogram.snapshot()] for (name, labels), histogram in histograms],
+                'counters': [[name, dict(labels), value] for (name, labels), value in counters]}
+
+    def save(self):
+        with self._lock:
+            self._save_timer = None
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        with atomic_path(path) as temporary_path, open(temporary_path, 'w') as f:
+            json.dump(self.snapshot(), f)
+
+    # the metrics of this worker, or of every worker with a directory, in the Prometheus text format
+    def render(self):
+        if self.directory is None:
+            return render_snapshots([self.snapshot()])
+        self.save()
+        snapshots = []
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                pass    # a worker's file being replaced
+        return render_snapshots(snapshots)
+
+
+# a label value as the text format wants it: backslash, double quote and line feed escaped
+def label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def label_text(labels, **extra):
+    labels = {**labels, **extra}
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{label_value(value)}"' for key, value in sorted(labels.items())) + '}'
+
+
+# adds up the snapshots (one per worker) and writes them out
+def render_snapshots(snapshots):
+    families, histograms, counters = {}, {}, {}
+    for snapshot in snapshots:
+        families.update(snapshot['families'])
+        for name, labels, histogram in snapshot['histograms']:
+            key = (name, tuple(sorted(labels.items())))
+            total = histograms.setdefault(key, {'buckets': dict.fromkeys(histogram['buckets'], 0), 'count': 0, 'sum': 0.0})
+            for upper_bound, count in histogram['buckets'].items():
+                total['buckets'][upper_bound] += count
+            total['count'] += histogram['count']
+            total['sum'] += histogram['sum']
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(sorted(labels.items())))
+            counters[key] = counters.get(key, 0) + value
+
+    lines = []
+    for family, (metric_type, help_text) in sorted(families.items()):
+        lines += [f'# HELP {family} {help_text}', f'# TYPE {family} {metric_type}']
+        for (name, labels), value in sorted(counters.items()):
+            if name == family: lines.append(f'{name}{label_text(dict(labels))} {value}')
+        for (name, labels), histogram in sorted(histograms.items()):
+            if name != family: continue
+            cumulative = 0
+            for upper_bound, count in histogram['buckets'].items():
+                cumulative += count
+                lines.append(f'{name}_bucket{label_text(dict(labels), le=upper_bound)} {cumulative}')
+            lines.append(f'{name}_sum{label_text(dict(labels))} {histogram["sum"]}')
+            lines.append(f'{name}_count{label_text(dict(labels))} {histogram["count"]}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,126 @@
+import hmac
+import os
+import random
+import sys
+import threading
+from collections import Counter
+
+# Opt-in sampling profiler for /predict, turned on by setting PROFILE_DIR. For a fraction of the requests
+# (PROFILE_SAMPLE_RATE, 1% by default) the stacks of the threads doing the work are sampled every
+# PROFILE_INTERVAL_MS milliseconds (5 by default):
+#
+#   - the feature pool process decoding the upload and computing its MFCCs
+#   - the micro-batcher thread while the request waits for its forward pass
+#
+# and appended, in the collapsed format flame graph tools read (one 'frame;frame;frame count' line per
+# stack, root first), to
+#
+#   <PROFILE_DIR>/profile-<pid>.folded
+#
+# Once that file reaches PROFILE_MAX_FILE_MB (50 by default) it is renamed to profile-<pid>.folded.1
+# (replacing the previous one) and a new one is started, so a process never keeps more than twice that.
+# A request can also ask to be profiled with an 'X-Profile: <PROFILE_TOKEN>' header, only if PROFILE_TOKEN
+# is set: profiling costs the server time, so clients can't force it without the token.
+#
+# e.g. flamegraph.pl profile-*.folded > predict.svg, or open the file in speedscope. Every stack starts with
+# the part of the request it comes from ('features' or 'model'). When profiling is off (the default), a
+# request costs a single attribute check.
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f'{os.path.basename(code.co_filename)}:{code.co_name}'
+
+
+# the stack of a frame, root first, as a single 'a;b;c' string
+def collapse(frame):
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+# samples the stacks of the given threads from a background thread until stop(), which returns how many
+# times every stack was seen
+class StackSampler:
+    def __init__(self, thread_ids, interval_s=0.005):
+        self.thread_ids = set(thread_ids)
+        self.interval_s = interval_s
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        while not self._stop.wait(self.interval_s):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id in self.thread_ids:
+                    self.stacks[collapse(frame)] += 1
+
+
+class Profiler:
+    # directory=None turns the profiler off, token=None means requests can't ask to be profiled
+    def __init__(self, directory=None, sample_rate=0.01, interval_ms=5, token=None, max_file_mb=50):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.interval_s = interval_ms / 1000.0
+        self.token = token
+        self.max_file_bytes = max_file_mb * 1e6
+        self.enabled = directory is not None
+        self.profiled = 0
+        self.rotations = 0
+        self._lock = threading.Lock()
+
+    # True if this request is profiled, by sampling or because it sent the token (its X-Profile header)
+    def should_profile(self, token=None):
+        if not self.enabled:
+            return False
+        forced = self.token is not None and token is not None and hmac.compare_digest(token.encode(), self.token.encode())
+        if not (forced or random.random() < self.sample_rate):
+            return False
+        self.profiled += 1
+        return True
+
+    def sampler(self, thread_ids):
+        return StackSampler(thread_ids, self.interval_s).start()
+
+    # appends the stacks under `root` (e.g. 'features') to this process's file
+    def write(self, root, stacks):
+        if not stacks:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        lines = ''.join(f'{root};{stack} {count}\n' for stack, count in stacks.items())
+        path = os.path.join(self.directory, f'profile-{os.getpid()}.folded')
+        with self._lock:
+            try:
+                rotate = os.path.getsize(path) + len(lines) > self.max_file_bytes
+            except OSError:
+                rotate = False
+            if rotate:
+                os.replace(path, f'{path}.1')
+                self.rotations += 1
+            with open(path, 'a') as f:
+                f.write(lines)
+
+    def stats(self):
+        return {'enabled': self.enabled, 'sample rate': self.sample_rate, 'interval ms': self.interval_s * 1000,
+                'token': self.token is not None, 'profiled': self.profiled, 'rotations': self.rotations}
+
+
+# runs function(*args) with its thread's stacks sampled every interval_s, returns its result and the stacks
+def profile_call(interval_s, function, *args):
+    sampler = StackSampler([threading.get_ident()], interval_s).start()
+    try:
+        result = function(*args)
+    finally:
+        stacks = sampler.stop()
+    return result, stacks
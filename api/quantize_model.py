@@ -0,0 +1,183 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao.quantization import QConfigMapping, get_default_qconfig, default_dynamic_qconfig, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from torch.nn.utils import prune
+
+from atomic_write import atomic_path
+from backends import load_eager_model, inference_model, weights_path, quantized_path, input_shape, model_dir
+
+# Post-training int8 quantization of the API model, for the 'quantized' backend (see backends.py). Run it
+# from the repository root:
+#
+#   python api/quantize_model.py --features Data/packed_2s
+#   python api/quantize_model.py --features Data/packed_2s --static-convs --prune 0.5 --tolerance 0.01
+#
+# - the Linear layers (almost all the weights, 3.4M of them in Linear(13248, 256)) are quantized dynamically:
+#   int8 weights, activations quantized on the fly, so they need no calibration
+# - with --static-convs the convolutions (most of the compute) are quantized statically too, with their
+#   activation ranges calibrated on --calibration-size clips of the held-out features
+# - with --prune, that fraction of the smallest weights of Linear(13248, 256) is set to zero first
+#   (unstructured: it doesn't make the dense int8 kernels any faster, but the zeros compress well)
+#
+# --features is a packed feature directory of held-out 2s clips (Lib.packed_features.pack_features with
+# desired_length_in_sec=2.0). The clips not used for calibration measure the accuracy of both models.
+#
+# The quantized model is saved as frozen TorchScript (trained_model_int8.pt), so the API loads it directly,
+# without rebuilding the quantized modules. The script exits with 1 if the accuracy drops by more than
+# --tolerance.
+#
+# Without --features there is nothing real to calibrate or measure accuracy on, so it is only a smoke run of
+# the dynamic quantization: the int8 model is made from the weights and saved to a temporary directory, and
+# its size, latency and agreement with the fp32 model on random inputs are reported, without passing or
+# failing (--static-convs and --tolerance need --features).
+
+
+def load_held_out(packed_dir, calibration_size, seed=0):
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    from Lib.packed_features import PackedFeatureDataset
+
+    dataset = PackedFeatureDataset(packed_dir)
+    features, labels = dataset[np.arange(len(dataset))]
+    features = features.unsqueeze(1)
+    if features.shape[1:] != input_shape:
+        raise ValueError(f'the held-out features are {tuple(features.shape[1:])} matrices, the model takes {input_shape} (2s clips)')
+
+    permutation = torch.randperm(len(features), generator=torch.Generator().manual_seed(seed))
+    calibration, evaluation = permutation[:calibration_size], permutation[calibration_size:]
+    return features[calibration], features[evaluation], labels[evaluation]
+
+
+def random_held_out(calibration_size, evaluation_size=512, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(calibration_size, *input_shape, generator=generator), torch.randn(evaluation_size, *input_shape, generator=generator), None
+
+
+def prune_dense_layer(model, amount):
+    dense = next(layer for layer in model if isinstance(layer, nn.Linear))
+    prune.l1_unstructured(dense, name='weight', amount=amount)
+    prune.remove(dense, 'weight')
+    return model
+
+
+def quantize(model, calibration_features, static_convs=False, batch_size=64):
+    if not static_convs:
+        return quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+    # convolutions (and their pooling) static, Linear layers dynamic. Every ReLU gets the qconfig of the layer
+    # before it, since they are fused together
+    static_qconfig = get_default_qconfig(torch.backends.quantized.engine)
+    qconfig_mapping = QConfigMapping()
+    qconfig = None
+    for name, layer in model.named_children():
+        if isinstance(layer, (nn.Conv2d, nn.MaxPool2d)): qconfig = static_qconfig
+        elif isinstance(layer, nn.Linear): qconfig = default_dynamic_qconfig
+        elif not isinstance(layer, nn.ReLU): qconfig = None
+        qconfig_mapping.set_module_name(name, qconfig)
+    prepared = prepare_fx(model, qconfig_mapping, example_inputs=(calibration_features[:1],))
+    with torch.no_grad():
+        for start in range(0, len(calibration_features), batch_size):
+            prepared(calibration_features[start:start + batch_size])
+    return convert_fx(prepared)
+
+
+def save_torchscript(model, path):
+    with torch.no_grad():
+        traced = torch.jit.trace(model, torch.randn(2, *input_shape))
+    frozen = torch.jit.freeze(traced)
+    with atomic_path(path) as temporary_path:
+        frozen.save(temporary_path)
+
+
+def predict_all(model, features, batch_size=64):
+    with torch.no_grad():
+        return torch.cat([model(features[start:start + batch_size]) for start in range(0, len(features), batch_size)])
+
+
+# median and 90th percentile time of one forward pass, in ms
+def latency(model, batch_size, repeats=100, warm_up=10):
+    inputs = torch.randn(batch_size, *input_shape)
+    with torch.no_grad():
+        for _ in range(warm_up):
+            model(inputs)
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            model(inputs)
+            timings.append((time.perf_counter() - start) * 1000)
+    return float(np.percentile(timings, 50)), float(np.percentile(timings, 90))
+
+
+def report(fp32_model, int8_model, fp32_path, int8_path, evaluation_features, evaluation_labels):
+    fp32_outputs = predict_all(fp32_model, evaluation_features)
+    int8_outputs = predict_all(int8_model, evaluation_features)
+
+    result = {'agreement': float((fp32_outputs.argmax(1) == int8_outputs.argmax(1)).float().mean()),
+              'max probability diff': float((fp32_outputs - int8_outputs).abs().max()),
+              'fp32 size MB': os.path.getsize(fp32_path) / 1e6,
+              'int8 size MB': os.path.getsize(int8_path) / 1e6}
+    if evaluation_labels is not None:
+        result['fp32 accuracy'] = float((fp32_outputs.argmax(1) == evaluation_labels).float().mean())
+        result['int8 accuracy'] = float((int8_outputs.argmax(1) == evaluation_labels).float().mean())
+
+    for batch_size in [1, 16, 64]:
+        result[f'fp32 batch {batch_size} p50/p90 ms'] = latency(fp32_model, batch_size)
+        result[f'int8 batch {batch_size} p50/p90 ms'] = latency(int8_model, batch_size)
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Quantize the API model to int8')
+    parser.add_argument('--weights', default=weights_path(), help='state dict of the api CNNModel')
+    parser.add_argument('--out-dir', default=model_dir)
+    parser.add_argument('--features', default=None, help='packed feature directory of held-out 2s clips')
+    parser.add_argument('--calibration-size', type=int, default=512, help='held-out clips used for calibration')
+    parser.add_argument('--static-convs', action='store_true', help='also quantize the convolutions (statically)')
+    parser.add_argument('--prune', type=float, default=0.0, help='fraction of Linear(13248, 256) weights set to zero')
+    parser.add_argument('--tolerance', type=float, default=None, help='largest allowed accuracy drop (default 0.01, needs --features)')
+    args = parser.parse_args()
+
+    if args.features:
+        calibration_features, evaluation_features, evaluation_labels = load_held_out(args.features, args.calibration_size)
+        if args.tolerance is None: args.tolerance = 0.01
+    else:
+        if args.static_convs: parser.error('--static-convs calibrates on real clips, it needs --features')
+        if args.tolerance is not None: parser.error('--tolerance is an accuracy drop, it needs --features')
+        calibration_features, evaluation_features, evaluation_labels = random_held_out(args.calibration_size)
+        args.out_dir = tempfile.mkdtemp(prefix='quantize_smoke_')
+
+    fp32_model = inference_model(load_eager_model(args.weights))
+    model = inference_model(load_eager_model(args.weights))
+    if args.prune > 0:
+        model = prune_dense_layer(model, args.prune)
+    int8_model = quantize(model, calibration_features, args.static_convs)
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    path = quantized_path(args.out_dir)
+    save_torchscript(int8_model, path)
+    int8_model = torch.jit.load(path)       # report on what the API will load
+
+    result = report(fp32_model, int8_model, args.weights, path, evaluation_features, evaluation_labels)
+    if evaluation_labels is not None: print(f'Saved {path}')
+    for key, value in result.items():
+        if isinstance(value, tuple): value = '/'.join(f'{v:.2f}' for v in value)
+        elif isinstance(value, float): value = f'{value:.4f}'
+        print(f'  {key}: {value}')
+
+    if evaluation_labels is None:
+        shutil.rmtree(args.out_dir)
+        print('Smoke run on random inputs (nothing saved): use --features to calibrate, evaluate and save the model')
+        sys.exit(0)
+
+    drop = result['fp32 accuracy'] - result['int8 accuracy']
+    passed = drop <= args.tolerance
+    print(('OK' if passed else 'FAIL') + f': drop of {drop:.4f} (tolerance {args.tolerance})')
+    sys.exit(0 if passed else 1)
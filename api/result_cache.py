@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from atomic_write import atomic_path
+
+# Cache of /predict results, keyed by the SHA-1 of the uploaded bytes and of the model version, so a clip
+# that was already scored (retries, duplicate uploads, regression suites) skips the decoding, the features
+# and the forward pass altogether, and a new model never serves the results of the previous one.
+#
+# The entries (the model output row of the clip) are kept in memory in LRU order: at most max_entries of
+# them, each for at most ttl_s seconds. With disk_dir, every entry is also written to disk
+#
+#   <disk_dir>/<first 2 characters of the key>/<key>.json
+#
+# so results survive restarts and are shared by every server worker. An entry found on disk is moved back
+# into memory; expired ones are deleted when they are found. The disk tier is also pruned in the background
+# every prune_every_s seconds (by every worker, starting with the first entry stored): the files older than
+# ttl_s are deleted, then the oldest ones past max_disk_entries, so the directory can't grow without bound.
+
+# bump this when the audio pipeline changes in a way that changes its output, to invalidate every entry
+pipeline_version = 1
+
+
+# SHA-1 of the model file, read once at startup
+def model_version(model_path):
+    sha1 = hashlib.sha1()
+    with open(model_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, model_version, max_entries=10000, ttl_s=24 * 3600, disk_dir=None, max_disk_entries=100000,
+                 prune_every_s=600):
+        self.model_version = f'{model_version}:{pipeline_version}'
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.disk_dir = disk_dir
+        self.max_disk_entries = max_disk_entries
+        self.prune_every_s = prune_every_s
+
+        self._entries = OrderedDict()   # key -> (time stored, output row), least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.disk_pruned = 0
+        self._next_prune = 0.0
+        self._pruning = False
+
+    def key(self, audio_bytes):
+        sha1 = hashlib.sha1(self.model_version.encode())
+        sha1.update(audio_bytes)
+        return sha1.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f'{key}.json')
+
+    # the cached output row of the key, or None
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            if key in self._entries:
+                stored_at, output = self._entries[key]
+                if now - stored_at <= self.ttl_s:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return output
+                del self._entries[key]
+                self.expirations += 1
+
+        output = self._read(key, now)
+        with self._lock:
+            if output is None:
+                self.misses += 1
+            else:
+                self.disk_hits += 1
+        return output
+
+    def put(self, key, output):
+        now = time.time()
+        self._remember(key, now, output)
+        if self.disk_dir is not None:
+            self._write(key, now, output)
+            self._schedule_prune(now)
+
+    # deletes the disk entries older than ttl_s (and the temporary files of interrupted writes), then the
+    # least recently written ones past max_disk_entries. The files' modification times are their storing
+    # times, so nothing has to be opened. Several workers can prune the same directory at once: a file
+    # another one deleted first is skipped
+    def prune(self):
+        now = time.time()
+        entries = []
+        pruned = 0
+        for directory, _, files in os.walk(self.disk_dir):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    modified = os.stat(path).st_mtime
+                except OSError:
+                    continue
+                if now - modified > self.ttl_s:
+                    pruned += _remove(path)
+                elif name.endswith('.json'):
+                    entries.append((modified, path))
+
+        if len(entries) > self.max_disk_entries:
+            entries.sort()
+            for _, path in entries[:len(entries) - self.max_disk_entries]:
+                pruned += _remove(path)
+
+        with self._lock:
+            self.disk_pruned += pruned
+        return pruned
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {'entries': len(self._entries), 'max entries': self.max_entries, 'ttl s': self.ttl_s,
+                    'disk': self.disk_dir is not None, 'hits': self.hits, 'disk hits': self.disk_hits,
+                    'misses': self.misses, 'evictions': self.evictions, 'expirations': self.expirations,
+                    'disk pruned': self.disk_pruned,
+                    'hit rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0}
+
+    def _remember(self, key, stored_at, output):
+        with self._lock:
+            self._entries[key] = (stored_at, output)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    # prunes the disk tier in a background thread if the last pruning is prune_every_s old
+    def _schedule_prune(self, now):
+        with self._lock:
+            if self._pruning or now < self._next_prune:
+                return
+            self._pruning = True
+            self._next_prune = now + self.prune_every_s
+        threading.Thread(target=self._prune_in_background, daemon=True).start()
+
+    def _prune_in_background(self):
+        try:
+            self.prune()
+        finally:
+            with self._lock:
+                self._pruning = False
+
+    def _read(self, key, now):
+        if self.disk_dir is None:
+            return None
+        path = self.entry_path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if now - entry['stored at'] > self.ttl_s:
+            with self._lock:
+                self.expirations += 1
+            _remove(path)
+            return None
+
+        self._remember(key, entry['stored at'], entry['output'])
+        return entry['output']
+
+    def _write(self, key, stored_at, output):
+        with atomic_path(self.entry_path(key)) as temporary_path, open(temporary_path, 'w') as f:
+            json.dump({'stored at': stored_at, 'output': output}, f)
+
+
+# 1 if the file was deleted, 0 if it was already gone
+def _remove(path):
+    try:
+        os.remove(path)
+        return 1
+    except OSError:
+        return 0
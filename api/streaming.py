@@ -0,0 +1,179 @@
+import math
+import subprocess
+import threading
+
+import numpy as np
+import soundfile as sf
+import soxr
+import torch
+
+from audio import target_sampling_rate, training_load_sampling_rate, normalize_data, extract_mfccs
+
+# Streaming inference for recordings of any length. /predict only looks at the first 2 seconds of the
+# (silence-free) audio; here a 2s window slides over the whole recording with a configurable hop, and
+# every window is classified, giving an emotion timeline plus an aggregate over the recording.
+#
+# Everything is a chain of generators, so only one decoded block, one window and one batch of features
+# are in memory at a time, whatever the length of the recording:
+#   decode_blocks -> resample_blocks -> sliding_windows -> (features) -> batches through the model
+#
+# Silence is not removed (it would shift the timeline); windows quieter than the silence threshold are
+# still classified but marked as silent, and left out of the aggregate. Each window is normalized on its
+# own, like a single clip in training.
+
+window_length_s = 2.0                   # model input length
+min_hop_s = 0.1                         # 20 windows per second of audio at most
+block_size = 65536                      # samples decoded at a time
+silence_threshold = -50                 # dBFS, same as remove_silence
+
+
+# decodes the file block by block into mono float32 samples, returns (sampling rate, block generator).
+# wav (and flac/ogg) files are read with soundfile, anything else is decoded by an ffmpeg subprocess at
+# 22.05kHz (the rate every training clip was loaded at)
+def decode_blocks(audio_file):
+    try:
+        sound_file = sf.SoundFile(audio_file)
+    except Exception:
+        audio_file.seek(0)
+        return training_load_sampling_rate, ffmpeg_blocks(audio_file, training_load_sampling_rate)
+
+    def blocks():
+        with sound_file:
+            for block in sound_file.blocks(blocksize=block_size, dtype='float32', always_2d=True):
+                yield block.mean(axis=1)
+    return sound_file.samplerate, blocks()
+
+
+def ffmpeg_blocks(audio_file, sr):
+    process = subprocess.Popen(['ffmpeg', '-loglevel', 'error', '-i', 'pipe:0', '-f', 'f32le', '-ac', '1', '-ar', str(sr), 'pipe:1'],
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    # the upload is fed to ffmpeg from another thread while its output is read here
+    def feed():
+        try:
+            for chunk in iter(lambda: audio_file.read(block_size), b''):
+                process.stdin.write(chunk)
+        except BrokenPipeError:
+            pass
+        finally:
+            process.stdin.close()
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    try:
+        leftover = b''
+        for chunk in iter(lambda: process.stdout.read(block_size * 4), b''):
+            chunk = leftover + chunk
+            usable = len(chunk) - len(chunk) % 4
+            leftover = chunk[usable:]
+            yield np.frombuffer(chunk[:usable], dtype=np.float32)
+    finally:
+        process.stdout.close()
+        process.wait()
+        feeder.join()
+
+
+# resamples the blocks as they come, keeping the training bandwidth like audio.resample_audio does
+# (soxr's streaming resampler gives the same samples as librosa.resample on the whole signal)
+def resample_blocks(blocks, sr, target_sr=target_sampling_rate):
+    stages = []
+    if sr > training_load_sampling_rate:
+        stages.append(soxr.ResampleStream(sr, training_load_sampling_rate, 1, dtype='float32', quality='HQ'))
+        sr = training_load_sampling_rate
+    if sr != target_sr:
+        stages.append(soxr.ResampleStream(sr, target_sr, 1, dtype='float32', quality='HQ'))
+
+    def run_stages(block, last):
+        for stage in stages:
+            block = stage.resample_chunk(block, last=last)
+        return block
+
+    for block in blocks:
+        yield run_stages(block, last=False)
+    yield run_stages(np.zeros(0, dtype=np.float32), last=True)
+
+
+# yields (start sample, window) for every window_length window, hop samples apart. A last, shorter window
+# covers whatever is left at the end (it is padded later, like any short clip)
+def sliding_windows(blocks, window_length, hop):
+    if hop < 1: raise ValueError(f'hop must be at least one sample, got {hop}')
+    buffer = np.zeros(0, dtype=np.float32)
+    start = 0          # position of buffer[0] in the recording
+    next_window = 0    # start of the next window
+    covered = 0        # end of the last window given out
+
+    for block in blocks:
+        buffer = np.concatenate([buffer, block])
+        while next_window + window_length <= start + len(buffer):
+            offset = next_window - start
+            yield next_window, buffer[offset:offset + window_length]
+            covered = next_window + window_length
+            next_window += hop
+
+        # drop everything no later window needs
+        drop = min(next_window - start, len(buffer))
+        buffer = buffer[drop:]
+        start += drop
+
+    if covered < start + len(buffer) and next_window < start + len(buffer):
+        yield next_window, buffer[max(next_window - start, 0):]
+
+
+def is_silent(window):
+    rms = np.sqrt(np.mean(np.square(window, dtype=np.float64))) if len(window) else 0.0
+    return rms <= 10 ** (silence_threshold / 20)
+
+
+# the hop in samples, for a hop in seconds of at least min_hop_s (raises ValueError otherwise)
+def hop_samples(hop_s):
+    if not math.isfinite(hop_s) or hop_s < min_hop_s:
+        raise ValueError(f'hop must be a number of seconds, at least {min_hop_s}')
+    return round(hop_s * target_sampling_rate)
+
+
+# classifies the whole recording, batch_size windows per forward pass. The confidences are softmaxed like
+# /predict's, and the aggregate is their mean over the windows that aren't silent
+def predict_timeline(model, device, audio_file, hop_s=1.0, batch_size=32):
+    hop = hop_samples(hop_s)
+    sr, blocks = decode_blocks(audio_file)
+    window_length = int(window_length_s * target_sampling_rate)
+    windows = sliding_windows(resample_blocks(blocks, sr), window_length, hop)
+
+    timeline = []
+    confidence_sum = None
+    counted = 0
+    batch, batch_windows = [], []
+
+    def run_batch():
+        nonlocal confidence_sum, counted
+        with torch.no_grad():
+            inputs = torch.from_numpy(np.stack(batch).astype(np.float32)).unsqueeze(1).to(device)
+            outputs = model(inputs).cpu().softmax(dim=1)
+        for (start, length, silent), output in zip(batch_windows, outputs):
+            timeline.append({'start': start / target_sampling_rate,
+                             'end': (start + length) / target_sampling_rate,
+                             'silent': silent,
+                             'prediction': int(output.argmax()),
+                             'confidence': output.tolist()})
+            if not silent:
+                confidence_sum = output if confidence_sum is None else confidence_sum + output
+                counted += 1
+        batch.clear()
+        batch_windows.clear()
+
+    for start, window in windows:
+        silent = bool(is_silent(window))
+        batch.append(extract_mfccs(audio=normalize_data(window) if np.std(window) > 0 else window))
+        batch_windows.append((start, len(window), silent))
+        if len(batch) == batch_size: run_batch()
+    if batch: run_batch()
+
+    aggregate = None
+    if counted:
+        mean_confidence = confidence_sum / counted
+        predictions = [window['prediction'] for window in timeline if not window['silent']]
+        aggregate = {'prediction': int(mean_confidence.argmax()),
+                     'confidence': mean_confidence.tolist(),
+                     'window share': (np.bincount(predictions, minlength=len(mean_confidence)) / counted).tolist()}
+
+    return {'window length': window_length_s, 'hop': hop / target_sampling_rate, 'windows': len(timeline), 'timeline': timeline, 'aggregate': aggregate}
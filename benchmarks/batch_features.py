@@ -0,0 +1,55 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import Lib
+from Lib.batch_features import BatchMFCC
+
+# Throughput of the MFCC + delta + delta² features: Lib.extract_mfccs one clip at a time against
+# Lib.batch_features.BatchMFCC on the whole padded batch. Run it from the repository root:
+#
+#   python benchmarks/batch_features.py
+#   python benchmarks/batch_features.py --clips 1024 --length 2 --chunk-sizes 16 64
+#
+# The clips are synthetic 24kHz noise of random length (1 to 5 s), padded to --length seconds like the
+# training clips. Both paths get the same clips, and the largest difference between their features is
+# printed with the timings.
+
+
+def make_clips(num_clips, sr=24000, seed=0):
+    rng = np.random.default_rng(seed)
+    return [(rng.standard_normal(int(sr * rng.uniform(1, 5))) * 0.1).astype(np.float32) for _ in range(num_clips)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per clip against batched MFCC feature extraction')
+    parser.add_argument('--clips', type=int, default=256)
+    parser.add_argument('--length', type=float, default=4.0, help='padded clip length in seconds')
+    parser.add_argument('--chunk-sizes', type=int, nargs='+', default=[8, 32, 128])
+    args = parser.parse_args()
+
+    sr = 24000
+    clips = make_clips(args.clips, sr)
+
+    start = time.perf_counter()
+    reference = np.stack([Lib.extract_mfccs(audio=clip, sr=sr, desired_length_in_sec=args.length) for clip in clips])
+    per_clip_time = time.perf_counter() - start
+
+    print(f'{args.clips} clips of {args.length} s')
+    print(f"{'path':>22} {'clips/s':>10} {'speedup':>9} {'max abs diff':>14}")
+    print(f"{'per clip':>22} {args.clips / per_clip_time:>10.1f} {1:>8.1f}x {0:>14.1e}")
+
+    for chunk_size in args.chunk_sizes:
+        extractor = BatchMFCC(sr=sr, chunk_size=chunk_size)
+        out = np.empty((args.clips, extractor.num_frames(int(sr * args.length)), 39), dtype=np.float32)
+        extractor(extractor.pad(clips[:chunk_size], args.length))      # warm up
+
+        start = time.perf_counter()
+        extractor(extractor.pad(clips, args.length), out=out)
+        batch_time = time.perf_counter() - start
+        difference = float(np.abs(out - reference).max())
+        print(f"{f'batched, chunks of {chunk_size}':>22} {args.clips / batch_time:>10.1f} {per_clip_time / batch_time:>8.1f}x {difference:>14.1e}")
@@ -0,0 +1,97 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import soundfile as sf
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import Lib
+from Lib.dataset_index import dataset_registry, load_index, dataset_dictionary
+
+# Listing the datasets: the os.listdir loops the dataset functions used before Lib.dataset_index, against
+# building the index (crawl and file headers), updating it after a file was added to one dataset, and
+# loading it when nothing changed. Run it from the repository root:
+#
+#   python benchmarks/dataset_index.py
+#   python benchmarks/dataset_index.py --files 2000 --dir D:\scratch      (e.g. a network drive)
+#
+# The datasets are synthetic: --files tiny wavs per dataset, named and laid out like the real ones, in a
+# temporary directory (or under --dir).
+
+emotions = {'TESS': ['angry', 'disgust', 'fear', 'happy', 'neutral', 'ps', 'sad'],
+            'CREMA': ['ANG', 'DIS', 'FEA', 'HAP', 'NEU', 'SAD'],
+            'SAVEE': ['a', 'd', 'f', 'h', 'n', 'sa', 'su'],
+            'RAVDESS': ['01', '02', '03', '04', '05', '06', '07', '08'],
+            'EMOdb': ['W', 'L', 'E', 'A', 'F', 'T', 'N']}
+
+
+def file_path(dataset, i):
+    root = dataset_registry[dataset]['path']
+    emotion = emotions[dataset][i % len(emotions[dataset])]
+    if dataset == 'TESS': return os.path.join(root, f'OAF_{emotion}', f'OAF_w{i}_{emotion}.wav')
+    if dataset == 'CREMA': return os.path.join(root, f'{i}_DFA_{emotion}_XX.wav')
+    if dataset == 'SAVEE': return os.path.join(root, f'S{i}_{emotion}{i % 100:02d}.wav')
+    if dataset == 'RAVDESS': return os.path.join(root, f'Actor_{i % 24 + 1:02d}', f'03-01-{emotion}-01-02-01-{i}.wav')
+    return os.path.join(root, f'{i % 100:02d}a{i // 100 % 100:02d}{emotion}{i}.wav')
+
+
+def make_datasets(files_per_dataset):
+    clip = np.zeros(1600, dtype=np.float32)
+    for dataset in dataset_registry:
+        for i in range(files_per_dataset):
+            path = file_path(dataset, i)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            sf.write(path, clip, 16000)
+
+
+# what the dataset functions did: os.listdir of every folder and the labels split out of the names
+def listdir_datasets():
+    parsers = {'TESS': lambda name: name.split('_')[2][:-4], 'CREMA': lambda name: name.split('_')[2],
+               'SAVEE': lambda name: name.split('_')[1][:-6], 'RAVDESS': lambda name: name.split('-')[2],
+               'EMOdb': lambda name: name[5]}
+    paths = []
+    for dataset, spec in dataset_registry.items():
+        folders = [os.path.join(spec['path'], folder) for folder in os.listdir(spec['path'])] if spec['depth'] else [spec['path']]
+        for folder in folders:
+            for name in os.listdir(folder):
+                try:
+                    Lib.assign_global_labels(dataset, parsers[dataset](name))
+                    paths.append(os.path.join(folder, name))
+                except KeyError:
+                    pass
+    return paths
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return result, (time.perf_counter() - start) * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='os.listdir loops against the dataset index')
+    parser.add_argument('--files', type=int, default=5000, help='files per dataset')
+    parser.add_argument('--dir', default=None, help='where to create the datasets (default: a temporary directory)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        os.chdir(directory)
+        make_datasets(args.files)
+        print(f'{args.files * len(dataset_registry)} files in {len(dataset_registry)} datasets')
+
+        paths, listdir_ms = timed(listdir_datasets)
+        index, build_ms = timed(lambda: load_index(rebuild=True))
+        sf.write(file_path('CREMA', args.files), np.zeros(1600, dtype=np.float32), 16000)
+        _, update_ms = timed(load_index)
+        _, load_ms = timed(load_index)
+        _, dictionaries_ms = timed(lambda: [dataset_dictionary(dataset, index) for dataset in dataset_registry])
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    print(f'{"os.listdir loops (no durations)":<36} {listdir_ms:>9.1f} ms  {len(paths)} files')
+    print(f'{"index built (crawl + file headers)":<36} {build_ms:>9.1f} ms  {len(index["path"])} files')
+    print(f'{"index updated (1 new file in CREMA)":<36} {update_ms:>9.1f} ms')
+    print(f'{"index loaded (nothing changed)":<36} {load_ms:>9.1f} ms')
+    print(f'{"dataset dictionaries from the index":<36} {dictionaries_ms:>9.1f} ms')
@@ -0,0 +1,57 @@
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+from backends import backend_names, load_backend, input_shape, model_dir
+
+# Latency and throughput of the inference backends (api/backends.py) for batch sizes 1 to 64, on the CPU.
+# Export and quantize the model first (api/export_model.py, api/quantize_model.py), then run it from the
+# repository root:
+#
+#   python benchmarks/inference_backends.py
+#   python benchmarks/inference_backends.py --threads 1 --backends eager onnx
+#
+# Latency is the median time of one forward pass of the whole batch, throughput is clips per second at
+# that median. Every backend is warmed up first (TorchScript optimizes its graph on the first runs).
+
+batch_sizes = [1, 2, 4, 8, 16, 32, 64]
+
+
+def time_backend(backend, batch_size, repeats, warm_up=5):
+    inputs = torch.randn(batch_size, *input_shape)
+    for _ in range(warm_up):
+        backend(inputs)
+
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        backend(inputs)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Latency and throughput of the inference backends')
+    parser.add_argument('--model-dir', default=model_dir)
+    parser.add_argument('--backends', nargs='+', default=backend_names, choices=backend_names)
+    parser.add_argument('--threads', type=int, default=None, help='threads per forward pass (default: torch default)')
+    parser.add_argument('--repeats', type=int, default=50)
+    args = parser.parse_args()
+
+    if args.threads is not None: torch.set_num_threads(args.threads)
+    threads = torch.get_num_threads()
+    backends = [load_backend(name, args.model_dir, threads=threads) for name in args.backends]
+
+    print(f'{threads} threads')
+    print(f"{'batch':>6} " + ' '.join(f"{backend.name + ' ms':>16} {'clips/s':>9}" for backend in backends))
+    for batch_size in batch_sizes:
+        row = f'{batch_size:>6} '
+        for backend in backends:
+            latency = time_backend(backend, batch_size, args.repeats)
+            row += f'{latency * 1000:>16.2f} {batch_size / latency:>9.0f} '
+        print(row)
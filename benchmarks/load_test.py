@@ -0,0 +1,112 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+import requests
+import soundfile as sf
+
+# Load test of the production server (api/gunicorn.conf.py): for every worker count, starts the server,
+# waits until every worker is ready, then sends --requests /predict requests from --concurrency clients
+# and reports requests per second and the p50/p99 latency. Run it from the repository root:
+#
+#   python benchmarks/load_test.py --workers 1 2 4 8
+#   python benchmarks/load_test.py --workers 4 --backend onnx --file recording.wav
+#   python benchmarks/load_test.py --url http://localhost:5000      (an already running server)
+#
+# Without --file, every request uploads the same synthetic 3s 44.1kHz clip (noise bursts with pauses).
+
+repository_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def make_clip(length_s=3, sr=44100, seed=0):
+    rng = np.random.default_rng(seed)
+    samples = rng.uniform(-0.5, 0.5, int(length_s * sr)).astype(np.float32)
+    samples[int(sr * 0.8):int(sr * 1.4)] = 0       # a pause for the silence removal
+    clip = BytesIO()
+    sf.write(clip, samples, sr, format='WAV', subtype='PCM_16')
+    return clip.getvalue()
+
+
+def start_server(workers, threads_per_worker, backend, port):
+    env = dict(os.environ, WEB_CONCURRENCY=str(workers), TORCH_THREADS_PER_WORKER=str(threads_per_worker),
+               INFERENCE_BACKEND=backend, BIND=f'127.0.0.1:{port}')
+    return subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', os.path.join('api', 'gunicorn.conf.py')],
+                            cwd=repository_root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+# polls /ready until `workers` different worker processes have answered it
+def wait_until_ready(url, workers, timeout=120):
+    ready_pids = set()
+    deadline = time.time() + timeout
+    while len(ready_pids) < workers:
+        if time.time() > deadline:
+            raise TimeoutError(f'only {len(ready_pids)} of {workers} workers ready after {timeout}s')
+        try:
+            response = requests.get(url + '/ready', timeout=5)
+            if response.status_code == 200: ready_pids.add(response.json()['pid'])
+        except requests.ConnectionError:
+            time.sleep(0.5)
+
+
+def run_load(url, clip, num_requests, concurrency):
+    def send(_):
+        start = time.perf_counter()
+        response = requests.post(url + '/predict', files={'file': ('clip.wav', clip, 'audio/wav')}, timeout=120)
+        return time.perf_counter() - start, response.status_code == 200
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, range(num_requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array([latency for latency, _ in results]) * 1000
+    return {'requests/s': num_requests / elapsed,
+            'p50 ms': float(np.percentile(latencies, 50)),
+            'p99 ms': float(np.percentile(latencies, 99)),
+            'errors': sum(not ok for _, ok in results)}
+
+
+def print_row(label, result):
+    print(f"{label:>8} {result['requests/s']:>12.1f} {result['p50 ms']:>10.1f} {result['p99 ms']:>10.1f} {result['errors']:>8}", flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Requests per second and latency of the server as the worker count grows')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--threads-per-worker', type=int, default=None, help='torch threads per worker (default: cores / workers)')
+    parser.add_argument('--backend', default='eager')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16, help='clients sending requests at the same time')
+    parser.add_argument('--file', default=None, help='audio file to upload (default: a synthetic 3s clip)')
+    parser.add_argument('--url', default=None, help='test this running server instead of starting one')
+    parser.add_argument('--port', type=int, default=5077)
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, 'rb') as f:
+            clip = f.read()
+    else:
+        clip = make_clip()
+
+    print(f'{os.cpu_count()} cores, {args.requests} requests, {args.concurrency} concurrent clients')
+    print(f"{'workers':>8} {'requests/s':>12} {'p50 ms':>10} {'p99 ms':>10} {'errors':>8}")
+    if args.url:
+        run_load(args.url, clip, min(args.requests, 2 * args.concurrency), args.concurrency)   # warm up
+        print_row('-', run_load(args.url, clip, args.requests, args.concurrency))
+        sys.exit(0)
+
+    for workers in args.workers:
+        threads_per_worker = args.threads_per_worker or max(1, os.cpu_count() // workers)
+        server = start_server(workers, threads_per_worker, args.backend, args.port)
+        url = f'http://127.0.0.1:{args.port}'
+        try:
+            wait_until_ready(url, workers)
+            print_row(str(workers), run_load(url, clip, args.requests, args.concurrency))
+        finally:
+            server.terminate()
+            server.wait()
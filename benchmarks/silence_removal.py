@@ -0,0 +1,71 @@
+import os
+import sys
+import time
+
+import numpy as np
+from pydub import AudioSegment
+from pydub.silence import split_on_silence
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+from audio import segment_to_samples, remove_silence_from_samples
+
+# Benchmark of the silence removal used by /predict: pydub's split_on_silence with the chunks added back
+# together one at a time (what remove_silence does, without the file export) against the vectorized
+# remove_silence_from_samples. Run it from the repository root:
+#
+#   python benchmarks/silence_removal.py
+#
+# The clips are synthetic 44.1kHz mono 16-bit "speech" (noise bursts) with pauses of random length,
+# so that both versions have plenty of chunks to cut out and put back together.
+
+clip_lengths_s = [2, 30, 300]
+sr = 44100
+
+
+def make_clip(length_s, seed=0):
+    rng = np.random.default_rng(seed)
+    samples = np.zeros(int(length_s * sr))
+
+    position = 0
+    while position < len(samples):
+        speech_length = int(rng.uniform(0.3, 2.0) * sr)
+        pause_length = int(rng.uniform(0.1, 0.8) * sr)
+        speech = rng.standard_normal(min(speech_length, len(samples) - position)) * 0.2
+        samples[position:position + len(speech)] = speech
+        position += speech_length + pause_length
+
+    samples = (np.clip(samples, -1, 1) * 32767).astype(np.int16)
+    return AudioSegment(data=samples.tobytes(), sample_width=2, frame_rate=sr, channels=1)
+
+
+def pydub_remove_silence(audio_segment):
+    chunks = split_on_silence(audio_segment, min_silence_len=300, silence_thresh=-50)
+    output = AudioSegment.empty()
+    for chunk in chunks:
+        output += chunk
+    return output.raw_data
+
+
+def numpy_remove_silence(audio_segment):
+    samples = remove_silence_from_samples(segment_to_samples(audio_segment), audio_segment.frame_rate,
+                                          audio_segment.max_possible_amplitude, min_silence_length_ms=300, silence_threshold=-50)
+    return samples.tobytes()
+
+
+# best of a few runs (a single run for the slow ones, the 5 minute pydub run alone takes a while)
+def time_function(function, audio_segment, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = function(audio_segment)
+        timings.append(time.perf_counter() - start)
+    return min(timings), output
+
+
+if __name__ == '__main__':
+    print(f"{'clip':>8} {'pydub (s)':>12} {'numpy (s)':>12} {'speedup':>10}  same output")
+    for length_s in clip_lengths_s:
+        audio_segment = make_clip(length_s)
+        pydub_time, pydub_output = time_function(pydub_remove_silence, audio_segment, 3 if length_s <= 30 else 1)
+        numpy_time, numpy_output = time_function(numpy_remove_silence, audio_segment, 5)
+        print(f"{str(length_s) + ' s':>8} {pydub_time:>12.4f} {numpy_time:>12.4f} {pydub_time / numpy_time:>9.1f}x  {pydub_output == numpy_output}")
@@ -0,0 +1,331 @@
+import argparse
+import importlib.metadata
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+from contextlib import contextmanager, redirect_stdout
+from io import BytesIO, StringIO
+
+import numpy as np
+import soundfile as sf
+
+repository_root = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, repository_root)
+sys.path.insert(0, os.path.join(repository_root, 'api'))
+
+# Benchmark suite of the whole pipeline, on synthetic audio so no dataset has to be downloaded:
+#
+#   resample_data          Lib.resample_data of a 3s 44.1kHz wav file
+#   preprocess_dataset     Lib.preprocess_dataset of a --files clip dataset (from scratch, in this process)
+#   remove_silence         api/audio.py's remove_silence (pydub, file to file) and remove_silence_from_samples
+#   extract_mfccs          Lib.extract_mfccs of a 4s clip, and Lib.batch_features.BatchMFCC of 64 of them
+#   train_step             one Lib.training.train_one_epoch step (forward, backward, Adam) of every
+#                          --models model at every --batch-sizes batch size, on 4s (188 x 39) inputs, in
+#                          every --train-modes precision and memory format (fp32, bf16, ...-channels-last)
+#   predict                POST /predict through the Flask test client (api/app.py, the model of
+#                          api/ModelWeights), a different clip every request so the result cache never answers
+#
+# Every benchmark is warmed up, then timed --repeats times. The results (median, min, max and items per
+# second of every benchmark) and the machine they ran on are written to a JSON file, and two of those files
+# can be compared: every benchmark whose median got slower by more than --threshold is flagged as a
+# regression, and the comparison exits with status 1 if there is any. Run it from the repository root:
+#
+#   python benchmarks/suite.py                                        everything, to benchmarks/results/<time>.json
+#   python benchmarks/suite.py --only extract_mfccs predict --output after.json
+#   python benchmarks/suite.py --only train_step --models Lib.models:CNNModel --batch-sizes 16
+#   python benchmarks/suite.py --compare before.json after.json --threshold 0.1
+#
+# Numbers are only comparable between runs on the same machine under the same load: the comparison warns
+# when the machines differ. The train step only runs PooledCNNModel by default: CNNModel's first linear layer
+# alone has 359M weights, its Adam train step needs about 6 GB of memory (more at large batch sizes), so it
+# is opt-in with --models.
+
+benchmark_names = ['resample_data', 'preprocess_dataset', 'remove_silence', 'extract_mfccs', 'train_step', 'predict']
+default_models = ['Lib.models:PooledCNNModel']
+default_batch_sizes = [16, 64, 256]
+train_modes = {'fp32': ('fp32', False), 'fp32-channels-last': ('fp32', True), 'bf16': ('bf16', False),
+               'bf16-channels-last': ('bf16', True)}
+default_output_dir = os.path.join('benchmarks', 'results')
+
+sr = 44100
+
+
+# ---------------------------------------------------------------------------------------------------------
+# Fixtures
+
+
+# "speech" (noise bursts) with pauses of random length, float32 in [-1, 1]
+def speech_like(length_s, sample_rate=sr, seed=0):
+    rng = np.random.default_rng(seed)
+    samples = np.zeros(int(length_s * sample_rate), dtype=np.float32)
+
+    position = 0
+    while position < len(samples):
+        speech_length = int(rng.uniform(0.3, 1.5) * sample_rate)
+        pause_length = int(rng.uniform(0.1, 0.6) * sample_rate)
+        speech = rng.standard_normal(min(speech_length, len(samples) - position)) * 0.2
+        samples[position:position + len(speech)] = speech
+        position += speech_length + pause_length
+    return np.clip(samples, -1, 1)
+
+
+def wav_bytes(samples, sample_rate=sr):
+    clip = BytesIO()
+    sf.write(clip, samples, sample_rate, format='WAV', subtype='PCM_16')
+    return clip.getvalue()
+
+
+def write_wav(path, samples, sample_rate=sr):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    sf.write(path, samples, sample_rate, subtype='PCM_16')
+    return path
+
+
+# a dataset dictionary (see Lib.dataset_dictionary) of num_files clips of 1 to 4s in directory
+def make_dataset(directory, num_files):
+    labels = ['neutral', 'happy', 'sad', 'angry', 'fearful', 'disgust', 'surprised']
+    rng = np.random.default_rng(0)
+    dataset = {'audio path': [], 'label': []}
+    for i in range(num_files):
+        path = os.path.join(directory, f'clip_{i:04d}.wav')
+        write_wav(path, speech_like(rng.uniform(1, 4), seed=i))
+        dataset['audio path'].append(path)
+        dataset['label'].append(labels[i % len(labels)])
+    return dataset
+
+
+@contextmanager
+def working_directory(directory):
+    previous = os.getcwd()
+    os.chdir(directory)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+# ---------------------------------------------------------------------------------------------------------
+# Timing
+
+
+# times function() `repeats` times after `warm_up` untimed calls. setup(), if given, runs untimed before
+# every call (e.g. to remove what the previous call wrote). items is how many clips / samples a call handles
+def measure(function, repeats, warm_up=1, setup=None, items=1):
+    for _ in range(warm_up):
+        if setup is not None: setup()
+        function()
+
+    timings = []
+    for _ in range(repeats):
+        if setup is not None: setup()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    median = float(np.median(timings))
+    return {'median ms': median * 1000, 'min ms': min(timings) * 1000, 'max ms': max(timings) * 1000,
+            'repeats': repeats, 'items': items, 'items per s': items / median if median else 0.0}
+
+
+# ---------------------------------------------------------------------------------------------------------
+# Benchmarks, each one returns {benchmark name: measure(...)}
+
+
+def bench_resample_data(args, directory):
+    import Lib
+    path = write_wav(os.path.join(directory, 'resample_data.wav'), speech_like(3))
+    return {'resample_data (3s 44.1kHz wav)': measure(lambda: Lib.resample_data(path, Lib.target_sampling_rate), args.repeats)}
+
+
+def bench_preprocess_dataset(args, directory):
+    import Lib
+    dataset = make_dataset(os.path.join(directory, 'sources'), args.files)
+    output_dir = os.path.join(directory, 'preprocess')
+
+    # every run starts from an empty output directory, so every file is processed
+    def setup():
+        shutil.rmtree(output_dir, ignore_errors=True)
+        os.makedirs(output_dir)
+
+    def run():
+        with working_directory(output_dir), redirect_stdout(StringIO()):
+            Lib.preprocess_dataset('SYNTH', dataset, workers=args.workers)
+
+    return {f'preprocess_dataset ({args.files} files, {args.workers} workers)':
+            measure(run, max(1, args.repeats // 4), setup=setup, items=args.files)}
+
+
+def bench_remove_silence(args, directory):
+    from audio import remove_silence, remove_silence_from_samples, decode_audio, segment_to_samples
+    input_path = write_wav(os.path.join(directory, 'remove_silence.wav'), speech_like(10))
+    output_path = os.path.join(directory, 'remove_silence_output.wav')
+    audio_segment = decode_audio(open(input_path, 'rb').read())
+    samples = segment_to_samples(audio_segment)
+
+    return {'remove_silence (10s file, pydub)': measure(lambda: remove_silence(input_path, output_path), max(1, args.repeats // 4)),
+            'remove_silence_from_samples (10s)': measure(lambda: remove_silence_from_samples(
+                samples, audio_segment.frame_rate, audio_segment.max_possible_amplitude), args.repeats)}
+
+
+def bench_extract_mfccs(args, directory):
+    import Lib
+    from Lib.batch_features import BatchMFCC
+    clips = [speech_like(4, Lib.target_sampling_rate, seed=seed) for seed in range(64)]
+    extractor = BatchMFCC(sr=Lib.target_sampling_rate)
+    batch = extractor.pad(clips, desired_length_in_sec=4.0)
+
+    return {'extract_mfccs (4s clip)': measure(lambda: Lib.extract_mfccs(audio=clips[0], sr=Lib.target_sampling_rate), args.repeats),
+            'BatchMFCC (64 4s clips)': measure(lambda: extractor(batch), max(1, args.repeats // 4), items=len(clips))}
+
+
+def bench_train_step(args, directory):
+    import torch
+    import torch.nn as nn
+    import torch.optim as optim
+    from Lib.grid_search import make_model
+    from Lib.training import train_one_epoch
+
+    results = {}
+    for model_spec in args.models:
+        for mode in args.train_modes:
+            precision, channels_last = train_modes[mode]
+            torch.manual_seed(0)
+            model = make_model(model_spec, num_classes=7)
+            if channels_last: model.to(memory_format=torch.channels_last)
+            optimizer = optim.Adam(model.parameters(), lr=0.001)
+            criterion = nn.CrossEntropyLoss()
+            for batch_size in args.batch_sizes:
+                batch = [(torch.randn(batch_size, 188, 39), torch.randint(0, 7, (batch_size,)))]
+                name = f'train_step {model_spec.split(":")[1]} (batch {batch_size}{"" if mode == "fp32" else ", " + mode})'
+                results[name] = measure(lambda: train_one_epoch(model, optimizer, criterion, batch, precision=precision,
+                                                                channels_last=channels_last),
+                                        args.repeats, warm_up=2, items=batch_size)
+            del model, optimizer
+    return results
+
+
+def bench_predict(args, directory):
+    with working_directory(repository_root):
+        import app
+        app.warm_up()
+    client = app.app.test_client()
+
+    # a new clip for every request, the result cache would answer the same clip twice
+    clips = iter([wav_bytes(speech_like(3, seed=seed)) for seed in range(args.repeats + 2)])
+
+    def post():
+        response = client.post('/predict', data={'file': (BytesIO(next(clips)), 'clip.wav')})
+        assert response.status_code == 200, response.get_data(as_text=True)
+
+    return {'/predict (3s 44.1kHz wav, test client)': measure(post, args.repeats, warm_up=2)}
+
+
+benchmarks = {'resample_data': bench_resample_data, 'preprocess_dataset': bench_preprocess_dataset,
+              'remove_silence': bench_remove_silence, 'extract_mfccs': bench_extract_mfccs,
+              'train_step': bench_train_step, 'predict': bench_predict}
+
+
+# ---------------------------------------------------------------------------------------------------------
+# Results
+
+
+def package_version(name):
+    try:
+        return importlib.metadata.version(name)
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repository_root, capture_output=True, text=True,
+                              timeout=10).stdout.strip() or None
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+
+
+def machine_info():
+    import torch
+    return {'platform': platform.platform(), 'machine': platform.machine(), 'processor': platform.processor(),
+            'cpu count': os.cpu_count(), 'python': platform.python_version(), 'torch threads': torch.get_num_threads(),
+            'packages': {name: package_version(name) for name in ['numpy', 'scipy', 'librosa', 'torch', 'flask']},
+            'git commit': git_commit()}
+
+
+def run(args):
+    results = {'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'machine': machine_info(),
+               'settings': {'repeats': args.repeats, 'files': args.files, 'workers': args.workers,
+                            'models': args.models, 'batch sizes': args.batch_sizes, 'train modes': args.train_modes},
+               'benchmarks': {}}
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name in args.only:
+            print(f'{name}...', flush=True)
+            for benchmark, result in benchmarks[name](args, directory).items():
+                results['benchmarks'][benchmark] = result
+                print(f"  {benchmark:<58} {result['median ms']:>10.2f} ms  (min {result['min ms']:.2f}, "
+                      f"max {result['max ms']:.2f}, {result['items per s']:.1f} items/s)", flush=True)
+    return results
+
+
+# regressions: benchmarks of `current` whose median is more than threshold slower than in `baseline`
+def compare(baseline, current, threshold):
+    for key in ['platform', 'processor', 'cpu count', 'torch threads']:
+        if baseline['machine'].get(key) != current['machine'].get(key):
+            print(f"warning: the runs come from different machines ({key}: {baseline['machine'].get(key)} "
+                  f"against {current['machine'].get(key)}), the timings are not comparable")
+
+    regressions = []
+    print(f"{'benchmark':<58} {'baseline ms':>12} {'current ms':>12} {'change':>9}")
+    for benchmark, result in current['benchmarks'].items():
+        if benchmark not in baseline['benchmarks']:
+            print(f"{benchmark:<58} {'-':>12} {result['median ms']:>12.2f} {'new':>9}")
+            continue
+        before, after = baseline['benchmarks'][benchmark]['median ms'], result['median ms']
+        change = after / before - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(benchmark)
+        elif change < -threshold:
+            flag = '  faster'
+        print(f'{benchmark:<58} {before:>12.2f} {after:>12.2f} {change * 100:>+8.1f}%{flag}')
+    for benchmark in baseline['benchmarks']:
+        if benchmark not in current['benchmarks']: print(f"{benchmark:<58} {'(not run)':>12}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of preprocessing, features, training and serving')
+    parser.add_argument('--only', nargs='+', choices=benchmark_names, default=benchmark_names, help='benchmarks to run')
+    parser.add_argument('--output', default=None, help=f'results file (default: {default_output_dir}\\<time>.json)')
+    parser.add_argument('--repeats', type=int, default=20, help='timed runs of the fast benchmarks (a quarter for the slow ones)')
+    parser.add_argument('--files', type=int, default=32, help='clips of the preprocess_dataset benchmark')
+    parser.add_argument('--workers', type=int, default=1, help='processes of the preprocess_dataset benchmark')
+    parser.add_argument('--models', nargs='+', default=default_models, help="'module:ClassName' of the train step models")
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=default_batch_sizes)
+    parser.add_argument('--train-modes', nargs='+', choices=list(train_modes), default=['fp32', 'bf16-channels-last'])
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'), help='compare two results files instead')
+    parser.add_argument('--threshold', type=float, default=0.1, help='slowdown flagged as a regression (0.1: 10%%)')
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f: baseline = json.load(f)
+        with open(args.compare[1]) as f: current = json.load(f)
+        regressions = compare(baseline, current, args.threshold)
+        print(f'{len(regressions)} regression(s) over {args.threshold * 100:.0f}%')
+        sys.exit(1 if regressions else 0)
+
+    warnings.filterwarnings('ignore')
+    results = run(args)
+    output = args.output or os.path.join(default_output_dir, time.strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {output}')